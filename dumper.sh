@@ -4,7 +4,7 @@
 tput reset 2>/dev/null || clear
 
 # Unset Every Variables That We Are Gonna Use Later
-unset PROJECT_DIR INPUTDIR UTILSDIR OUTDIR TMPDIR FILEPATH FILE EXTENSION UNZIP_DIR ArcPath \
+unset PROJECT_DIR INPUTDIR UTILSDIR OUTDIR TMPDIR FILEPATH FILE EXTENSION UNZIP_DIR ArcPath datpairs \
 	GITHUB_TOKEN GIT_ORG TG_TOKEN CHAT_ID
 
 # Resize Terminal Window To Atleast 30x90 For Better View
@@ -96,7 +96,7 @@ done
 ## See README.md File For Program Credits
 # Set Utility Program Alias
 SDAT2IMG="${UTILSDIR}"/sdat2img.py
-SIMG2IMG="${UTILSDIR}"/bin/simg2img
+SPARSEIMG="${UTILSDIR}"/sparseimg.py
 PACKSPARSEIMG="${UTILSDIR}"/bin/packsparseimg
 UNSIN="${UTILSDIR}"/unsin
 PAYLOAD_EXTRACTOR="${UTILSDIR}"/bin/payload-dumper-go
@@ -238,10 +238,8 @@ cd "${PROJECT_DIR}"/ || exit
 function superimage_extract() {
     if [ -f super.img ]; then
         echo "Extracting Partitions from the Super Image..."
-        ${SIMG2IMG} super.img super.img.raw 2>/dev/null
-    fi
-    if [[ ! -s super.img.raw ]] && [ -f super.img ]; then
-        mv super.img super.img.raw
+        # Unsparsed, or moved as is when it is already raw
+        python3 "${SPARSEIMG}" -m super.img super.img.raw 2>/dev/null
     fi
     for partition in $PARTITIONS; do
         ($LPUNPACK --partition="$partition"_a super.img.raw || $LPUNPACK --partition="$partition" super.img.raw) 2>/dev/null
@@ -361,11 +359,11 @@ if echo "${FILEPATH}" | grep -q ".*.kdz" || [[ "${EXTENSION}" == "kdz" ]]; then
 	printf "LG KDZ Detected.\n"
 	# Either Move Downloaded/Re-Loaded File Or Copy Local File
 	mv -f "${INPUTDIR}"/"${FILE}" "${TMPDIR}"/ 2>/dev/null || cp -a "${FILEPATH}" "${TMPDIR}"/
-	python3 "${KDZ_EXTRACT}" -f "${FILE}" -x -o "./" 2>/dev/null
-	DZFILE=$(ls -- *.dz)
 	printf "Extracting All Partitions As Individual Images.\n"
-	python3 "${DZ_EXTRACT}" -f "${DZFILE}" -s -o "./" 2>/dev/null
-	rm -f "${TMPDIR}"/"${FILE}" "${TMPDIR}"/"${DZFILE}" 2>/dev/null
+	# undz reads the DZ in place inside the KDZ, no need to unpack it first;
+	# only slot A of the supported partitions is decompressed
+	python3 "${DZ_EXTRACT}" -f "${FILE}" -s --sparse --slot a -I "${PARTITIONS}" -o "./" 2>/dev/null
+	rm -f "${TMPDIR}"/"${FILE}" "${TMPDIR}"/"${FILE}".index.json 2>/dev/null
 	# dzpartitions="gpt_main persist misc metadata vendor system system_other product userdata gpt_backup tz boot dtbo vbmeta cust oem odm factory modem NON-HLOS"
 	find "${TMPDIR}" -maxdepth 1 -type f -name "*.image" | while read -r i; do mv "${i}" "${i/.image/.img}" 2>/dev/null; done
 	find "${TMPDIR}" -maxdepth 1 -type f -name "*_a.img" | while read -r i; do mv "${i}" "${i/_a.img/.img}" 2>/dev/null; done
@@ -411,8 +409,7 @@ if [[ -f "${FILEPATH}" ]]; then
 			${BIN_7ZZ} e -y -- "${FILEPATH}" "${foundfile}" */"${foundfile}" 2>/dev/null >> "${TMPDIR}"/zip.log
 			output=$(ls -- "${filename}"* 2>/dev/null)
 			[[ ! -e "${TMPDIR}"/"${outname}".img ]] && mv "${output}" "${TMPDIR}"/"${outname}".img
-			"${SIMG2IMG}" "${TMPDIR}"/"${outname}".img "${OUTDIR}"/"${outname}".img 2>/dev/null
-			[[ ! -s "${OUTDIR}"/"${outname}".img && -f "${TMPDIR}"/"${outname}".img ]] && mv "${outname}".img "${OUTDIR}"/"${outname}".img
+			python3 "${SPARSEIMG}" -m "${TMPDIR}"/"${outname}".img "${OUTDIR}"/"${outname}".img 2>/dev/null
 		fi
 	done
 fi
@@ -429,26 +426,21 @@ if ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "system.new.dat" 2>/dev/null || [[ $
 		# rename(my_bigball.00011011.new.dat.br, my_bigball.new.dat.br)
 		# rename(my_bigball.00011011.patch.dat, my_bigball.patch.dat)
 		# rename(my_bigball.00011011.transfer.list, my_bigball.transfer.list)
-		if [[ -f ${partition}.new.dat.1 ]]; then
-			cat ${partition}.new.dat.{0..999} 2>/dev/null >> ${partition}.new.dat
-			rm -rf ${partition}.new.dat.{0..999}
-		fi
-		ls | grep "\.new\.dat" | while read i; do
-			line=$(echo "$i" | cut -d"." -f1)
-			if [[ $(echo "$i" | grep "\.dat\.xz") ]]; then
-				${BIN_7ZZ} e -y "$i" 2>/dev/null >> ${TMPDIR}/zip.log
-				rm -rf "$i"
-			fi
-			if [[ $(echo "$i" | grep "\.dat\.br") ]]; then
-				echo "Converting brotli ${partition} dat to normal"
-				brotli -d "$i"
-				rm -f "$i"
-			fi
-			echo "Extracting ${partition}"
-			python3 ${SDAT2IMG} ${line}.transfer.list ${line}.new.dat "${OUTDIR}"/${line}.img > ${TMPDIR}/extract.log
-			rm -rf ${line}.transfer.list ${line}.new.dat
+		# sdat2img reads compressed (.br/.xz/.lz4) and split (.new.dat.N) data directly
+		for i in ${partition}.new.dat ${partition}.new.dat.br ${partition}.new.dat.xz ${partition}.new.dat.lz4 ${partition}.new.dat.0; do
+			[[ -f ${i} && -f ${partition}.transfer.list ]] || continue
+			echo "Found ${partition}"
+			datpairs="${datpairs} ${partition}.transfer.list=${i}"
+			break
 		done
 	done
+	# Convert all partitions at once, one worker process per CPU
+	if [[ -n "${datpairs}" ]]; then
+		python3 ${SDAT2IMG} -b ${datpairs} -o "${OUTDIR}" > ${TMPDIR}/extract.log
+		for pair in ${datpairs}; do
+			rm -rf ${pair%%=*} ${pair%%.transfer.list=*}.new.dat*
+		done
+	fi
 elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep rawprogram || [[ $(find "${TMPDIR}" -type f -name "*rawprogram*" | wc -l) -ge 1 ]]; then
 	echo "QFIL Detected"
 	rawprograms=$(${BIN_7ZZ} l -ba ${FILEPATH} | gawk '{ print $NF }' | grep rawprogram)
@@ -495,8 +487,7 @@ elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep system | grep chunk | grep -q -v ".*\
 		romchunk=$(find . -maxdepth 1 -type f -name "*${partition}*chunk*" | cut -d'/' -f'2-' | sort)
 		if echo "${romchunk}" | grep -q "sparsechunk"; then
 			if [[ ! -f "${partition}".img ]]; then
-				"${SIMG2IMG}" "${romchunk}" "${partition}".img.raw 2>/dev/null
-				mv "${partition}".img.raw "${partition}".img
+				python3 "${SPARSEIMG}" ${romchunk} "${partition}".img 2>/dev/null
 			fi
 			rm -rf -- *"${partition}"*chunk* 2>/dev/null
 		fi
@@ -595,7 +586,7 @@ elif [[ $(${BIN_7ZZ} l -ba "$FILEPATH" | grep "super.img") ]]; then
 	${BIN_7ZZ} e -y "${FILEPATH}" $foundsupers dummypartition 2>/dev/null >> ${TMPDIR}/zip.log
 	superchunk=$(ls | grep chunk | grep super | sort)
 	if [[ $(echo "$superchunk" | grep "sparsechunk") ]]; then
-		"${SIMG2IMG}" $(echo "$superchunk" | tr '\n' ' ') super.img.raw 2>/dev/null
+		python3 "${SPARSEIMG}" ${superchunk} super.img.raw 2>/dev/null
 		rm -rf *super*chunk*
 	fi
 	superimage_extract || exit 1
@@ -608,13 +599,13 @@ elif [[ $(find "${TMPDIR}" -type f -name "super*.*img" | wc -l) -ge 1 ]]; then
 	splitsupers=$(ls | grep -oP "super.[0-9].+.img")
 	if [[ ! -z "${splitsupers}" ]]; then
 		printf "Creating super.img.raw ...\n"
-		"${SIMG2IMG}" ${splitsupers} super.img.raw 2>/dev/null
+		python3 "${SPARSEIMG}" ${splitsupers} super.img.raw 2>/dev/null
 		rm -rf -- ${splitsupers}
 	fi
 	superchunk=$(find . -maxdepth 1 -type f -name "*super*chunk*" | cut -d'/' -f'2-' | sort)
 	if echo "${superchunk}" | grep -q "sparsechunk"; then
 		printf "Creating super.img.raw ...\n"
-		"${SIMG2IMG}" ${superchunk} super.img.raw 2>/dev/null
+		python3 "${SPARSEIMG}" ${superchunk} super.img.raw 2>/dev/null
 		rm -rf -- *super*chunk*
 	fi
 	superimage_extract || exit 1
@@ -671,16 +662,11 @@ elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "UPDATE.APP" 2>/dev/null || [[ $(f
 	printf "Huawei UPDATE.APP Detected\n"
 	[[ -f "${FILEPATH}" ]] && ${BIN_7ZZ} x "${FILEPATH}" UPDATE.APP 2>/dev/null >> "${TMPDIR}"/zip.log
 	find "${TMPDIR}" -type f -name "UPDATE.APP" -exec mv {} . \;
-	python3 "${SPLITUAPP}" -f "UPDATE.APP" -l super preas preavs || (
-	for partition in ${PARTITIONS}; do
-		python3 "${SPLITUAPP}" -f "UPDATE.APP" -l "${partition/.img/}" || printf "%s not found in UPDATE.APP\n" "${partition}"
-	done )
+	# One indexed pass each; the second run reuses the UPDATE.APP.index.json of the first
+	# Sparse super entries are merged into a raw super.img while extracting
+	python3 "${SPLITUAPP}" -f "UPDATE.APP" -u -l super preas preavs || python3 "${SPLITUAPP}" -f "UPDATE.APP" -u -l ${PARTITIONS//.img/}
 	find output/ -type f -name "*.img" -exec mv {} . \;	# Partitions Are Extracted In "output" Folder
-	if [[ -f super.img ]]; then
-		printf "Creating super.img.raw ...\n"
-		"${SIMG2IMG}" super.img super_* super.img.raw 2>/dev/null
-		[[ ! -s super.img.raw && -f super.img ]] && mv super.img super.img.raw
-	fi
+	[[ -f super.img ]] && mv super.img super.img.raw
 	superimage_extract || exit 1
 elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "rockchip" 2>/dev/null || [[ $(find "${TMPDIR}" -type f -name "rockchip") ]]; then
 	printf "Rockchip Detected\n"
@@ -715,8 +701,7 @@ for otherpartition in ${OTHERPARTITIONS}; do
 	if [[ -f "${output}" ]]; then
 		printf "%s Detected For %s\n" "${output}" "${outname}"
 		[[ ! -e "${TMPDIR}"/"${outname}".img ]] && mv "${output}" "${TMPDIR}"/"${outname}".img
-		"${SIMG2IMG}" "${TMPDIR}"/"${outname}".img "${OUTDIR}"/"${outname}".img 2>/dev/null
-		[[ ! -s "${OUTDIR}"/"${outname}".img && -f "${TMPDIR}"/"${outname}".img ]] && mv "${outname}".img "${OUTDIR}"/"${outname}".img
+		python3 "${SPARSEIMG}" -m "${TMPDIR}"/"${outname}".img "${OUTDIR}"/"${outname}".img 2>/dev/null
 	fi
 done
 
@@ -726,7 +711,7 @@ for partition in ${PARTITIONS}; do
 		foundpart=$(${BIN_7ZZ} l -ba "${FILEPATH}" | gawk '{print $NF}' | grep "${partition}.img" 2>/dev/null)
 		${BIN_7ZZ} e -y -- "${FILEPATH}" "${foundpart}" */"${foundpart}" 2>/dev/null >> "${TMPDIR}"/zip.log
 	fi
-	[[ -f "${partition}".img ]] && "${SIMG2IMG}" "${partition}".img "${OUTDIR}"/"${partition}".img 2>/dev/null
+	[[ -f "${partition}".img ]] && python3 "${SPARSEIMG}" -m "${partition}".img "${OUTDIR}"/"${partition}".img 2>/dev/null
 	[[ ! -s "${OUTDIR}"/"${partition}".img && -f "${TMPDIR}"/"${partition}".img ]] && mv "${TMPDIR}"/"${partition}".img "${OUTDIR}"/"${partition}".img
 	if [[ "${EXT4PARTITIONS}" =~ (^|[[:space:]])"${partition}"($|[[:space:]]) && -f "${OUTDIR}"/"${partition}".img ]]; then
 		MAGIC=$(head -c12 "${OUTDIR}"/"${partition}".img | tr -d '\0')
@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: blockimgupdate.py
+#   DESCRIPTION: Apply block based (incremental) OTA
+#                transfer lists onto an image in place
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, bz2, zlib, time, shutil, hashlib, tempfile
+from collections import OrderedDict
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import blockio
+import sdat2img
+from sdat2img import BLOCK_SIZE, rangeset
+
+# Default amount of stashed data kept in RAM before spilling to disk
+STASH_MEMORY = 256 << 20
+
+class BlockImageUpdateError(Exception):
+    pass
+
+def _offtin(buf, pos):
+    """
+    bsdiff's sign-magnitude 64 bit integers
+
+    >>> _offtin(bytes([5, 0, 0, 0, 0, 0, 0, 0x80]), 0)
+    -5
+    """
+    value = int.from_bytes(bytes(buf[pos:pos + 8]), 'little')
+    if value & (1 << 63):
+        value = -(value & ((1 << 63) - 1))
+    return value
+
+def _add_bytes(a, b):
+    """
+    Byte-wise addition modulo 256 of two equally long buffers, done on big
+    integers: the low 7 bits of each byte can't carry into the next byte
+    and the top bit is the xor of both top bits and that carry
+
+    >>> _add_bytes(bytes([0x01, 0x7f, 0x80, 0xff]), bytes([0x01, 0x01, 0x80, 0x02])).hex()
+    '02800001'
+    >>> _add_bytes(b'', b'')
+    b''
+    """
+    n = len(a)
+    if not n:
+        return b''
+    x = int.from_bytes(bytes(a), 'little')
+    y = int.from_bytes(bytes(b), 'little')
+    low = int.from_bytes(b'\x7f'*n, 'little')
+    high = int.from_bytes(b'\x80'*n, 'little')
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, 'little')
+
+def _bsdf2_decompress(kind, data):
+    if kind == 0:
+        return bytes(data)
+    if kind == 1:
+        return bz2.decompress(data)
+    if kind == 2 and brotli:
+        return brotli.decompress(bytes(data))
+    raise BlockImageUpdateError('unsupported BSDF2 compression type {}'.format(kind))
+
+def apply_bsdiff(old, patch):
+    """
+    Apply a BSDIFF40 or BSDF2 patch to old, return the new data
+
+    The header is the magic, then the control and diff stream lengths and
+    the new size at offsets 8, 16 and 24; the streams start at 32.  BSDF2
+    gives the compression of each stream in magic bytes 5 to 7 (0 none,
+    1 bzip2, 2 brotli), BSDIFF40 bzip2s them all.
+
+    >>> import bz2
+    >>> def off(value):
+    ...     return (abs(value) | (1 << 63 if value < 0 else 0)).to_bytes(8, 'little')
+    >>> def patch(magic, ctrl, diff, extra, size, pack=bytes):
+    ...     ctrl = pack(b''.join(off(value) for value in ctrl))
+    ...     diff, extra = pack(diff), pack(extra)
+    ...     return magic + off(len(ctrl)) + off(len(diff)) + off(size) + ctrl + diff + extra
+    >>> apply_bsdiff(b'hello world', patch(b'BSDF2' + bytes(3), [11, 2, 0], bytes([2]) + bytes(10), b'!!', 13))
+    b'jello world!!'
+    >>> apply_bsdiff(b'abcdef', patch(b'BSDIFF40', [0, 2, 3, 3, 0, -6, 3, 0, 0], bytes(6), b'XY', 8, bz2.compress))
+    b'XYdefabc'
+    >>> apply_bsdiff(b'abc', patch(b'BSDIFF41', [3, 0, 0], bytes(3), b'', 3))
+    Traceback (most recent call last):
+    ...
+    blockimgupdate.BlockImageUpdateError: bad bsdiff magic b'BSDIFF41'
+    """
+    patch = memoryview(patch)
+    magic = bytes(patch[:8])
+    if magic == b'BSDIFF40':
+        if bsdiff4:
+            return bsdiff4.patch(bytes(old), bytes(patch))
+        kinds = (1, 1, 1)
+    elif magic[:5] == b'BSDF2':
+        kinds = tuple(bytearray(magic[5:8]))
+    else:
+        raise BlockImageUpdateError('bad bsdiff magic {!r}'.format(magic))
+
+    ctrl_len = _offtin(patch, 8)
+    diff_len = _offtin(patch, 16)
+    new_size = _offtin(patch, 24)
+    if ctrl_len < 0 or diff_len < 0 or new_size < 0:
+        raise BlockImageUpdateError('corrupt bsdiff header')
+
+    pos = 32
+    ctrl = _bsdf2_decompress(kinds[0], patch[pos:pos + ctrl_len])
+    pos += ctrl_len
+    diff = _bsdf2_decompress(kinds[1], patch[pos:pos + diff_len])
+    pos += diff_len
+    extra = _bsdf2_decompress(kinds[2], patch[pos:])
+
+    old = memoryview(old)
+    new = bytearray(new_size)
+    new_pos = old_pos = diff_pos = extra_pos = 0
+    for i in range(0, len(ctrl), 24):
+        x, y, z = _offtin(ctrl, i), _offtin(ctrl, i + 8), _offtin(ctrl, i + 16)
+        if x < 0 or y < 0 or new_pos + x + y > new_size:
+            raise BlockImageUpdateError('corrupt bsdiff control block')
+
+        # Add old data to diff data; old data outside the old buffer is zero
+        if old_pos >= 0 and old_pos + x <= len(old):
+            base = old[old_pos:old_pos + x]
+        else:
+            base = bytearray(x)
+            lo = min(max(old_pos, 0), len(old))
+            hi = max(min(old_pos + x, len(old)), lo)
+            base[lo - old_pos:hi - old_pos] = old[lo:hi]
+        new[new_pos:new_pos + x] = _add_bytes(diff[diff_pos:diff_pos + x], base)
+        new_pos += x
+        diff_pos += x
+        old_pos += x
+
+        new[new_pos:new_pos + y] = extra[extra_pos:extra_pos + y]
+        new_pos += y
+        extra_pos += y
+        old_pos += z
+
+    return bytes(new)
+
+CHUNK_NORMAL = 0
+CHUNK_GZIP = 1
+CHUNK_DEFLATE = 2
+CHUNK_RAW = 3
+
+def apply_imgdiff(old, patch):
+    """
+    Apply an IMGDIFF2 patch (bsdiff per chunk, with deflate chunks patched
+    uncompressed and recompressed with the recorded zlib parameters)
+
+    After the magic come the chunk count and the chunks: a NORMAL chunk
+    is its source start, length and patch offset (8 bytes each), a RAW
+    chunk a 4 byte length and the data, a DEFLATE chunk the NORMAL fields,
+    both expanded lengths and the 4 byte zlib level, method, window bits,
+    memory level and strategy.
+
+    >>> def i4(value):
+    ...     return value.to_bytes(4, 'little', signed=True)
+    >>> def i8(value):
+    ...     return value.to_bytes(8, 'little', signed=True)
+    >>> def bsdf2(diff):
+    ...     return b'BSDF2' + bytes(3) + i8(24) + i8(len(diff)) + i8(len(diff)) + i8(len(diff)) + i8(0) + i8(0) + diff
+    >>> def deflate(data):
+    ...     compressor = zlib.compressobj(6, zlib.DEFLATED, -15, 8, 0)
+    ...     return compressor.compress(data) + compressor.flush()
+    >>> old = b'HEAD' + deflate(b'hello world')
+    >>> normal = bsdf2(bytes([32])*4)
+    >>> inner = bsdf2(bytes([2]) + bytes(10))
+    >>> new = apply_imgdiff(old, b'IMGDIFF2' + i4(3)
+    ...     + i4(CHUNK_NORMAL) + i8(0) + i8(4) + i8(114)
+    ...     + i4(CHUNK_DEFLATE) + i8(4) + i8(len(old) - 4) + i8(114 + len(normal)) + i8(11) + i8(11)
+    ...     + i4(6) + i4(zlib.DEFLATED) + i4(-15) + i4(8) + i4(0)
+    ...     + i4(CHUNK_RAW) + i4(2) + b'--'
+    ...     + normal + inner)
+    >>> new == b'head' + deflate(b'jello world') + b'--'
+    True
+    """
+    patch = memoryview(patch)
+    if bytes(patch[:8]) != b'IMGDIFF2':
+        raise BlockImageUpdateError('bad imgdiff magic {!r}'.format(bytes(patch[:8])))
+
+    def read4(pos):
+        return int.from_bytes(bytes(patch[pos:pos + 4]), 'little', signed=True)
+
+    def read8(pos):
+        return int.from_bytes(bytes(patch[pos:pos + 8]), 'little', signed=True)
+
+    old = memoryview(old)
+    out = []
+    pos = 12
+    for i in range(read4(8)):
+        kind = read4(pos)
+        pos += 4
+        if kind == CHUNK_NORMAL:
+            src_start, src_len, patch_offset = read8(pos), read8(pos + 8), read8(pos + 16)
+            pos += 24
+            out.append(apply_bsdiff(old[src_start:src_start + src_len], patch[patch_offset:]))
+        elif kind == CHUNK_RAW:
+            length = read4(pos)
+            pos += 4
+            out.append(bytes(patch[pos:pos + length]))
+            pos += length
+        elif kind == CHUNK_DEFLATE:
+            src_start, src_len, patch_offset = read8(pos), read8(pos + 8), read8(pos + 16)
+            src_expanded, tgt_expanded = read8(pos + 24), read8(pos + 32)
+            level, method, window_bits, mem_level, strategy = [read4(pos + 40 + 4*j) for j in range(5)]
+            pos += 60
+
+            expanded = zlib.decompressobj(-15).decompress(old[src_start:src_start + src_len])
+            if len(expanded) != src_expanded:
+                raise BlockImageUpdateError('imgdiff chunk {}: source expanded to {} bytes, expected {}'.format(i, len(expanded), src_expanded))
+            target = apply_bsdiff(expanded, patch[patch_offset:])
+            if len(target) != tgt_expanded:
+                raise BlockImageUpdateError('imgdiff chunk {}: patched to {} bytes, expected {}'.format(i, len(target), tgt_expanded))
+            compressor = zlib.compressobj(level, method, window_bits, mem_level, strategy)
+            out.append(compressor.compress(target) + compressor.flush())
+        else:
+            raise BlockImageUpdateError('imgdiff chunk {}: unsupported type {}'.format(i, kind))
+    return b''.join(out)
+
+class StashCache(object):
+    """
+    Stashed blocks, kept in RAM up to limit bytes (least recently used
+    entries are spilled to files in a scratch directory beyond that)
+    """
+
+    def __init__(self, limit=STASH_MEMORY, spill_dir=None):
+        self.limit = limit
+        self.spill_parent = spill_dir
+        self.spill_dir = None
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled = {}
+        self.peak_bytes = 0
+        self.spills = 0
+        self.reloads = 0
+
+    def _spill_path(self, key):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='stash-', dir=self.spill_parent)
+        return os.path.join(self.spill_dir, key.replace(os.sep, '_'))
+
+    def _spill(self, key, data):
+        path = self._spill_path(key)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.spilled[key] = path
+        self.spills += 1
+
+    def put(self, key, data):
+        self.free(key)
+        if len(data) > self.limit:
+            self._spill(key, data)
+            return
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.limit:
+            old_key, old_data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old_data)
+            self._spill(old_key, old_data)
+        self.peak_bytes = max(self.peak_bytes, self.memory_bytes)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.spilled:
+            self.reloads += 1
+            with open(self.spilled[key], 'rb') as f:
+                return f.read()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.spilled
+
+    def free(self, key):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        elif key in self.spilled:
+            os.remove(self.spilled.pop(key))
+
+    def close(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        self.spilled.clear()
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+class BlockImageUpdate(object):
+    """
+    Applies a transfer list (versions 1 to 4) with its new.dat and
+    patch.dat onto an image in place, verifying source and target hashes
+    """
+
+    def __init__(self, transfer_list, new_data, patch_data, image,
+            stash_memory=STASH_MEMORY, stash_dir=None, verify=True):
+        self.transfer_list = transfer_list
+        self.new_data_path = new_data
+        self.patch_data_path = patch_data
+        self.image = image
+        self.verify = verify
+        self.stash_memory = stash_memory
+        self.stash_dir = stash_dir if stash_dir else os.path.dirname(os.path.abspath(image))
+        self.counts = {}
+        self.written = 0
+
+    def read_ranges(self, ranges):
+        return b''.join(os.pread(self.fd, (end - begin)*BLOCK_SIZE, begin*BLOCK_SIZE) for begin, end in ranges)
+
+    def write_ranges(self, ranges, data):
+        data = memoryview(data)
+        pos = 0
+        for begin, end in ranges:
+            length = (end - begin)*BLOCK_SIZE
+            blockio.pwrite_all(self.fd, data[pos:pos + length], begin*BLOCK_SIZE)
+            pos += length
+        self.written += pos
+
+    def check_hash(self, data, expected):
+        return not self.verify or hashlib.sha1(data).hexdigest() == expected
+
+    def load_source(self, tokens):
+        """
+        Load the source buffer described by '<blocks> <range> [<locs>]
+        [<id>:<range> ...]' or '<blocks> - <id>:<range> ...'
+        """
+        blocks = int(tokens[0])
+        buf = bytearray(blocks*BLOCK_SIZE)
+        rest = tokens[2:]
+        if tokens[1] != '-':
+            data = self.read_ranges(rangeset(tokens[1]))
+            if rest:
+                self.move_range(buf, rangeset(rest[0]), data)
+                rest = rest[1:]
+            else:
+                buf[:len(data)] = data
+        for spec in rest:
+            stash_id, locs = spec.split(':', 1)
+            try:
+                self.move_range(buf, rangeset(locs), self.stash.get(stash_id))
+            except KeyError:
+                raise BlockImageUpdateError('missing stash {}'.format(stash_id))
+        return buf
+
+    def move_range(self, dest, locs, source):
+        """
+        Scatter the contiguous blocks of source to the block positions locs
+        """
+        pos = 0
+        for begin, end in locs:
+            length = (end - begin)*BLOCK_SIZE
+            dest[begin*BLOCK_SIZE:end*BLOCK_SIZE] = source[pos:pos + length]
+            pos += length
+
+    def do_move(self, tokens, patch=None):
+        """
+        move/bsdiff/imgdiff: patch is (kind, offset, length) for the latter
+        """
+        if self.version == 1:
+            src = self.read_ranges(rangeset(tokens[0]))
+            tgt = rangeset(tokens[1])
+            src_hash = tgt_hash = None
+        else:
+            if self.version >= 3:
+                src_hash = tokens.pop(0)
+                tgt_hash = tokens.pop(0) if patch else src_hash
+            else:
+                src_hash = tgt_hash = None
+            tgt = rangeset(tokens[0])
+            src = self.load_source(tokens[1:])
+
+            if src_hash and not self.check_hash(src, src_hash):
+                # An earlier run may have written the target already, or
+                # stashed the overlapping source under its hash
+                if tgt_hash and self.check_hash(self.read_ranges(tgt), tgt_hash):
+                    return
+                if src_hash in self.stash:
+                    src = self.stash.get(src_hash)
+                else:
+                    raise BlockImageUpdateError('source hash mismatch for {} (expected {})'.format(tokens[0], src_hash))
+
+        if patch:
+            kind, offset, length = patch
+            patch_buf = os.pread(self.patch_fd, length, offset)
+            if kind == 'bsdiff':
+                data = apply_bsdiff(src, patch_buf)
+            else:
+                data = apply_imgdiff(src, patch_buf)
+            if len(data) != tgt.size()*BLOCK_SIZE:
+                raise BlockImageUpdateError('{} produced {} bytes for {} blocks'.format(kind, len(data), tgt.size()))
+            if tgt_hash and not self.check_hash(data, tgt_hash):
+                raise BlockImageUpdateError('{} target hash mismatch (expected {})'.format(kind, tgt_hash))
+        else:
+            data = src[:tgt.size()*BLOCK_SIZE]
+        self.write_ranges(tgt, data)
+
+    def do_new(self, ranges):
+        for begin, end in ranges:
+            length = (end - begin)*BLOCK_SIZE
+            data = self.new_data.read_at(self.new_pos, length)
+            if len(data) < length:
+                raise BlockImageUpdateError('new data ended at offset {}'.format(self.new_pos + len(data)))
+            blockio.pwrite_all(self.fd, data, begin*BLOCK_SIZE)
+            self.new_pos += length
+            self.written += length
+
+    def do_stash(self, stash_id, ranges):
+        if stash_id in self.stash:
+            return
+        data = self.read_ranges(ranges)
+        if self.version >= 3 and not self.check_hash(data, stash_id):
+            # Only fatal if a later command really needs it
+            print('Warning: stash {} does not match its source blocks, not stashed'.format(stash_id), file=sys.stderr)
+            return
+        self.stash.put(stash_id, data)
+
+    def run(self):
+        start = time.time()
+        with open(self.transfer_list, 'r') as f:
+            lines = [line.rstrip('\n') for line in f]
+
+        self.version = int(lines[0])
+        total_blocks = int(lines[1])
+        body = lines[2:]
+        max_stash_blocks = 0
+        if self.version >= 2:
+            max_stash_blocks = int(lines[3])
+            body = lines[4:]
+
+        # The transfer list declares its peak stash usage; keep it all in
+        # RAM when that fits the budget, otherwise spill the overflow
+        limit = min(self.stash_memory, max_stash_blocks*BLOCK_SIZE) if max_stash_blocks else self.stash_memory
+        if max_stash_blocks*BLOCK_SIZE > self.stash_memory:
+            print('Stash needs up to {:.1f} MiB, spilling beyond {:.1f} MiB to {}'.format(
+                    max_stash_blocks*BLOCK_SIZE/1048576.0, self.stash_memory/1048576.0, self.stash_dir))
+        self.stash = StashCache(limit, self.stash_dir)
+
+        self.fd = os.open(self.image, os.O_RDWR)
+        self.patch_fd = os.open(self.patch_data_path, os.O_RDONLY) if self.patch_data_path else None
+        self.new_data = sdat2img.open_new_data(self.new_data_path) if self.new_data_path else None
+        self.new_pos = 0
+        image_end = 0
+
+        try:
+            for number, line in enumerate(body):
+                tokens = line.split()
+                if not tokens:
+                    continue
+                cmd = tokens.pop(0)
+                self.counts[cmd] = self.counts.get(cmd, 0) + 1
+                try:
+                    if cmd in ('move', 'bsdiff', 'imgdiff'):
+                        patch = None
+                        if cmd != 'move':
+                            patch = (cmd, int(tokens.pop(0)), int(tokens.pop(0)))
+                        self.do_move(tokens, patch)
+                    elif cmd == 'new':
+                        ranges = rangeset(tokens[0])
+                        image_end = max(image_end, ranges.last)
+                        self.do_new(ranges)
+                    elif cmd in ('zero', 'erase'):
+                        ranges = rangeset(tokens[0])
+                        image_end = max(image_end, ranges.last)
+                        for begin, end in ranges:
+                            blockio.punch_hole(self.fd, begin*BLOCK_SIZE, (end - begin)*BLOCK_SIZE)
+                    elif cmd == 'stash':
+                        self.do_stash(tokens[0], rangeset(tokens[1]))
+                    elif cmd == 'free':
+                        self.stash.free(tokens[0])
+                    elif cmd == 'compute_hash_tree':
+                        print('Warning: skipping compute_hash_tree, hash trees are not rebuilt', file=sys.stderr)
+                    elif cmd == 'abort':
+                        raise BlockImageUpdateError('transfer list requested abort')
+                    else:
+                        raise BlockImageUpdateError('unknown command "{}"'.format(cmd))
+                except BlockImageUpdateError as e:
+                    raise BlockImageUpdateError('line {}: {}: {}'.format(number + 5 if self.version >= 2 else number + 3, cmd, e))
+
+            # zero/erase past the old end of image only make it longer
+            if os.fstat(self.fd).st_size < image_end*BLOCK_SIZE:
+                os.ftruncate(self.fd, image_end*BLOCK_SIZE)
+        finally:
+            os.close(self.fd)
+            if self.patch_fd is not None:
+                os.close(self.patch_fd)
+            if self.new_data:
+                self.new_data.close()
+            self.stash.close()
+
+        return {
+            'version': self.version,
+            'blocks': total_blocks,
+            'bytes': self.written,
+            'seconds': time.time() - start,
+            'commands': self.counts,
+            'stash_peak': self.stash.peak_bytes,
+            'stash_spills': self.stash.spills,
+        }
+
+def main(transfer_list, new_data, patch_data, image, output=None, stash_memory=STASH_MEMORY, stash_dir=None, verify=True):
+    if output and os.path.realpath(output) != os.path.realpath(image):
+        print('Copying {} to {}...'.format(image, output))
+        with open(image, 'rb') as src, open(output, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            blockio.copy_range(src.fileno(), 0, dst.fileno(), 0, size)
+        image = output
+
+    try:
+        stats = BlockImageUpdate(transfer_list, new_data, patch_data, image,
+                stash_memory, stash_dir, verify).run()
+    except (BlockImageUpdateError, IOError, OSError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print(', '.join('{} {}'.format(count, cmd) for cmd, count in sorted(stats['commands'].items())))
+    print('Stash peak {:.1f} MiB in memory, {} entries spilled to disk'.format(stats['stash_peak']/1048576.0, stats['stash_spills']))
+    print('Wrote {:.1f} MiB in {:.2f}s ({:.1f} MiB/s)'.format(stats['bytes']/1048576.0, stats['seconds'], stats['bytes']/1048576.0/max(stats['seconds'], 1e-6)))
+    print('Done! Updated image: {}'.format(os.path.realpath(image)))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Apply a block based (incremental) OTA onto a source image')
+    parser.add_argument('transfer_list', help='transfer list file')
+    parser.add_argument('new_data', help='new dat file (.br, .xz, .lz4 and split sets are read directly)')
+    parser.add_argument('patch_data', help='patch dat file')
+    parser.add_argument('image', help='source image, updated in place unless --output is given')
+    parser.add_argument('-o', '--output', help='copy the source image here and update the copy')
+    parser.add_argument('-m', '--stash-memory', type=int, default=STASH_MEMORY >> 20, metavar='MiB',
+            help='stash data kept in RAM before spilling to disk (default: {})'.format(STASH_MEMORY >> 20))
+    parser.add_argument('--stash-dir', help='directory for spilled stashes (default: next to the image)')
+    parser.add_argument('--no-verify', action='store_false', dest='verify', help='skip SHA1 checks of source and target blocks')
+    args = parser.parse_args()
+
+    main(args.transfer_list, args.new_data, args.patch_data, args.image, args.output,
+            args.stash_memory << 20, args.stash_dir, args.verify)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: blockio.py
+#   DESCRIPTION: Block level file I/O shared by the
+#                extractors: range copies, reflinks,
+#                holes, preallocation and cache hints
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os, sys, errno, struct
+
+# Largest amount of data handed to the kernel (or read into RAM) at once
+COPY_CHUNK = 64 << 20
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940D
+FILE_CLONE_RANGE = struct.Struct('=qQQQ')
+
+# Clone ranges have to start on a filesystem block, 4096 is the usual one
+REFLINK_ALIGN = 4096
+
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+_fallocate = None
+
+def fallocate(fd, mode, offset, length):
+    """
+    Call the Linux fallocate(2), return False where it isn't available
+    """
+    global _fallocate
+    if _fallocate is None:
+        _fallocate = False
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            func = getattr(libc, 'fallocate64', None) or libc.fallocate
+            func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            func.restype = ctypes.c_int
+            _fallocate = func
+        except (ImportError, OSError, AttributeError):
+            pass
+    if not _fallocate or length <= 0:
+        return False
+    return _fallocate(fd, mode, offset, length) == 0
+
+def preallocate(fd, offset, length):
+    """
+    Reserve space for a range about to be written
+    """
+    return fallocate(fd, 0, offset, length)
+
+def punch_hole(fd, offset, length):
+    """
+    Make a range read back as zeros without keeping blocks allocated for it
+    """
+    if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length):
+        return
+    # Nothing to clear past the end of file, truncate() extends with a hole
+    length = min(length, os.fstat(fd).st_size - offset)
+    zero = bytes(min(length, COPY_CHUNK)) if length > 0 else b''
+    while length > 0:
+        n = os.pwrite(fd, zero[:length], offset)
+        offset += n
+        length -= n
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise(2) hint, silently ignored where unsupported
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def pread(fd, count, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, count, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, count)
+
+def preadinto(fd, view, offset):
+    """
+    Read into the writable buffer view from offset, without moving the
+    file offset where pread is available; return the bytes read
+    """
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    data = pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+def reflink(src_fd, src_pos, dst_fd, dst_pos, length):
+    """
+    Share length bytes of src_fd with dst_fd (FICLONERANGE), raises OSError
+    when the filesystem can't; offsets must be block aligned and so must
+    length unless the range ends at the end of the source
+    """
+    import fcntl
+    arg = FILE_CLONE_RANGE.pack(src_fd, src_pos, length, dst_pos)
+    fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+
+class RangeCopier(object):
+    """
+    Copies byte ranges between two file descriptors, preferring to share
+    the blocks (reflink), then to let the kernel move the data
+    (copy_file_range, then sendfile) and falling back to large buffered
+    reads.  A method that fails once is not tried again.  With dontneed
+    the source pages are dropped from the page cache once copied, for data
+    which is read only once.
+    """
+
+    def __init__(self, dontneed=False):
+        self.use_reflink = sys.platform.startswith('linux')
+        self.use_copy_file_range = hasattr(os, 'copy_file_range')
+        self.use_sendfile = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+        self.dontneed = dontneed
+        self.buffer = None
+
+    def copy(self, src_fd, src_pos, dst_fd, dst_pos, length, progress=None):
+        """
+        Copy length bytes from src_pos of src_fd to dst_pos of dst_fd,
+        return the number of bytes copied (less than length on EOF)
+        """
+        fadvise(src_fd, src_pos, length, FADV_SEQUENTIAL)
+
+        done = self._reflink(src_fd, src_pos, dst_fd, dst_pos, length)
+        if done and progress is not None:
+            progress.update(bytes_in=done, bytes_out=done)
+
+        while done < length:
+            count = min(length - done, COPY_CHUNK)
+            n = self._copy(src_fd, src_pos + done, dst_fd, dst_pos + done, count)
+            if n == 0:
+                break
+            if self.dontneed:
+                fadvise(src_fd, src_pos + done, n, FADV_DONTNEED)
+            done += n
+            if progress is not None:
+                progress.update(bytes_in=n, bytes_out=n)
+        return done
+
+    def _reflink(self, src_fd, src_pos, dst_fd, dst_pos, length):
+        """
+        Clone the block aligned part of the range, return its length
+        """
+        if not self.use_reflink or src_pos % REFLINK_ALIGN or dst_pos % REFLINK_ALIGN:
+            return 0
+        count = length - length % REFLINK_ALIGN
+        if count <= 0:
+            return 0
+        try:
+            reflink(src_fd, src_pos, dst_fd, dst_pos, count)
+        except (OSError, IOError) as e:
+            # EINVAL is an unsuitable range this time, anything else means
+            # this pair of files (filesystem) can't share blocks at all
+            if e.errno != errno.EINVAL:
+                self.use_reflink = False
+            return 0
+        except ImportError:
+            self.use_reflink = False
+            return 0
+        return count
+
+    def _copy(self, src_fd, src_pos, dst_fd, dst_pos, count):
+        if self.use_copy_file_range:
+            try:
+                return os.copy_file_range(src_fd, dst_fd, count, src_pos, dst_pos)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                self.use_copy_file_range = False
+
+        if self.use_sendfile:
+            try:
+                os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, src_pos, count)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.use_sendfile = False
+
+        if self.buffer is None:
+            self.buffer = bytearray(COPY_CHUNK)
+        view = memoryview(self.buffer)[:count]
+        # Positional reads leave the offset of a shared descriptor alone
+        n = preadinto(src_fd, view, src_pos)
+        pwrite_all(dst_fd, view[:n], dst_pos)
+        return n
+
+def copy_range(src_fd, src_pos, dst_fd, dst_pos, length, progress=None, dontneed=False):
+    """
+    One off RangeCopier.copy()
+    """
+    return RangeCopier(dontneed).copy(src_fd, src_pos, dst_fd, dst_pos, length, progress)
@@ -5,15 +5,20 @@ from __future__ import absolute_import
 from __future__ import print_function
 from builtins import input
 
+import os
 import re
+import sys
 import cgi
 import json
-import math
-import clint
 import argparse
 import humanize
 import requests
 
+# shared helpers live one level up, in "utils"
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from progress import tracker, add_argument as add_progress_argument
+
 mirror_url = r"https://androidfilehost.com/libs/otf/mirrors.otf.php"
 url_matchers = [
     re.compile(r"fid=(?P<id>\d+)")
@@ -23,14 +28,13 @@ class Mirror:
     def __init__(self, **entries):
         self.__dict__.update(entries)
 
-def download_file(url, fname, fsize):
+def download_file(url, fname, fsize, progress='bar'):
     dat = requests.get(url, stream=True)
-    with open(fname, 'wb') as f:
-        bar = clint.textui.progress.bar(dat.iter_content(chunk_size=4096),
-                                        expected_size=math.floor(fsize / 4096) + 1)
-        for chunk in bar:
+    with open(fname, 'wb') as f, tracker(progress, fname, total=fsize, items_total=1) as report:
+        for chunk in dat.iter_content(chunk_size=4096):
             f.write(chunk)
-            f.flush()
+            report.update(bytes_in=len(chunk), bytes_out=len(chunk))
+        report.update(items=1)
 
 def get_file_info(url):
     data = requests.head(url)
@@ -78,7 +82,7 @@ def match_url(url):
             return res
     return None
 
-def main(link=None):
+def main(link=None, progress='bar'):
     given_url = link
     if not link:
         given_url = input("Provide an AndroidFileHost URL: ")
@@ -102,7 +106,7 @@ def main(link=None):
         print("Downloading from {}...".format(server.name))
         rsize, size, fname = get_file_info(server.url)
         print("Size: {} | Filename: {}".format(size, fname))
-        download_file(server.url, fname, rsize)
+        download_file(server.url, fname, rsize, progress)
         print("Downloading complete!")
     else:
         print("This does not appear to be a supported link.")
@@ -113,11 +117,12 @@ def entry_main():
                         help="Run afh-dl in interactive mode.")
     parser.add_argument("-l", "--link", action="store", nargs="?", type=str, default=None,
                         help="Link that should be downloaded.")
+    add_progress_argument(parser, default='bar')
     parsed = parser.parse_args()
     if parsed.interactive == True:
-        main()
+        main(progress=parsed.progress)
     elif not parsed.link == None:
-        main(parsed.link)
+        main(parsed.link, parsed.progress)
     else:
         print("A link must be specified if not in interactive mode.")
 
@@ -25,6 +25,56 @@ from struct import Struct
 from collections import OrderedDict
 
 
+class DZRecord(object):
+	"""
+	One header decoded by a DZStruct layout.  The fields are read as
+	attributes, or as rec['field'] like the dicts used before; fields
+	which may be collapsed have their trailing \x00 's stripped when they
+	are read, not when the header is decoded.  "buffer" is the raw header.
+	"""
+
+	__slots__ = ('values', 'buffer')
+
+	# Field names in layout order, filled in for each layout
+	_dz_fields = ()
+
+	def __init__(self, values, buffer):
+		self.values = values
+		self.buffer = buffer
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __contains__(self, key):
+		return key == 'buffer' or key in self._dz_fields
+
+	def keys(self):
+		return self._dz_fields
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+
+def _dz_field(index, collapse):
+	"""
+	Property reading field index of a DZRecord
+	"""
+
+	if collapse:
+		def get(self):
+			value = self.values[index]
+			return value.rstrip(b'\x00') if type(value) is bytes else value
+	else:
+		def get(self):
+			return self.values[index]
+
+	return property(get)
+
+
+
 class DZStruct(object):
 	"""
 	Common class for DZ file structures
@@ -38,30 +88,44 @@ class DZStruct(object):
 		Common initializations for all DZ structures
 		"""
 
+		# The layout is compiled once, by the first instance of classy
+		if '_dz_struct' not in classy.__dict__:
+			DZStruct._dz_compile(classy)
+
+	@staticmethod
+	def _dz_compile(classy):
+		"""
+		Generate the struct, the list of items that can be collapsed
+		(truncated) and the record type for the layout of classy
+		"""
+
+		fields = classy._dz_format_dict
 
 		# Generate the struct for .unpack()
-		try:
-			classy._dzstruct
+		struct = Struct("<" + "".join([x[0] for x in fields.values()]))
 
-		except AttributeError:
-			classy._dz_struct = Struct("<" + "".join([x[0] for x in classy._dz_format_dict.values()]))
+		# Sanity check
+		if struct.size != classy._dz_length:
+			print("[!] Internal error!  Chunk format wrong! (computed={:d}, specified={:d})".format(struct.size, classy._dz_length), file=sys.stderr)
+			sys.exit(-1)
 
-			# Sanity check
-			if self._dz_struct.size != self._dz_length:
-				print("[!] Internal error!  Chunk format wrong! (computed={:d}, specified={:d})".format(self._dz_struct.size, self._dz_length), file=sys.stderr)
-				sys.exit(-1)
+		classy._dz_collapsibles = [n for n, (y, p) in fields.items() if p]
 
-		# Generate list of items that can be collapsed (truncated)
-		try:
-			classy._dz_collapsibles
+		# Position of the magic number, if the layout has one
+		names = list(fields.keys())
+		classy._dz_header_index = names.index('header') if 'header' in fields else None
 
-		except AttributeError:
-			classy._dz_collapsibles = [n for n, (y, p) in classy._dz_format_dict.items() if p]
+		attrs = dict((n, _dz_field(i, p)) for i, (n, (y, p)) in enumerate(fields.items()))
+		attrs['__slots__'] = ()
+		attrs['_dz_fields'] = tuple(names)
+		classy._dz_record = type(classy.__name__ + "Record", (DZRecord,), attrs)
+
+		classy._dz_struct = struct
 
 
 	def packdict(self, din):
 		"""
-		Pack all the fields from the dict into a returned buffer
+		Pack all the fields from the dict (or record) into a returned buffer
 		"""
 
 		dout = dict()
@@ -76,7 +140,8 @@ class DZStruct(object):
 			else:
 				dout[k] = din[k]
 
-		dout['header'] = self._dz_header
+		if self._dz_header_index is not None:
+			dout['header'] = self._dz_header
 
 		values = [dout[k] for k in self._dz_format_dict.keys()]
 		buffer = self._dz_struct.pack(*values)
@@ -84,21 +149,22 @@ class DZStruct(object):
 		return buffer
 
 
-	def unpackdict(self, buffer):
+	def unpackdict(self, buffer, offset=0):
 		"""
-		Unpack data in buffer into a returned dictionary, return None
-		if magic number/header is absent
+		Unpack the header at offset of buffer (bytes, memoryview or mmap)
+		into a returned record, return None if magic number/header is
+		absent
 		"""
 
-		d = dict(zip(
-			self._dz_format_dict.keys(),
-			self._dz_struct.unpack(buffer)
-		))
+		values = self._dz_struct.unpack_from(buffer, offset)
 
-		if d['header'] != self._dz_header:
+		if self._dz_header_index is not None and values[self._dz_header_index] != self._dz_header:
 			return None
 
-		return d
+		if offset or type(buffer) is not bytes:
+			buffer = bytes(buffer[offset:offset + self._dz_struct.size])
+
+		return self._dz_record(values, buffer)
 
 
 
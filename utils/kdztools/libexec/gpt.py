@@ -22,6 +22,7 @@ from __future__ import print_function
 import os
 import sys
 import io
+import mmap
 from collections import OrderedDict
 from struct import Struct
 from uuid import UUID
@@ -38,6 +39,16 @@ class NoGPT(Exception):
 		return self.errmsg
 
 
+class GPTTruncated(NoGPT):
+	"""
+	The buffer ends before the slice entry table, needed is the length
+	it would take
+	"""
+	def __init__(self, needed):
+		super(GPTTruncated, self).__init__("Error: slice entry table truncated ({:d} bytes needed)".format(needed))
+		self.needed = needed
+
+
 class GPTSlice(object):
 	"""
 	Class for handling invidual slices^Wpartitions of a GUID table
@@ -62,34 +73,52 @@ class GPTSlice(object):
 	# Generate the formatstring for struct.unpack()
 	_gpt_struct = Struct("<" + "".join([x for x in _gpt_slice_fmt.values()]))
 
+	# Type of an unused entry
+	_gpt_empty = bytes(16)
+
+	# The raw fields are kept, UUIDs and name are only made when used
+	__slots__ = ('rawType', 'rawUuid', 'startLBA', 'endLBA', 'flags', 'rawName')
+
+	@property
+	def type(self):
+		return UUID(bytes=self.rawType)
+
+	@property
+	def uuid(self):
+		return UUID(bytes=self.rawUuid)
+
+	@property
+	def name(self):
+		return self.rawName.decode("utf16").rstrip('\x00')
+
+	def isEmpty(self):
+		"""
+		Whether this is an unused entry (all zero type)
+		"""
+		return self.rawType == self._gpt_empty
+
 	def display(self, idx):
 		"""
 		Display the data for this slice of a GPT
 		"""
 
-		if self.type == UUID(int=0):
+		if self.isEmpty():
 			verbose("Name: <empty entry>")
 			return None
 
 		verbose("Name({:d}): \"{:s}\" start={:d} end={:d} count={:d}".format(idx, self.name, self.startLBA, self.endLBA, self.endLBA-self.startLBA+1))
 		verbose("typ={:s} id={:s}".format(str(self.type), str(self.uuid)))
 
-	def __init__(self, buf):
+	def __init__(self, buf, values=None):
 		"""
-		Initialize the GPTSlice class
+		Initialize the GPTSlice class from an entry in buf, or from the
+		values already unpacked from one
 		"""
 
-		data = dict(zip(
-			self._gpt_slice_fmt.keys(),
-			self._gpt_struct.unpack(buf)
-		))
+		if values is None:
+			values = self._gpt_struct.unpack_from(buf)
 
-		self.type = UUID(bytes=data['type'])
-		self.uuid = UUID(bytes=data['uuid'])
-		self.startLBA = data['startLBA']
-		self.endLBA = data['endLBA']
-		self.flags = data['flags']
-		self.name = data['name'].decode("utf16").rstrip('\x00')
+		self.rawType, self.rawUuid, self.startLBA, self.endLBA, self.flags, self.rawName = values
 
 
 
@@ -158,7 +187,7 @@ class GPT(object):
 		current = self.dataStartLBA
 		idx = 1
 		for slice in self.slices:
-			if slice.type != UUID(int=0):
+			if not slice.isEmpty():
 				if slice.startLBA != current:
 					verbose("Note: non-contiguous ({:d} unused)".format(slice.startLBA-current))
 				current = slice.endLBA + 1
@@ -179,7 +208,7 @@ class GPT(object):
 
 		data = dict(zip(
 			self._gpt_head_fmt.keys(),
-			self._gpt_struct.unpack(buf[0:self._gpt_size])
+			self._gpt_struct.unpack_from(buf)
 		))
 
 		if data['header'] != self._gpt_header:
@@ -282,29 +311,35 @@ class GPT(object):
 		if self.entrySize & (self.entrySize-1):
 			raise NoGPT("Error: entry size is not a power of 2")
 
+		# an entry may be longer than what we know of, not shorter
+		if self.entrySize < GPTSlice._gpt_struct.size:
+			raise NoGPT("Error: entry size {:d} is too small".format(self.entrySize))
+
+		# the backup table is just before the backup header, at the end
 		if self.myLBA == 1:
 			sliceAddr = self.entryStart<<self.shiftLBA
 		else:
-			sliceAddr = (self.entryStart-self.myLBA-1)<<self.shiftLBA
+			sliceAddr = len(buf) + ((self.entryStart-self.myLBA-1)<<self.shiftLBA)
 
-		self.slices = []
-		crc = 0
-		for i in range(self.entryCount):
-			sbuf = buf[sliceAddr:sliceAddr+self.entrySize]
-			crc = crc32(sbuf, crc)
-			slice = GPTSlice(sbuf)
-			self.slices.append(slice)
+		tableLength = self.entrySize * self.entryCount
+		if sliceAddr < 0 or sliceAddr + tableLength > len(buf):
+			raise GPTTruncated(sliceAddr + tableLength)
 
-			sliceAddr+=self.entrySize
+		# Decode the whole table in one go
+		table = buf[sliceAddr:sliceAddr+tableLength]
 
-		crc &= 0xFFFFFFFF
-
-		if crc != self.entryCrc32:
+		if crc32(table) & 0xFFFFFFFF != self.entryCrc32:
 			raise NoGPT("Error: bad slice entry CRC")
 
+		if self.entrySize == GPTSlice._gpt_struct.size:
+			entries = GPTSlice._gpt_struct.iter_unpack(table)
+		else:
+			entries = (GPTSlice._gpt_struct.unpack_from(table, offset) for offset in range(0, tableLength, self.entrySize))
+		self.slices = [GPTSlice(None, values) for values in entries]
+
 		last = 0
 		for slice in self.slices:
-			if slice.type == UUID(int=0):
+			if slice.isEmpty():
 				continue
 			if slice.startLBA <= last:
 				verbose("Note: slices are out of order in GPT")
@@ -316,6 +351,41 @@ class GPT(object):
 
 
 
+def probe(file, lbaMinShift=9, lbaMaxShift=16):
+	"""
+	Find the GPT of a disk (image) file: the file is mapped, so only the
+	header and entry blocks tried are read from it; a stream is read up
+	to the end of the entry table
+	"""
+
+	try:
+		buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+	except (ValueError, OSError, io.UnsupportedOperation, mmap.error):
+		buf = None
+
+	if buf is not None:
+		try:
+			return GPT(buf, lbaMinShift=lbaMinShift, lbaMaxShift=lbaMaxShift)
+		finally:
+			buf.close()
+
+	# header is always in second LBA, slice entries usually in third;
+	# a bigger table is read once the header says how big
+	buf = file.read((1<<17)+(1<<16))
+	while True:
+		try:
+			return GPT(buf, lbaMinShift=lbaMinShift, lbaMaxShift=lbaMaxShift)
+		except GPTTruncated as err:
+			# more data won't help a table wanted before the end of buf
+			if err.needed <= len(buf):
+				raise
+			more = file.read(err.needed - len(buf))
+			if not more:
+				raise
+			buf += more
+
+
+
 if __name__ == "__main__":
 	verbose = lambda msg: print(msg)
 
@@ -324,17 +394,12 @@ if __name__ == "__main__":
 
 	for arg in sys.argv:
 		if arg == "-":
-			file = sys.stdin
+			file = getattr(sys.stdin, "buffer", sys.stdin)
 		else:
 			file = io.FileIO(arg, "rb")
 
-		# header is always in second LBA, slice entries in third
-		# if you run out of slice entries with a 64KB LBA, oy vey!
-		buf = file.read(1<<17+1<<16)
-
 		try:
-			gpt = GPT(buf)
+			gpt = probe(file)
 			gpt.display()
-		except NoGPT:
-			print(NoGPT, file=sys.stderr)
-
+		except NoGPT as err:
+			print(err, file=sys.stderr)
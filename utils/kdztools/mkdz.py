@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+
+"""
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import io
+import zlib
+import hashlib
+import argparse
+from binascii import crc32, a2b_hex
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import zstandard as zstd
+except ImportError:
+	zstd = None
+
+# our tools are in "libexec"
+sys.path.append(os.path.join(sys.path[0], "libexec"))
+
+import dz
+import kdz
+
+# shared helpers live one level up, in "utils"
+sys.path.append(os.path.dirname(sys.path[0]))
+
+import blockio
+import sparseimg
+from progress import tracker, add_argument as add_progress_argument
+
+# Most uncompressed data put in one chunk
+CHUNK_MAX = 32 << 20
+
+# A run of zeros at least this long ends a chunk, it is left to the wipe
+# (trimCount) of the chunk before it instead of being compressed
+ZERO_GAP = 1 << 20
+
+# Granularity of the zero detection
+SCAN_BLOCK = 4096
+
+# The KDZ magic for each version in .kdz.params, see unkdz
+KDZ_MAGIC = {
+	0: b"\x28\x05\x00\x00"b"\x34\x31\x25\x80",
+	1: b"\x18\x05\x00\x00"b"\x32\x79\x44\x50",
+	2: kdz.KDZFile._dz_header,
+}
+
+
+def readParams(name):
+	"""
+	Read a .params file written by undz/unkdz into a dict of strings
+	"""
+
+	params = {}
+	with open(name, "rt") as file:
+		for line in file:
+			line = line.strip()
+			if not line or line.startswith("#") or "=" not in line:
+				continue
+			key, value = line.split("=", 1)
+			params[key] = value
+	return params
+
+
+def readFull(fd, length, offset):
+	"""
+	Read exactly length bytes from offset of fd, less only at end of file
+	"""
+
+	buf = bytearray(length)
+	view = memoryview(buf)
+	done = 0
+	while done < length:
+		n = blockio.preadinto(fd, view[done:], offset + done)
+		if n == 0:
+			del buf[done:]
+			break
+		done += n
+	return buf
+
+
+
+class MKDZSlice(object):
+	"""
+	A slice image extracted by undz -s, with its .params
+	"""
+
+	def __init__(self, name, params):
+		self.name = name
+		self.sliceName = os.path.basename(name)[:-len(".image")]
+		self.start = int(params['startAddr'])
+		self.end = int(params['endAddr'])
+		self.phantom = 'lastWipe' not in params
+		self.lastWipe = int(params.get('lastWipe', 0))
+		self.dev = int(params.get('dev', 0))
+		self.size = os.path.getsize(name)
+
+	def scanExtents(self, fd, blockSize):
+		"""
+		Return the [start, end) ranges of the image to put in chunks:
+		its data, split at long runs of zeros and at CHUNK_MAX.  The
+		first chunk starts at the beginning of the slice, so that its
+		wipe covers all of it.
+		"""
+
+		# undz reads the partition table from the very first chunk
+		if self.start == 0:
+			return [(0, self.size)]
+
+		scan = max(SCAN_BLOCK, blockSize)
+		extents = []
+		start = None
+		end = 0
+
+		pos = 0
+		while pos < self.size:
+			buf = readFull(fd, min(blockio.COPY_CHUNK, self.size - pos), pos)
+			if not buf:
+				break
+			whole = len(buf) - len(buf) % scan
+			runs = list(sparseimg.zero_runs(buf if whole == len(buf) else buf[:whole], scan))
+			if whole < len(buf):
+				runs.append((whole // scan, 1, buf[whole:].count(0) == len(buf) - whole))
+			for first, count, is_zero in runs:
+				lo = pos + first * scan
+				hi = min(pos + (first + count) * scan, self.size)
+				if not is_zero:
+					if start is None:
+						start = lo
+					end = hi
+				elif start is not None and hi - end >= ZERO_GAP:
+					extents.append([start, end])
+					start = None
+			pos += len(buf)
+
+		# Short runs of zeros are only left out between chunks, not at
+		# the end
+		if start is not None:
+			if self.size - end < ZERO_GAP:
+				end = self.size
+			extents.append([start, end])
+
+		# Nothing but zeros still needs its wipe
+		if not extents:
+			extents.append([0, 0])
+		extents[0][0] = 0
+
+		split = []
+		for start, end in extents:
+			while end - start > CHUNK_MAX:
+				split.append((start, start + CHUNK_MAX))
+				start += CHUNK_MAX
+			split.append((start, end))
+
+		return split
+
+
+
+class MKDZFile(dz.DZFile):
+	"""
+	Writer of a LGE DZ file from undz output
+	"""
+
+	def __init__(self, indir, codec=None, level=None, jobs=1):
+		"""
+		Load .dz.params and the slices from indir
+		"""
+
+		super(MKDZFile, self).__init__()
+
+		self.indir = indir
+		self.params = readParams(os.path.join(indir, ".dz.params"))
+		self.shiftLBA = int(self.params.get('blockShift', 9))
+		self.blockSize = 1 << self.shiftLBA
+
+		self.codec = codec or self.params.get('compression', 'zlib')
+		if self.codec == 'zstd' and zstd is None:
+			print("[!] Error: zstd compression needs the zstandard module", file=sys.stderr)
+			sys.exit(1)
+		self.level = level
+		self.jobs = jobs
+
+		self.slices = []
+		for name in sorted(os.listdir(indir)):
+			if not name.endswith(".image"):
+				continue
+			path = os.path.join(indir, name)
+			if not os.path.exists(path + ".params"):
+				print("[!] Warning: {:s} has no .params, skipped".format(name), file=sys.stderr)
+				continue
+			slice = MKDZSlice(path, readParams(path + ".params"))
+			if not slice.phantom:
+				self.slices.append(slice)
+
+		# Chunks are written per device, in block order
+		self.slices.sort(key=lambda s: (s.dev, s.start))
+
+	def planChunks(self):
+		"""
+		Return the chunks to write as (slice, offset in image, length,
+		targetAddr, trimCount) tuples
+		"""
+
+		plan = []
+		for slice in self.slices:
+			with io.FileIO(slice.name, "rb") as file:
+				extents = slice.scanExtents(file.fileno(), self.blockSize)
+
+			for i, (start, end) in enumerate(extents):
+				targetAddr = (slice.start + start) >> self.shiftLBA
+				if i + 1 < len(extents):
+					nextAddr = (slice.start + extents[i + 1][0]) >> self.shiftLBA
+				else:
+					nextAddr = slice.lastWipe
+				plan.append((slice, start, end - start, targetAddr, max(nextAddr - targetAddr, 0)))
+
+		return plan
+
+	def compress(self, data):
+		"""
+		Compress one chunk's data with our codec
+		"""
+
+		if self.codec == 'zstd':
+			level = self.level if self.level is not None else 3
+			return zstd.ZstdCompressor(level=level).compress(data)
+
+		# undz tells zlib chunks by the \x78\x01 header of level 0/1
+		return zlib.compress(data, 1 if self.level is None else min(self.level, 1))
+
+	def buildChunk(self, job):
+		"""
+		Read, hash and compress one planned chunk (run in a worker
+		thread, hashing and compression don't hold the GIL)
+		"""
+
+		slice, offset, length, targetAddr, trimCount = job
+
+		with io.FileIO(slice.name, "rb") as file:
+			data = readFull(file.fileno(), length, offset)
+
+		# A short image is padded, like undz would read it back
+		if len(data) < length:
+			data += bytes(length - len(data))
+
+		return {
+			'sliceName':	slice.sliceName.encode("utf8"),
+			'chunkName':	"{:s}_{:d}.bin".format(slice.sliceName, targetAddr).encode("utf8"),
+			'targetSize':	length,
+			'md5':		hashlib.md5(data).digest(),
+			'crc32':	crc32(data) & 0xFFFFFFFF,
+			'targetAddr':	targetAddr,
+			'trimCount':	trimCount,
+			'dev':		slice.dev,
+		}, self.compress(data)
+
+	def write(self, name, progress):
+		"""
+		Write the DZ file to name
+		"""
+
+		plan = self.planChunks()
+		progress.total = sum(job[2] for job in plan)
+		progress.items_total = len(plan)
+
+		chunk = dz.DZChunk()
+		md5Headers = hashlib.md5()
+
+		with io.FileIO(name, "wb") as out, ThreadPoolExecutor(max_workers=self.jobs) as pool:
+			# The file header goes in last, once the chunks are known
+			out.write(bytes(self._dz_length))
+
+			# Chunks are compressed out of order but written in order,
+			# with a bounded number of them in memory
+			pending = deque()
+			jobs = iter(plan)
+			while True:
+				while len(pending) < self.jobs * 2:
+					job = next(jobs, None)
+					if job is None:
+						break
+					pending.append(pool.submit(self.buildChunk, job))
+				if not pending:
+					break
+
+				fields, data = pending.popleft().result()
+				fields['dataSize'] = len(data)
+				header = chunk.packdict(fields)
+				md5Headers.update(header)
+				out.write(header)
+				out.write(data)
+
+				print("[+] Compressed {:s} ({:d} to {:d} bytes)".format(fields['chunkName'].decode("utf8"), fields['targetSize'], len(data)))
+				progress.update(bytes_in=fields['targetSize'], bytes_out=len(data) + len(header), items=1)
+
+			out.seek(0, io.SEEK_SET)
+			out.write(self.packHeader(len(plan), md5Headers.digest()))
+
+		return len(plan)
+
+	def packHeader(self, chunkCount, md5):
+		"""
+		Pack the file header from .dz.params
+		"""
+
+		p = self.params
+		return self.packdict({
+			'formatMajor':	int(p.get('format_major', 2)),
+			'formatMinor':	int(p.get('format_minor', 1)),
+			'device':	p.get('device', '').encode("utf8"),
+			'version':	p.get('factoryversion', '').encode("utf8"),
+			'chunkCount':	chunkCount,
+			'md5':		md5,
+			'unknown0':	int(p.get('unknown0', 0)),
+			'unknown1':	a2b_hex(p.get('unknown1', '')),
+			'unknown2':	p.get('unknown2', '').encode("utf8"),
+			'buildType':	p.get('build_type', '').encode("utf8"),
+			'unknown3':	a2b_hex(p.get('unknown3', '')),
+			'androidVer':	p.get('android_version', '').encode("utf8"),
+			'oldDateCode':	p.get('old_date_code', '').encode("utf8"),
+			'reserved5':	0,
+			'unknown4':	int(p.get('unknown4', 0)),
+			'unknown5':	int(p.get('unknown5', 0)),
+		})
+
+
+
+class MKKDZFile(kdz.KDZFile):
+	"""
+	Writer of a LGE KDZ file from unkdz output
+	"""
+
+	def __init__(self, indir):
+		"""
+		Load .kdz.params from indir
+		"""
+
+		super(MKKDZFile, self).__init__()
+
+		self.indir = indir
+		self.params = readParams(os.path.join(indir, ".kdz.params"))
+
+		version = int(self.params.get('version', 2))
+		if version not in KDZ_MAGIC:
+			print("[!] Error: unknown KDZ version {:d}".format(version), file=sys.stderr)
+			sys.exit(1)
+		self.magic = KDZ_MAGIC[version]
+
+		# Payloads are listed in data order, with their header position
+		self.payloads = []
+		i = 0
+		while "payload{:d}".format(i) in self.params:
+			self.payloads.append((self.params["payload{:d}".format(i)], int(self.params["payload{:d}head".format(i)])))
+			i += 1
+
+	def write(self, name, dzName, progress):
+		"""
+		Write the KDZ file to name, the DZ payload taken from dzName and
+		the others from indir
+		"""
+
+		paths = {}
+		for payload, head in self.payloads:
+			if payload.lower().endswith(".dz"):
+				paths[payload] = dzName
+			else:
+				paths[payload] = os.path.join(self.indir, payload)
+
+		extra = os.path.join(self.indir, "kdz_extras.bin")
+		extraSize = os.path.getsize(extra) if os.path.exists(extra) else 0
+
+		# Headers, the terminating \x00 and any extra data come first
+		headerEnd = len(self.magic) + len(self.payloads) * self._dz_length + 1
+		dataStart = max(int(self.params.get('dataStart', 0)), headerEnd + extraSize + 1)
+
+		offsets = {}
+		offset = dataStart
+		for payload, head in self.payloads:
+			offsets[payload] = offset
+			offset += os.path.getsize(paths[payload])
+
+		progress.total = offset - dataStart
+		progress.items_total = len(self.payloads)
+
+		with io.FileIO(name, "wb") as out:
+			out.write(self.magic)
+			for payload, head in sorted(self.payloads, key=lambda p: p[1]):
+				out.write(self.packdict({
+					'name':		payload.encode("utf8"),
+					'length':	os.path.getsize(paths[payload]),
+					'offset':	offsets[payload],
+				}))
+			out.write(b"\x00")
+
+			if extraSize:
+				with io.FileIO(extra, "rb") as file:
+					blockio.copy_range(file.fileno(), 0, out.fileno(), headerEnd, extraSize)
+			out.truncate(dataStart)
+
+			for payload, head in self.payloads:
+				print("[+] Adding {:s}".format(payload))
+				with io.FileIO(paths[payload], "rb") as file:
+					blockio.copy_range(file.fileno(), 0, out.fileno(), offsets[payload], os.path.getsize(paths[payload]), progress)
+				progress.update(items=1)
+
+
+
+class MKDZTools:
+	"""
+	LGE DZ (and KDZ) file writer
+	"""
+
+	def parseArgs(self):
+		# Parse arguments
+		parser = argparse.ArgumentParser(description='LG DZ/KDZ File Writer, from the output of undz -s and unkdz -x')
+		parser.add_argument('-d', '--dir', help='undz output to pack: .dz.params and the slice images with their .params (default: dzextracted)', action='store', default='dzextracted', dest='indir')
+		parser.add_argument('-o', '--out', help='DZ file to write', action='store', required=True, dest='dzfile')
+		parser.add_argument('-c', '--compression', help='chunk compression (default: as recorded in .dz.params, else zlib)', choices=('zlib', 'zstd'), action='store', dest='codec')
+		parser.add_argument('--level', help='compression level (zlib chunks are always level 1 at most)', action='store', type=int, dest='level')
+		parser.add_argument('-j', '--jobs', help='number of chunks compressed at once (default: CPU count)', action='store', type=int, dest='jobs')
+		parser.add_argument('--kdz-dir', help='unkdz output holding .kdz.params and the other payloads, to also write a KDZ', action='store', dest='kdzdir')
+		parser.add_argument('--kdz', help='KDZ file to write, with the DZ in place of the original one', action='store', dest='kdzfile')
+		add_progress_argument(parser)
+
+		return parser.parse_args()
+
+	def main(self):
+		args = self.parseArgs()
+
+		if bool(args.kdzdir) != bool(args.kdzfile):
+			print("[!] Error: --kdz-dir and --kdz go together", file=sys.stderr)
+			sys.exit(1)
+
+		dz_file = MKDZFile(args.indir, args.codec, args.level, args.jobs or os.cpu_count() or 1)
+		print("[+] Writing {:s} from {:d} slices ({:s})\n".format(args.dzfile, len(dz_file.slices), dz_file.codec))
+
+		progress = tracker(args.progress, os.path.basename(args.dzfile))
+		count = dz_file.write(args.dzfile, progress)
+		progress.finish()
+		print("[+] Wrote {:d} chunks".format(count))
+
+		if args.kdzfile:
+			kdz_file = MKKDZFile(args.kdzdir)
+			progress = tracker(args.progress, os.path.basename(args.kdzfile))
+			kdz_file.write(args.kdzfile, args.dzfile, progress)
+			progress.finish()
+
+if __name__ == "__main__":
+	mkdz = MKDZTools()
+	mkdz.main()
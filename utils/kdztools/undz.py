@@ -23,18 +23,252 @@ from __future__ import print_function
 import os
 import sys
 import io
+import json
+import mmap
+import tempfile
 import zlib
 import zstandard as zstd
 import argparse
+import fnmatch
 import hashlib
-from binascii import crc32, b2a_hex
-from uuid import UUID
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from binascii import crc32, a2b_hex, b2a_hex
 
 # our tools are in "libexec"
 sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import dz
 import gpt
+import unkdz
+
+# shared helpers live one level up, in "utils"
+sys.path.append(os.path.dirname(sys.path[0]))
+
+import blockio
+import sparseimg
+from progress import Progress, tracker, add_argument as add_progress_argument
+
+# Most compressed data read, or decompressed data held, at once per chunk
+STREAM_CHUNK = 1 << 20
+
+# Granularity of zero detection for holes and sparse images
+SPARSE_BLOCK = 4096
+
+# Default memory budget for decompressed chunks kept around
+CHUNK_CACHE = 64 << 20
+
+# Default disk budget of the chunk store
+CHUNK_STORE = 4096 << 20
+
+# Chunk table, slice map and GPT layout saved next to the DZ (or KDZ)
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.json'
+
+
+class ChunkCache(object):
+        """
+        Decompressed (and MD5 checked) chunk payloads keyed by the offset of
+        their data in the DZ file, the least recently used are dropped once
+        they add up to more than limit bytes
+        """
+
+        def __init__(self, limit=CHUNK_CACHE):
+                self.limit = limit
+                self.buffers = OrderedDict()
+                self.bytes = 0
+                self.peakBytes = 0
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+                # Chunks may be extracted from several threads
+                self.lock = threading.Lock()
+
+        def get(self, key):
+                """
+                Return the payload cached for key, or None
+                """
+                with self.lock:
+                        buf = self.buffers.get(key)
+                        if buf is None:
+                                self.misses += 1
+                        else:
+                                self.hits += 1
+                                self.buffers.move_to_end(key)
+                        return buf
+
+        def put(self, key, buf):
+                """
+                Cache buf for key, unless it alone is over the budget
+                """
+                if len(buf) > self.limit:
+                        return
+                with self.lock:
+                        if key in self.buffers:
+                                self.bytes -= len(self.buffers.pop(key))
+                        self.buffers[key] = buf
+                        self.bytes += len(buf)
+                        self._evict()
+                        self.peakBytes = max(self.peakBytes, self.bytes)
+
+        def resize(self, limit):
+                """
+                Change the budget, dropping what no longer fits
+                """
+                with self.lock:
+                        self.limit = limit
+                        self._evict()
+
+        def _evict(self):
+                while self.bytes > self.limit:
+                        self.bytes -= len(self.buffers.popitem(last=False)[1])
+                        self.evictions += 1
+
+        def stats(self):
+                return {
+                        'hits': self.hits,
+                        'misses': self.misses,
+                        'evictions': self.evictions,
+                        'bytes': self.bytes,
+                        'peakBytes': self.peakBytes,
+                        'limit': self.limit,
+                }
+
+
+
+class ChunkStore(object):
+        """
+        Decompressed chunk payloads kept on disk across runs (and firmware
+        versions) under path, named by the MD5 from their chunk header.
+        Payloads are stored with holes for all-zero pieces; once they take
+        more than limit bytes of disk the least recently used are removed.
+        The modification time of a payload records its last use.
+        """
+
+        def __init__(self, path, limit=CHUNK_STORE):
+                # Extraction changes to the output directory
+                self.path = os.path.abspath(path)
+                self.limit = limit
+                self.entries = OrderedDict()
+                self.bytes = 0
+                self.hits = 0
+                self.misses = 0
+                self.stored = 0
+                self.evictions = 0
+                self.lock = threading.Lock()
+
+                if not os.path.exists(self.path):
+                        os.makedirs(self.path)
+
+                # Oldest first, temporary files start with a dot
+                found = []
+                for sub in os.scandir(self.path):
+                        if sub.name.startswith('.') or not sub.is_dir():
+                                continue
+                        for entry in os.scandir(sub.path):
+                                if not entry.name.startswith('.'):
+                                        st = entry.stat()
+                                        found.append((st.st_mtime, entry.name, st.st_blocks << 9))
+                for mtime, name, size in sorted(found):
+                        self.entries[name] = size
+                        self.bytes += size
+
+                # The limit may have been lowered since the last run
+                self._evict()
+
+        def entryPath(self, name):
+                return os.path.join(self.path, name[:2], name)
+
+        def lookup(self, md5, size):
+                """
+                Return the path of the payload with md5 and size bytes, or None
+                """
+                name = b2a_hex(md5).decode()
+                path = self.entryPath(name)
+                with self.lock:
+                        if name not in self.entries:
+                                return None
+                        try:
+                                if os.stat(path).st_size != size:
+                                        return None
+                                os.utime(path)
+                        except OSError:
+                                # Removed by another run sharing the store
+                                self.bytes -= self.entries.pop(name)
+                                return None
+                        self.entries.move_to_end(name)
+                        self.hits += 1
+                return path
+
+        def fill(self, md5, pieces):
+                """
+                Pass pieces through, storing them as the payload with md5
+                once they have all gone by (and been checked by the
+                decompressor); an interrupted payload isn't kept
+                """
+
+                with self.lock:
+                        self.misses += 1
+                fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+                done = False
+                try:
+                        offset = 0
+                        for buf in pieces:
+                                if buf.count(0) != len(buf):
+                                        blockio.pwrite_all(fd, buf, offset)
+                                yield buf
+                                offset += len(buf)
+                        os.ftruncate(fd, offset)
+                        done = True
+                finally:
+                        os.close(fd)
+                        if done:
+                                self.commit(tmp, b2a_hex(md5).decode())
+                        else:
+                                os.unlink(tmp)
+
+        def commit(self, tmp, name):
+                """
+                Move the finished payload tmp into place as name
+                """
+
+                size = os.stat(tmp).st_blocks << 9
+                if size > self.limit:
+                        os.unlink(tmp)
+                        return
+                path = self.entryPath(name)
+                if not os.path.exists(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+
+                with self.lock:
+                        if name in self.entries:
+                                self.bytes -= self.entries.pop(name)
+                        self.entries[name] = size
+                        self.bytes += size
+                        self.stored += 1
+                        self._evict()
+
+        def _evict(self):
+                while self.bytes > self.limit:
+                        name, size = self.entries.popitem(last=False)
+                        self.bytes -= size
+                        self.evictions += 1
+                        try:
+                                os.unlink(self.entryPath(name))
+                        except OSError:
+                                pass
+
+        def stats(self):
+                return {
+                        'hits': self.hits,
+                        'misses': self.misses,
+                        'stored': self.stored,
+                        'evictions': self.evictions,
+                        'bytes': self.bytes,
+                        'limit': self.limit,
+                }
 
 
 class UNDZUtils(object):
@@ -46,18 +280,18 @@ class UNDZUtils(object):
         def loadHeader(self, file):
                 """
                 Loads a structured header, does common processing and returns
-                dictionary with data (buffer stored as "buffer")
+                record with data (buffer stored as "buffer")
                 """
 
-                # Read the header structure
-                buffer = file.read(self._dz_length)
+                return self.unpackHeader(file.read(self._dz_length))
 
+        def unpackHeader(self, buffer, offset=0):
+                """
+                Same as loadHeader(), for a header at offset of buffer
+                """
 
-                # "Make the item"
-                # Create a new dict using the keys from the format string
-                # and the format string itself
-                # and apply the format to the buffer
-                dz_item = self.unpackdict(buffer)
+                # "Make the item", a record of the fields in the buffer
+                dz_item = self.unpackdict(buffer, offset)
 
 
                 # Verify DZ area header
@@ -66,27 +300,24 @@ class UNDZUtils(object):
                         sys.exit(1)
 
 
-                # some paths want to take a look at the raw data
-                dz_item['buffer'] = buffer
-
-
-                # Collapse (truncate) each key's value if it's listed as collapsible
+                # Check each key's value if it's listed as collapsible, the
+                # record only collapses (truncates) them when they're read
                 for key in self._dz_collapsibles:
-                        if type(dz_item[key]) is str or type(dz_item[key]) is bytes:
-                                dz_item[key] = dz_item[key].rstrip(b'\x00')
-                                if b'\x00' in dz_item[key]:
+                        value = dz_item[key]
+                        if type(value) is bytes:
+                                if b'\x00' in value:
                                         print("[!] Warning: extraneous data found IN "+key, file=sys.stderr)
                                         #sys.exit(1)
-                        elif type(dz_item[key]) is int:
-                                if dz_item[key] != 0:
-                                        print('[!] Error: Value supposed to be zero in field "'+key+'" is non-zero ('+hex(dz_item[key])+')', file=sys.stderr)
+                        elif type(value) is int:
+                                if value != 0:
+                                        print('[!] Error: Value supposed to be zero in field "'+key+'" is non-zero ('+hex(value)+')', file=sys.stderr)
                                         sys.exit(1)
                         else:
                                 print("[!] Error: internal error", file=sys.stderr)
                                 sys.exit(-1)
 
                 # To my knowledge this is supposed to be blank (for now...)
-                if len(dz_item['pad']) != 0:
+                if len(dz_item.pad) != 0:
                         print("[!] Warning: pad is not empty", file=sys.stderr)
 
                 return dz_item
@@ -150,6 +381,13 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
                 """
                 return (self.targetAddr << self.dz.shiftLBA) + self.targetSize
 
+        def getCodec(self):
+                """
+                Return how our payload is compressed, "zlib" or "zstd"
+                """
+                head = blockio.pread(self.dz.dzfile.fileno(), 2, self.dz.dzBase + self.dataOffset)
+                return "zlib" if head == bytes([0x78, 0x01]) else "zstd"
+
         def getNext(self):
                 """
                 Return offset of next chunk
@@ -177,19 +415,14 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
                 self.Messages()
                 return ++selfIdx
 
-        def extract(self):
+        def iterExtract(self):
                 """
-                Extracts our payload from the compressed DZ file using ZLIB.
-                self function could be particularly memory-intensive when used
-                with large chunks, as the entire compressed chunk is loaded
-                into RAM and decompressed.
-
-                A better way to do self would be to chunk the zlib compressed
-                data and decompress it with zlib.decompressor() and a while
-                loop.
-
-                I'm lazy though, and y'all have fast computers, so self is good
-                enough.
+                Decompress our payload from the DZ file, yielding it in pieces
+                of STREAM_CHUNK bytes (the last one may be shorter); memory use
+                does not depend on the size of the chunk.  The MD5 is checked once the last piece
+                has been handed out.  A payload in the DZ's chunk cache or
+                chunk store is handed out from there instead, one which is
+                decompressed goes to the chunk store.
 
                 Starting with G7 KDZs, LG switched to zstandard compression.
                 To keep comparibility with older KDZs, we are going to compare
@@ -197,58 +430,124 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
                 use zlib .. if not, we use zstandard.
                 """
 
-                # Seek to the beginning of the compressed data in the specified partition
-                self.dz.dzfile.seek(self.dataOffset, io.SEEK_SET)
+                buf = self.dz.cache.get(self.dataOffset)
+                if buf is not None:
+                        for pos in range(0, len(buf), STREAM_CHUNK):
+                                yield buf[pos:pos + STREAM_CHUNK]
+                        return
+
+                store = self.dz.store
+                if store is None:
+                        for buf in self._iterDecompress():
+                                yield buf
+                        return
+
+                path = store.lookup(self.md5, self.targetSize)
+                if path is not None:
+                        with io.FileIO(path, "rb") as file:
+                                for buf in iter(lambda: file.read(STREAM_CHUNK), b''):
+                                        yield buf
+                        return
+
+                for buf in store.fill(self.md5, self._iterDecompress()):
+                        yield buf
+
+        def _iterDecompress(self):
+                """
+                Decompress our payload, see iterExtract()
+                """
 
                 zlib_magic = {'zlib': bytes([0x78, 0x01])}
-                cmp_header = self.dz.dzfile.read(2)
 
-                # Reset to the beginning of the compressed data
-                self.dz.dzfile.seek(self.dataOffset, io.SEEK_SET)
+                # The compressed data of this chunk only
+                source = KDZWindow(self.dz.dzfile, self.dz.dzBase + self.dataOffset, self.dataSize, closefd=False)
+                cmp_header = source.read(2)
+                source.seek(0, io.SEEK_SET)
 
-                # Read the whole compressed segment into RAM
-                zdata = self.dz.dzfile.read(self.dataSize)
+                crc = 0
+                md5 = hashlib.md5()
 
                 if cmp_header.startswith(zlib_magic['zlib']):
 
-                    # Decompress the data with zlib
-                    buf = zlib.decompress(zdata)
+                    # Decompress the data with zlib, a piece at a time
+                    dobj = zlib.decompressobj()
+                    pieces = self._iterZlib(source, dobj)
 
                 else:
                     # decompress with zstandard
                     dctx = zstd.ZstdDecompressor()
-                    buf = dctx.decompress(zdata, max_output_size=200000000)
-    
-                crc = crc32(buf) & 0xFFFFFFFF
+                    reader = dctx.stream_reader(source, read_size=STREAM_CHUNK, closefd=False)
+                    pieces = iter(lambda: reader.read(STREAM_CHUNK), b'')
+
+                for buf in self._iterFixed(pieces):
+                    crc = crc32(buf, crc)
+                    md5.update(buf)
+                    yield buf
+
+                crc &= 0xFFFFFFFF
 
                 #if crc != self.crc32:
         ##              print("[!] Error: CRC32 of data doesn't match header ({:08X} vs {:08X})".format(crc, self.crc32), file=sys.stderr)
         #               sys.exit(1)
 
-                md5 = hashlib.md5()
-                md5.update(buf)
-
                 if md5.digest() != self.md5:
                         print("[!] Error: MD5 of data doesn't match header ({:32s} vs {:32s})".format(md5.hexdigest(), b2a_hex(self.md5)), file=sys.stderr)
                         sys.exit(1)
 
+        def _iterZlib(self, source, dobj):
+                """
+                Feed source to the zlib decompressor dobj, never letting it
+                produce more than STREAM_CHUNK bytes at once
+                """
+                while not dobj.eof:
+                        data = dobj.unconsumed_tail or source.read(STREAM_CHUNK)
+                        if not data:
+                                break
+                        buf = dobj.decompress(data, STREAM_CHUNK)
+                        if buf:
+                                yield buf
+                buf = dobj.flush()
+                if buf:
+                        yield buf
+
+        def _iterFixed(self, pieces):
+                """
+                Regroup pieces into STREAM_CHUNK long ones, but the last
+                """
+                pending = bytearray()
+                for buf in pieces:
+                        if not pending and len(buf) == STREAM_CHUNK:
+                                yield buf
+                                continue
+                        pending += buf
+                        while len(pending) >= STREAM_CHUNK:
+                                yield bytes(pending[:STREAM_CHUNK])
+                                del pending[:STREAM_CHUNK]
+                if pending:
+                        yield bytes(pending)
+
+        def extract(self):
+                """
+                Extracts our payload from the compressed DZ file into RAM,
+                only for the small chunks which are parsed (GPT); use
+                iterExtract() for anything which may be large.  The result
+                goes to the chunk cache, the next extraction of this chunk
+                won't decompress it again.
+                """
+
+                buf = self.dz.cache.get(self.dataOffset)
+                if buf is None:
+                        buf = b"".join(self._iterDecompress())
+                        self.dz.cache.put(self.dataOffset, buf)
+
                 return buf
 
         def extractChunk(self, file, name):
                 """
                 Extract the payload of our chunk into the file with the name
 
-                Extracts our payload from the compressed DZ file using ZLIB.
-                self function could be particularly memory-intensive when used
-                with large chunks, as the entire compressed chunk is loaded
-                into RAM and decompressed.
-
-                A better way to do self would be to chunk the zlib compressed
-                data and decompress it with zlib.decompressor() and a while
-                loop.
-
-                I'm lazy though, and y'all have fast computers, so self is good
-                enough.
+                Extracts our payload from the compressed DZ file, a piece at
+                a time, into the file at its current position.
                 """
 
                 if name:
@@ -256,22 +555,100 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
 
                 # Create a hole at the end of the wipe area
                 if file:
-                        current = file.seek(0, io.SEEK_CUR)
+                        self.wipe(file.fileno(), file.seek(0, io.SEEK_CUR))
 
-#                       # Ensure space is allocated to areas to be written
-#                       for addr in range(self.trimCount):
-#                               file.seek(1<<self.dz.shiftLBA, io.SEEK_CUR)
-#                               file.write(b'\x00')
-#                       file.seek(current, io.SEEK_SET)
-                        # Makes the output the correct size, by filling as hole
-                        file.truncate(current + (self.trimCount<<self.dz.shiftLBA))
+                # Write it to file as it is decompressed
+                current = self.writeChunk(file.fileno(), file.seek(0, io.SEEK_CUR))
+                file.seek(current, io.SEEK_SET)
 
-                # Write it to file
-                file.write(self.extract())
+                # Print our messages
+                self.Messages()
+
+        def extractChunkAt(self, fd, offset, name):
+                """
+                Extract the payload of our chunk to offset of the descriptor
+                fd; unlike extractChunk() the file size is left alone, so
+                several chunks of one file can be extracted at the same time
+                """
+
+                if name:
+                        print("[+] Extracting {:s} to {:s}".format(self.chunkName.decode("utf8"), name))
+
+                if not self.dz.sparse:
+                        blockio.preallocate(fd, offset, self.targetSize)
+                self.writeChunk(fd, offset)
 
                 # Print our messages
                 self.Messages()
 
+        def wipe(self, fd, offset):
+                """
+                Make our wipe area (trimCount blocks from offset) read back
+                as zeros past the data we will write, extending the file
+                with a hole to cover it if needed
+                """
+
+                end = offset + self.targetSize
+                wipeEnd = offset + (self.trimCount << self.dz.shiftLBA)
+                size = os.fstat(fd).st_size
+
+                # Whatever the file already held there gets wiped
+                if size > end and wipeEnd > end:
+                        blockio.punch_hole(fd, end, min(size, wipeEnd) - end)
+
+                # Makes the output the correct size, by filling as hole
+                if size < wipeEnd:
+                        os.ftruncate(fd, wipeEnd)
+
+        def writeChunk(self, fd, offset):
+                """
+                Decompress our payload to offset of the descriptor fd, return
+                the offset following it; with the DZ's sparse flag all-zero
+                blocks are punched out instead of written; a payload in the
+                chunk store is copied (or shared) from there
+                """
+
+                store = self.dz.store
+                path = store.lookup(self.md5, self.targetSize) if store and not self.dz.sparse else None
+                if path is not None:
+                        with io.FileIO(path, "rb") as file:
+                                length = blockio.copy_range(file.fileno(), 0, fd, offset, self.targetSize)
+                        self.dz.progress.update(bytes_in=self.dataSize, bytes_out=length, items=1)
+                        return offset + length
+
+                for buf in self.iterExtract():
+                        if self.dz.sparse:
+                                self.writeSparse(fd, buf, offset)
+                        else:
+                                blockio.pwrite_all(fd, buf, offset)
+                        offset += len(buf)
+                        self.dz.progress.update(bytes_out=len(buf))
+                self.dz.progress.update(bytes_in=self.dataSize, items=1)
+
+                # Trailing zeros were never written, the file may be short
+                if self.dz.sparse and os.fstat(fd).st_size < offset:
+                        os.ftruncate(fd, offset)
+
+                return offset
+
+        def writeSparse(self, fd, buf, offset):
+                """
+                Write buf to offset of fd, leaving holes for the zero blocks
+                """
+
+                view = memoryview(buf)
+                for first, count, is_zero in sparseimg.zero_runs(buf, SPARSE_BLOCK):
+                        start = first * SPARSE_BLOCK
+                        if is_zero:
+                                blockio.punch_hole(fd, offset + start, count * SPARSE_BLOCK)
+                        else:
+                                blockio.pwrite_all(fd, view[start:start + count * SPARSE_BLOCK], offset + start)
+
+                # A chunk need not end on a whole block
+                tail = len(buf) % SPARSE_BLOCK
+                if tail:
+                        blockio.pwrite_all(fd, view[-tail:], offset + len(buf) - tail)
+
         def extractChunkfile(self, file, name):
                 """
                 Extract the raw data of our chunk into the file with the name
@@ -279,16 +656,20 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
 
                 print("[+] Extracting {:s} to {:s}".format(self.chunkName.decode("utf8"), name))
 
-                self.dz.dzfile.seek(self.dataOffset-self._dz_length, io.SEEK_SET)
-                buffer = self.dz.dzfile.read(self.dataSize + self._dz_length)
-                file.write(buffer)
+                # The chunk is stored as is, let the kernel copy it
+                current = file.seek(0, io.SEEK_CUR)
+                length = blockio.copy_range(self.dz.dzfile.fileno(), self.dz.dzBase + self.dataOffset - self._dz_length,
+                                file.fileno(), current, self.dataSize + self._dz_length)
+                file.seek(current + length, io.SEEK_SET)
+                self.dz.progress.update(bytes_in=length, bytes_out=length, items=1)
 
                 # Print our messages
                 self.Messages()
 
-        def __init__(self, dz, file):
+        def __init__(self, dz, buffer, dataOffset, offset=0):
                 """
-                Loads the DZ header in the form as defined by self._dz_chunk_dict
+                Loads the DZ header in the form as defined by self._dz_format_dict
+                from offset of buffer, the data following it is at dataOffset
                 """
 
                 super(UNDZChunk, self).__init__()
@@ -297,17 +678,18 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
                 self.dz = dz
 
                 # Load the header, does common checking
-                dz_item = self.loadHeader(file)
+                dz_item = self.unpackHeader(buffer, offset)
 
                 # used for warnings about the chunk
                 self.messages = []
 
                 # Record the "offset" where our chunk was declared,
                 # allows us to resolve where in the compressed data is
-                self.dataOffset = file.tell()
+                self.dataOffset = dataOffset
 
                 # Add ourselves to the hashes for checking
-                dz.md5Headers.update(dz_item['buffer'])
+                dz.md5Headers.update(dz_item.buffer)
+                self.header = dz_item.buffer
 
 ### experiment, results negative
 #               dz.sha1Headers.update(dz_item['buffer'])
@@ -320,19 +702,19 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
 
 
                 #
-                if dz_item['targetSize']&0x1FF != 0:
-                        self.messages.append("[?] Warning: uncompressed size is {:d}, not a multiple of 512 (please report!)".format(dz_item['targetSize']))
+                if dz_item.targetSize&0x1FF != 0:
+                        self.messages.append("[?] Warning: uncompressed size is {:d}, not a multiple of 512 (please report!)".format(dz_item.targetSize))
 
                 # Save off all the important data
-                self.sliceName  = dz_item['sliceName']
-                self.chunkName  = dz_item['chunkName']
-                self.targetAddr = dz_item['targetAddr']
-                self.targetSize = dz_item['targetSize']
-                self.dataSize   = dz_item['dataSize']
-                self.md5        = dz_item['md5']
-                self.trimCount  = dz_item['trimCount']
-                self.crc32      = dz_item['crc32']
-                self.dev        = dz_item['dev']
+                self.sliceName  = dz_item.sliceName
+                self.chunkName  = dz_item.chunkName
+                self.targetAddr = dz_item.targetAddr
+                self.targetSize = dz_item.targetSize
+                self.dataSize   = dz_item.dataSize
+                self.md5        = dz_item.md5
+                self.trimCount  = dz_item.trimCount
+                self.crc32      = dz_item.crc32
+                self.dev        = dz_item.dev
 
                 # The use of these non-.bin chunks is unknown
                 if self.chunkName[-4:] == b".img":
@@ -441,26 +823,10 @@ class UNDZSlice(object):
                 start = self.getStart()
                 end = self.getEnd()
 
-                for chunk in self.chunks:
-                        cur = chunk.getTargetStart()
-                        # Mostly happens for the backup GPT (large pad at start)
-                        if cur < start:
-                                # this ensures messages from extraction show up
-                                chunk.extractChunk(file, name)
-                                file.seek(0, io.SEEK_SET)
-                                file.truncate(0)
-                                # in case the long buffer was reeeally looong
-
-                                buf = chunk.extract()
-                                file.write(buf[cur-start:])
-                        else:
-                                file.seek(cur-start, io.SEEK_SET)
-                                chunk.extractChunk(file, name)
-
-                # it is possible for chunks wipe area to extend beyond slice
-                if self.getLength() >= 0:
-                        file.truncate(self.getLength())
-
+                if self.dz.sparseImage:
+                        self.dz.writeSparseImage(file, name, self.chunks, start, max(self.getLength(), 0))
+                else:
+                        self.extractRaw(file, name)
 
                 # write a params file for saving values used during recreate
                 params = io.open(name + ".params", "wt")
@@ -486,6 +852,47 @@ class UNDZSlice(object):
 
                 params.close()
 
+        def extractRaw(self, file, name):
+                """
+                Write the chunks of the slice to file as a plain image
+                """
+
+                start = self.getStart()
+
+                # Chunks inside the slice can go to the thread pool
+                if self.dz.jobs > 1:
+                        inside = [chunk for chunk in self.chunks if chunk.getTargetStart() >= start]
+                else:
+                        inside = []
+
+                for chunk in self.chunks:
+                        cur = chunk.getTargetStart()
+                        # Mostly happens for the backup GPT (large pad at start)
+                        if cur < start:
+                                if name:
+                                        print("[+] Extracting {:s} to {:s}".format(chunk.chunkName.decode("utf8"), name))
+
+                                # decompressed once, through the chunk cache
+                                buf = chunk.extract()
+                                self.dz.progress.update(bytes_in=chunk.dataSize, bytes_out=len(buf), items=1)
+
+                                file.seek(0, io.SEEK_SET)
+                                file.truncate(0)
+                                file.write(buf[cur-start:])
+
+                                # this ensures messages from extraction show up
+                                chunk.Messages()
+                        elif not inside:
+                                file.seek(cur-start, io.SEEK_SET)
+                                chunk.extractChunk(file, name)
+
+                if inside:
+                        self.dz.extractChunksParallel(file, name, inside, start)
+
+                # it is possible for chunks wipe area to extend beyond slice
+                if self.getLength() >= 0:
+                        file.truncate(self.getLength())
+
         def __init__(self, dz, index, name, start=0x7FFFFFFFFFFFFFFF, end=0):
                 """
                 Initialize the instance of UNDZSlice class
@@ -505,13 +912,217 @@ class UNDZSlice(object):
 
 
 
+class KDZWindow(io.RawIOBase):
+        """
+        Read-only file over length bytes at offset of another file's
+        descriptor, lets the DZ inside a KDZ be read in place instead of
+        being extracted first.  Reads are positional, so several windows
+        may be read from different threads at once.
+        """
+
+        def __init__(self, file, offset, length, closefd=True):
+                super(KDZWindow, self).__init__()
+                self.file = file
+                self.offset = offset
+                self.length = length
+                self.closefd = closefd
+                self.pos = 0
+
+        def readable(self):
+                return True
+
+        def seekable(self):
+                return True
+
+        def seek(self, pos, whence=io.SEEK_SET):
+                if whence == io.SEEK_CUR:
+                        pos += self.pos
+                elif whence == io.SEEK_END:
+                        pos += self.length
+                if pos < 0:
+                        raise ValueError("negative seek position {:d}".format(pos))
+                self.pos = pos
+                return pos
+
+        def tell(self):
+                return self.pos
+
+        def readinto(self, b):
+                count = min(len(b), self.length - self.pos)
+                if count <= 0:
+                        return 0
+                count = blockio.preadinto(self.file.fileno(), memoryview(b)[:count], self.offset + self.pos)
+                self.pos += count
+                return count
+
+        def fileno(self):
+                return self.file.fileno()
+
+        def close(self):
+                if self.closefd:
+                        self.file.close()
+                super(KDZWindow, self).close()
+
+
+
+class UNDZDisk(io.RawIOBase):
+        """
+        Read-only, seekable view of one target device (dev) of a DZ file as
+        the disk image extraction would produce, without writing it out.
+        Only the chunks overlapping a read are decompressed, a piece of
+        STREAM_CHUNK bytes at a time through the DZ's chunk cache; wipe
+        areas and space no chunk covers read back as zeros.  A chunk's MD5
+        is only checked once it has been read through to its end.
+        """
+
+        def __init__(self, dz, dev=0):
+                super(UNDZDisk, self).__init__()
+                self.dz = dz
+                self.dev = dev
+                self.pos = 0
+
+                # Chunks are already in target order, bisect over their starts
+                self.chunks = [chunk for chunk in dz.chunks if chunk.getDev() == dev]
+                self.starts = [chunk.getTargetStart() for chunk in self.chunks]
+                self.size = max([chunk.getTargetStart() + max(chunk.trimCount << dz.shiftLBA, chunk.targetSize) for chunk in self.chunks] + [0])
+
+                # Decompression of the chunk last read from, continued by a
+                # read further into it instead of starting over
+                self.stream = None
+                self.lock = threading.Lock()
+
+        def getSize(self):
+                """
+                Return the size of the device in bytes
+                """
+                return self.size
+
+        def readAt(self, offset, length):
+                """
+                Return up to length bytes from offset of the device, short
+                only at its end; the file position is left alone
+                """
+
+                length = max(min(length, self.size - offset), 0)
+                buf = bytearray(length)
+                end = offset + length
+
+                idx = max(bisect_right(self.starts, offset) - 1, 0)
+                while idx < len(self.chunks) and self.starts[idx] < end:
+                        start = self.starts[idx]
+                        chunk = self.chunks[idx]
+                        lo = max(offset, start)
+                        hi = min(end, start + chunk.targetSize)
+                        if lo < hi:
+                                self.readChunk(chunk, lo - start, memoryview(buf)[lo - offset:hi - offset])
+                        idx += 1
+
+                return bytes(buf)
+
+        def readChunk(self, chunk, pos, view):
+                """
+                Fill view with the payload of chunk from pos
+                """
+
+                key = chunk.getDataOffset()
+                first = pos // STREAM_CHUNK
+                last = (pos + len(view) - 1) // STREAM_CHUNK
+                for n in range(first, last + 1):
+                        piece = self.dz.cache.get((key, n))
+                        if piece is None:
+                                piece = self.streamPiece(chunk, n)
+                        base = n * STREAM_CHUNK
+                        lo = max(pos, base)
+                        hi = min(pos + len(view), base + len(piece))
+                        if lo < hi:
+                                view[lo - pos:hi - pos] = piece[lo - base:hi - base]
+
+        def streamPiece(self, chunk, n):
+                """
+                Decompress chunk up to its nth piece, caching every piece on
+                the way, and return it (empty past the end of the payload)
+                """
+
+                key = chunk.getDataOffset()
+                with self.lock:
+                        if self.stream is None or self.stream[0] is not chunk or self.stream[2] > n:
+                                self.stream = [chunk, chunk.iterExtract(), 0]
+                        stream = self.stream
+
+                        piece = b''
+                        while stream[2] <= n:
+                                piece = next(stream[1], None)
+                                if piece is None:
+                                        self.stream = None
+                                        return b''
+                                self.dz.cache.put((key, stream[2]), piece)
+                                stream[2] += 1
+
+                        # Past the last piece, let the stream run out so the
+                        # MD5 gets checked
+                        if stream[2] * STREAM_CHUNK >= chunk.targetSize:
+                                next(stream[1], None)
+                                self.stream = None
+
+                        return piece
+
+        def readable(self):
+                return True
+
+        def seekable(self):
+                return True
+
+        def seek(self, pos, whence=io.SEEK_SET):
+                if whence == io.SEEK_CUR:
+                        pos += self.pos
+                elif whence == io.SEEK_END:
+                        pos += self.size
+                if pos < 0:
+                        raise ValueError("negative seek position {:d}".format(pos))
+                self.pos = pos
+                return pos
+
+        def tell(self):
+                return self.pos
+
+        def readinto(self, b):
+                data = self.readAt(self.pos, len(b))
+                memoryview(b)[:len(data)] = data
+                self.pos += len(data)
+                return len(data)
+
+
+
 class UNDZFile(dz.DZFile, UNDZUtils):
         """
         Representation of the data parsed from a LGE DZ file
         """
 
 
-        def open(self, name):
+        def openKDZ(self, name, entry=None):
+                """
+                Return a window over the DZ entry of the KDZ file name (the only
+                .dz entry unless entry names one)
+                """
+
+                kdz = unkdz.KDZFileTools()
+                kdz.openFile(name)
+                kdz.getPartitions()
+
+                if entry:
+                        found = [p for p in kdz.partitions if p['name'].decode("utf8") == entry]
+                else:
+                        found = [p for p in kdz.partitions if p['name'].lower().endswith(b".dz")]
+
+                if len(found) != 1:
+                        print("[!] Error: {:s} DZ entry in KDZ file (entries: {:s})".format("no such" if entry or not found else "more than one",
+                                        ", ".join(p['name'].decode("utf8") for p in kdz.partitions)), file=sys.stderr)
+                        sys.exit(1)
+
+                self.kdzEntry = found[0]['name'].decode("utf8")
+                return KDZWindow(kdz.infile, found[0]['offset'], found[0]['length'])
+
+        def open(self, name, entry=None):
                 """
                 What do you expect? Open file and check the header
                 """
@@ -523,10 +1134,23 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                         print(err, file=sys.stderr)
                         sys.exit(1)
 
+                # Offset of the DZ in the underlying file, for raw copies
+                self.dzBase = 0
+                self.kdzEntry = None
+
+                # A KDZ is read through a window over its DZ entry
+                if self.dzfile.read(8) in unkdz.KDZFileTools.kdz_header:
+                        self.dzfile.close()
+                        self.dzfile = self.openKDZ(name, entry)
+                        self.dzBase = self.dzfile.offset
+
                 # Get length of whole file
                 self.length = self.dzfile.seek(0, io.SEEK_END)
                 self.dzfile.seek(0, io.SEEK_SET)
 
+                # Chunks are mostly read front to back
+                blockio.fadvise(self.dzfile.fileno(), self.dzBase, self.length, blockio.FADV_SEQUENTIAL)
+
 
                 # Load the header, does common checking
                 dz_file = self.loadHeader(self.dzfile)
@@ -585,7 +1209,36 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 
         def loadChunks(self):
                 """
-                Loads the headers of the chunks to prepare for listing|extract
+                Loads the headers of the chunks to prepare for listing|extract,
+                from the index next to the file when it is still valid
+                """
+
+                index = self.loadIndex()
+                if index is None:
+                        self.scanChunks()
+                        self.loadSlices()
+                        self.saveIndex()
+                else:
+                        for entry in index['chunks']:
+                                self.chunks.append(UNDZChunk(self, a2b_hex(entry['header']), entry['dataOffset']))
+                        self.sortChunks()
+
+                        self.shiftLBA = index['shiftLBA']
+                        for message in index['messages']:
+                                print(message)
+                        for entry in index['slices']:
+                                slice = UNDZSlice(self, entry['index'], entry['name'], entry['start'], entry['end'])
+                                self.slices.append(slice)
+                                if entry['named']:
+                                        self.sliceIdx[entry['name']] = slice
+
+                for chunk in self.chunks:
+                        self.addChunk(chunk)
+
+        def scanChunks(self):
+                """
+                Walk the chunk headers, over a mmap of the file where it can
+                be mapped
                 """
 
                 # are the chunks out of order in regards to image order?
@@ -593,10 +1246,22 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                 last = -1
                 dev = -1
 
+                try:
+                        view = mmap.mmap(self.dzfile.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError, mmap.error):
+                        view = None
+
+                # the first chunk follows the file header
+                pos = self._dz_length
+
                 while True:
 
                         # Read each segment's header
-                        chunk = UNDZChunk(self, self.dzfile)
+                        if view is not None:
+                                chunk = UNDZChunk(self, view, pos + self._dz_length, self.dzBase + pos)
+                        else:
+                                self.dzfile.seek(pos, io.SEEK_SET)
+                                chunk = UNDZChunk(self, self.dzfile.read(self._dz_length), pos + self._dz_length)
                         self.chunks.append(chunk)
 
                         # check ordering
@@ -612,26 +1277,37 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                                 disorder += 1
                         last = chunk.getTargetStart()
 
-                        # Would seeking the file to the end of the compressed
-                        # data bring us to the end of the file, or beyond it?
-                        next = chunk.getNext()
-                        if next >= int(self.length):
+                        # Would going to the end of the compressed data bring
+                        # us to the end of the file, or beyond it?
+                        pos = chunk.getNext()
+                        if pos >= int(self.length):
                                 break
 
-                        # Seek to next DZ header
-                        self.dzfile.seek(next, io.SEEK_SET)
+                if view is not None:
+                        view.close()
 
                 # If I'm perverse enough to think of this...
                 if disorder > 0:
                         print("[ ] Warning: Found {:d} out of order chunks (please report)".format(disorder), file=sys.stderr)
 
+                self.sortChunks()
+
+        def sortChunks(self):
+                """
+                Put the chunks in image order
+                """
+
                 # They're in the order to write, not block order though
                 self.chunks.sort(key=lambda c: (c.getTargetStart() + (c.getDev()<<48)))
 
+        def loadSlices(self):
+                """
+                Lay out the slices from the GPT in the first chunk
+                """
+
                 try:
                         emptycount = 0
                         g = gpt.GPT(self.chunks[0].extract())
-                        ordered = range(len(g.slices)) if g.ordered else range(len(g.slices)).sort(key=lambda s: g.slices[s].startLBA)
 
                         self.shiftLBA = g.shiftLBA
 
@@ -640,12 +1316,10 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                         self.slices.append(slice)
                         self.sliceIdx[self.chunks[0].getSliceName()] = slice
 
-                        index = 0
-                        while index < len(g.slices):
-                                if g.slices[index].type == UUID(int=0):
-                                        del g.slices[index]
-                                else:
-                                        index += 1
+                        # Unused entries are all zero, no need to decode them
+                        g.slices = [entry for entry in g.slices if not entry.isEmpty()]
+                        if not g.ordered:
+                                g.slices.sort(key=lambda entry: entry.startLBA)
 
                         index = 1
                         for slice in g.slices:
@@ -656,7 +1330,7 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 
                         for i in range(len(g.slices)):
                                 if next != g.slices[i].startLBA:
-                                        print("[!] Unallocated space found. Slice, Start, Size, End: " + str(next) + " " + str((g.slices[i].startLBA - next)<<self.shiftLBA), next<<self.shiftLBA, (g.slices[i].startLBA-1)<<self.shiftLBA)
+                                        self.layoutMessage("[!] Unallocated space found. Slice, Start, Size, End: {:d} {:d} {:d} {:d}".format(next, (g.slices[i].startLBA - next)<<self.shiftLBA, next<<self.shiftLBA, (g.slices[i].startLBA-1)<<self.shiftLBA))
                                         emptycount += 1
                                 next = g.slices[i].endLBA+1
 
@@ -671,11 +1345,71 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                         self.sliceIdx[self.chunks[-1].getSliceName()] = slice
 
                 except gpt.NoGPT as err:
-                        print("[!] Unable to find GPT in DZ file: {:s}".format(err))
+                        self.layoutMessage("[!] Unable to find GPT in DZ file: {:s}".format(str(err)))
                         pass
 
-                for chunk in self.chunks:
-                        self.addChunk(chunk)
+        def layoutMessage(self, message):
+                """
+                Print a finding about the layout, the index repeats it later
+                """
+                print(message)
+                self.layoutMessages.append(message)
+
+        def indexPath(self):
+                return self.dzName + INDEX_SUFFIX
+
+        def indexKey(self):
+                """
+                What the index must have been made from: the file's size and
+                mtime, the MD5 of the chunk headers from the DZ header and the
+                DZ entry of a KDZ
+                """
+                st = os.stat(self.dzName)
+                return {
+                        'version': INDEX_VERSION,
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                        'md5': b2a_hex(self.md5).decode("utf8"),
+                        'entry': self.kdzEntry,
+                }
+
+        def loadIndex(self):
+                """
+                Return the saved index if it matches the file, or None
+                """
+                if not self.useIndex:
+                        return None
+                try:
+                        key = self.indexKey()
+                        with open(self.indexPath()) as f:
+                                index = json.load(f)
+                except (IOError, OSError, ValueError):
+                        return None
+                for k in key:
+                        if index.get(k) != key[k]:
+                                return None
+                return index
+
+        def saveIndex(self):
+                """
+                Save the chunk headers (in file order), the slices the GPT
+                gave and the block size next to the file
+                """
+                if not self.useIndex:
+                        return
+                named = set(id(slice) for slice in self.sliceIdx.values())
+                index = self.indexKey()
+                index['shiftLBA'] = self.shiftLBA
+                index['messages'] = self.layoutMessages
+                index['chunks'] = [{'header': b2a_hex(chunk.header).decode("utf8"), 'dataOffset': chunk.dataOffset}
+                                for chunk in sorted(self.chunks, key=lambda c: c.dataOffset)]
+                index['slices'] = [{'index': slice.index, 'name': slice.name, 'start': slice.start, 'end': slice.end, 'named': id(slice) in named}
+                                for slice in self.slices]
+                try:
+                        with open(self.indexPath(), 'w') as f:
+                                json.dump(index, f)
+                except (IOError, OSError):
+                        pass
 
         def checkValues(self):
                 """
@@ -796,6 +1530,14 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                 """
                 return self.chunks[idx].getChunkName()
 
+        def getDisk(self, dev=0):
+                """
+                Return the random access UNDZDisk of the target device dev
+                """
+                if dev not in self.disks:
+                        self.disks[dev] = UNDZDisk(self, dev)
+                return self.disks[dev]
+
         def getSliceName(self, idx):
                 """
                 Return the name of the given slice index
@@ -831,11 +1573,98 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                 Extract the whole file to an image file named name
                 """
 
+                if self.sparseImage:
+                        length = max([chunk.getTargetStart() + max(chunk.trimCount << self.shiftLBA, chunk.targetSize) for chunk in self.chunks] + [0])
+                        self.writeSparseImage(file, name, self.chunks, 0, length)
+                        return
+
+                if self.jobs > 1:
+                        self.extractChunksParallel(file, name, self.chunks)
+                        return
+
                 # the slice extraction has gotten preoccupied with slices
                 for chunk in self.chunks:
                         file.seek(chunk.getTargetStart(), io.SEEK_SET)
                         chunk.extractChunk(file, name)
 
+        def extractChunksParallel(self, file, name, chunks, base=0):
+                """
+                Extract chunks with self.jobs threads (zlib and zstd work
+                without the GIL), each chunk pwrite()n to its target offset
+                less base.  The wipe areas of a device are cleared first, so
+                the workers only ever write data; devices share offsets in
+                the image and go one after the other, in chunk order.
+                """
+
+                from concurrent.futures import ThreadPoolExecutor
+                from itertools import groupby
+
+                fd = file.fileno()
+                end = max([chunk.getTargetEnd() - base for chunk in chunks] + [0])
+                if os.fstat(fd).st_size < end:
+                        os.ftruncate(fd, end)
+
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                        for dev, group in groupby(chunks, lambda chunk: chunk.getDev()):
+                                group = list(group)
+                                for chunk in group:
+                                        chunk.wipe(fd, chunk.getTargetStart() - base)
+                                for done in pool.map(lambda chunk: chunk.extractChunkAt(fd, chunk.getTargetStart() - base, name), group):
+                                        pass
+
+                file.seek(0, io.SEEK_END)
+
+        def writeSparseImage(self, file, name, chunks, base, length):
+                """
+                Write length bytes from base of the target, as covered by
+                chunks, to file as an Android sparse image: data as RAW
+                chunks, zero blocks as FILL, gaps and wipe areas as DONT_CARE
+                """
+
+                chunks = sorted(chunks, key=lambda chunk: chunk.getTargetStart())
+
+                # The largest block size every chunk lines up with
+                blkSize = SPARSE_BLOCK
+                aligned = [chunk.getTargetStart() - base for chunk in chunks if chunk.getTargetStart() >= base]
+                aligned += [chunk.targetSize for chunk in chunks] + [length]
+                while blkSize > 4 and any(value % blkSize for value in aligned):
+                        blkSize >>= 1
+
+                writer = sparseimg.SparseWriter(file, blkSize, (length + blkSize - 1) // blkSize)
+                total = writer.total_blks * blkSize
+
+                for chunk in chunks:
+                        offset = chunk.getTargetStart() - base
+                        if name:
+                                print("[+] Extracting {:s} to {:s}".format(chunk.chunkName.decode("utf8"), name))
+
+                        if offset < 0:
+                                # Mostly happens for the backup GPT (large pad at start),
+                                # kept as the plain extraction lays it out
+                                pieces = [chunk.extract()[offset:]]
+                                offset = 0
+                        else:
+                                pieces = chunk.iterExtract()
+
+                        if offset // blkSize < writer.block:
+                                print("[!] Error: {:s} overlaps the previous chunk".format(chunk.chunkName.decode("utf8")), file=sys.stderr)
+                                sys.exit(1)
+                        writer.skip(offset // blkSize - writer.block)
+
+                        for buf in pieces:
+                                # Nothing past the end of the slice is kept
+                                buf = buf[:max(0, total - offset)]
+                                if len(buf) % blkSize:
+                                        buf += bytes(blkSize - len(buf) % blkSize)
+                                writer.data(buf)
+                                offset += len(buf)
+                                self.progress.update(bytes_out=len(buf))
+                        self.progress.update(bytes_in=chunk.dataSize, items=1)
+
+                        # Print our messages
+                        chunk.Messages()
+
+                writer.close()
 
         def saveHeader(self, name):
                 """
@@ -869,17 +1698,26 @@ class UNDZFile(dz.DZFile, UNDZUtils):
                 params.write("unknown4={:d}\n".format(self.unknown4))
                 params.write("# this almost looks like a bar-code of bytes?\n")
                 params.write("unknown5={:d}\n".format(self.unknown5))
+                if self.chunks:
+                        params.write("# how the chunks are compressed, for mkdz\n")
+                        params.write("compression={:s}\n".format(self.chunks[0].getCodec()))
 
                 params.close()
 
 
-        def __init__(self, name):
+        def __init__(self, name, entry=None, index=True):
                 """
-                Constructing this class opens the file and loads map of chunks
+                Constructing this class opens the file and loads map of chunks;
+                name may also be a KDZ holding the DZ (as entry, if given).
+                With index the map is kept in a file next to it.
                 """
 
                 super(UNDZFile, self).__init__()
 
+                self.dzName = name
+                self.useIndex = index
+                self.layoutMessages = []
+
                 self.slices = []
                 self.sliceIdx = {}
 
@@ -887,6 +1725,25 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 
                 self.messages = set()
 
+                # Replaced by the caller to get extraction progress reports
+                self.progress = Progress()
+
+                # Decompressed chunks shared by the GPT probe and extraction
+                self.cache = ChunkCache()
+
+                # Optional ChunkStore of payloads shared across DZ files
+                self.store = None
+
+                # Read-only views of the target devices, see getDisk()
+                self.disks = {}
+
+                # Number of chunks decompressed at once
+                self.jobs = 1
+
+                # Leave holes for zero blocks, or write Android sparse images
+                self.sparse = False
+                self.sparseImage = False
+
                 # Hash of the headers for consistency checking
                 self.md5Headers = hashlib.new("md5")
 
@@ -908,7 +1765,7 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 #               self.crcAll = crc32(b"")
 #               # try crc32 ?
 
-                self.open(name)
+                self.open(name, entry)
                 self.loadChunks()
                 self.checkValues()
 
@@ -922,11 +1779,15 @@ class DZFileTools:
 
         # Setup variables
         outdir = "dzextracted"
+        include = []
+        exclude = []
+        slot = None
 
         def parseArgs(self):
                 # Parse arguments
                 parser = argparse.ArgumentParser(description='LG Compressed DZ File Extractor originally by IOMonster')
-                parser.add_argument('-f', '--file', help='DZ File to read', action='store', required=True, dest='dzfile')
+                parser.add_argument('-f', '--file', help='DZ File to read (or KDZ file holding it)', action='store', required=True, dest='dzfile')
+                parser.add_argument('-e', '--entry', help='name of the DZ inside a KDZ file (default: the only .dz)', action='store', dest='entry')
                 parser.add_argument('-b', '--batch', help='batch mode', action='store_true', dest='batchMode')
                 group = parser.add_mutually_exclusive_group(required=True)
                 group.add_argument('-l', '--list', help='list slices/partitions', action='store_true', dest='listOnly')
@@ -935,9 +1796,44 @@ class DZFileTools:
                 group.add_argument('-s', '--single', help='extract diskslice(s) (partition(s)) (all by default)', action='store_true', dest='extractSlice')
                 group.add_argument('-i', '--image', help='extract all slices/partitions as a disk image', action='store_true', dest='extractImage')
                 parser.add_argument('-d', '--dir', '-o', '--out', help='output location', action='store', dest='outdir')
+                parser.add_argument('--sparse', help='leave holes for all-zero blocks and wipe areas instead of writing zeros', action='store_true', dest='sparse')
+                parser.add_argument('--sparse-image', help='write slices/image as Android sparse images', action='store_true', dest='sparseImage')
+                parser.add_argument('--no-index', help='rescan instead of using (and writing) the {:s} index next to the file'.format(INDEX_SUFFIX), action='store_true', dest='noIndex')
+                parser.add_argument('--cache-size', help='MiB of decompressed chunks kept in memory for reuse (default: {:d})'.format(CHUNK_CACHE >> 20), action='store', type=int, dest='cacheSize')
+                parser.add_argument('--chunk-store', help='directory of decompressed chunks, reused by MD5 within and across DZ files', action='store', dest='chunkStore')
+                parser.add_argument('--chunk-store-size', help='MiB of disk the chunk store may use (default: {:d})'.format(CHUNK_STORE >> 20), action='store', type=int, default=CHUNK_STORE >> 20, dest='chunkStoreSize')
+                parser.add_argument('-I', '--include', help='only slices/chunks whose name matches one of these shell patterns (repeatable, whitespace or comma separated); "system" also matches "system_a"', action='append', nargs='+', dest='include')
+                parser.add_argument('--exclude', help='skip slices/chunks whose name matches one of these shell patterns', action='append', nargs='+', dest='exclude')
+                parser.add_argument('--slot', help='only the given A/B slot of slotted slices', action='store', choices=('a', 'b'), dest='slot')
+                parser.add_argument('-j', '--jobs', help='number of chunks decompressed at once (default: CPU count)', action='store', type=int, dest='jobs')
+                add_progress_argument(parser)
 
                 return parser.parse_known_args()
 
+        @staticmethod
+        def splitPatterns(args):
+                if not args:
+                        return []
+                return [pat for group in args for arg in group for pat in arg.replace(',', ' ').split()]
+
+        def wanted(self, name):
+                """
+                Whether the slice (or chunk of one) named name passes the
+                --include/--exclude/--slot selection
+                """
+                base = name
+                if len(name) > 2 and name[-2] == '_' and name[-1] in 'ab':
+                        if self.slot and name[-1] != self.slot:
+                                return False
+                        base = name[:-2]
+
+                def match(patterns):
+                        return any(fnmatch.fnmatchcase(name, pat) or fnmatch.fnmatchcase(base, pat) for pat in patterns)
+
+                if self.include and not match(self.include):
+                        return False
+                return not match(self.exclude)
+
         def cmdListPartitions(self):
             if not cmd.batchMode:
                 print("[+] DZ Partition List\n=========================================")
@@ -961,6 +1857,8 @@ class DZFileTools:
                         if idx < 0 or idx >= self.dz_file.getChunkCount():
                                 print("[!] Cannot extract out of range chunk {:d} (min=0 max={:d})".format(idx, self.dz_file.getChunkCount()-1), file=sys.stderr)
                                 sys.exit(1)
+                        if not self.wanted(self.dz_file.getChunk(idx).getSliceName()):
+                                continue
                         name = self.dz_file.getChunkName(idx)
                         file = io.FileIO(name, "wb")
                         self.dz_file.extractChunk(file, name, idx)
@@ -984,8 +1882,10 @@ class DZFileTools:
                         if idx < 0 or idx >= self.dz_file.getChunkCount():
                                 print("[!] Cannot extract out of range chunkfile {:d} (min=0 max={:d})".format(idx, self.dz_file.getChunkCount()-1), file=sys.stderr)
                                 sys.exit(1)
+                        if not self.wanted(self.dz_file.getChunk(idx).getSliceName()):
+                                continue
                         name = self.dz_file.getChunkName(idx) + ".chunk"
-                        file = io.open(name, "wb")
+                        file = io.FileIO(name, "wb")
                         self.dz_file.extractChunkfile(file, name, idx)
                         file.close()
 
@@ -1017,20 +1917,26 @@ class DZFileTools:
                                 if slice.getIndex() == None:
                                     slice = self.dz_file.getSlice(idx)
 
+                        if not self.wanted(slice.getSliceName()):
+                                continue
+
                         name = slice.getSliceName() + ".image"
                         file = io.FileIO(name, "wb")
                         self.dz_file.extractSlice(file, name, cur)
                         file.close()
 
         def cmdExtractImage(self, files):
-                if len(files) > 0:
+                if len(files) > 0 or self.include or self.exclude or self.slot:
                         print("[!] Cannot specify specific portions to extract when outputting image", file=sys.stderr)
                         sys.exit(1)
                 name = "image.img"
-                try:
-                        file = io.open(name, "r+b")
-                except IOError:
-                        file = io.open(name, "wb")
+                if self.dz_file.sparseImage:
+                        file = io.FileIO(name, "wb")
+                else:
+                        try:
+                                file = io.FileIO(name, "r+b")
+                        except IOError:
+                                file = io.FileIO(name, "wb")
                 self.dz_file.extractImage(file, name)
                 file.close()
 
@@ -1043,7 +1949,18 @@ class DZFileTools:
                 if cmd.outdir:
                         self.outdir = cmd.outdir
 
-                self.dz_file = UNDZFile(cmd.dzfile)
+                self.dz_file = UNDZFile(cmd.dzfile, cmd.entry, not cmd.noIndex)
+                self.dz_file.jobs = cmd.jobs or os.cpu_count() or 1
+                self.dz_file.sparse = cmd.sparse
+                self.dz_file.sparseImage = cmd.sparseImage
+                if cmd.cacheSize is not None:
+                        self.dz_file.cache.resize(cmd.cacheSize << 20)
+                if cmd.chunkStore:
+                        self.dz_file.store = ChunkStore(cmd.chunkStore, cmd.chunkStoreSize << 20)
+
+                self.include = self.splitPatterns(cmd.include)
+                self.exclude = self.splitPatterns(cmd.exclude)
+                self.slot = cmd.slot
 
                 if cmd.listOnly:
                         self.cmdListPartitions()
@@ -1056,6 +1973,11 @@ class DZFileTools:
                 # Change to the output directory
                 os.chdir(self.outdir)
 
+                # Every chunk is extracted once unless a subset was asked for
+                subset = files or self.include or self.exclude or self.slot
+                self.dz_file.progress = tracker(cmd.progress, os.path.basename(cmd.dzfile),
+                                items_total=None if subset else self.dz_file.getChunkCount())
+
                 # Extracting slice(s)
                 if cmd.extractSlice:
                         self.cmdExtractSlice(files)
@@ -1072,6 +1994,15 @@ class DZFileTools:
                 elif cmd.extractChunk:
                         self.cmdExtractChunk(files)
 
+                self.dz_file.progress.finish()
+
+                if not cmd.batchMode:
+                        stats = self.dz_file.cache.stats()
+                        print("[+] Chunk cache: {:d} hits, {:d} misses, {:d} evictions, {:d} bytes peak".format(stats['hits'], stats['misses'], stats['evictions'], stats['peakBytes']))
+                        if self.dz_file.store:
+                                stats = self.dz_file.store.stats()
+                                print("[+] Chunk store: {:d} hits, {:d} misses, {:d} stored, {:d} evictions, {:d} bytes".format(stats['hits'], stats['misses'], stats['stored'], stats['evictions'], stats['bytes']))
+
                 # Save the header for later reconstruction
                 self.dz_file.saveHeader(cmd.dzfile)
 
@@ -30,6 +30,12 @@ sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import kdz
 
+# shared helpers live one level up, in "utils"
+sys.path.append(os.path.dirname(sys.path[0]))
+
+import blockio
+from progress import Progress, tracker, add_argument as add_progress_argument
+
 
 class KDZFileTools(kdz.KDZFile):
 	"""
@@ -40,6 +46,7 @@ class KDZFileTools(kdz.KDZFile):
 	partitions = []
 	outdir = "kdzextracted"
 	infile = None
+	progress = Progress()
 
 	kdz_header = {
           b"\x28\x05\x00\x00"b"\x34\x31\x25\x80":	0,
@@ -57,25 +64,20 @@ class KDZFileTools(kdz.KDZFile):
 		# Read a whole DZ header
 		buf = self.infile.read(self._dz_length)
 
-		# "Make the item"
-		# Create a new dict using the keys from the format string
-		# and the format string itself
-		# and apply the format to the buffer
-		kdz_item = dict(zip(
-			self._dz_format_dict.keys(),
-			self._dz_struct.unpack(buf)
-		))
+		# "Make the item", a record of the fields in the buffer
+		kdz_item = self.unpackdict(buf)
 
-		# Collapse (truncate) each key's value if it's listed as collapsible
+		# Check each key's value if it's listed as collapsible, the
+		# record only collapses (truncates) them when they're read
 		for key in self._dz_collapsibles:
-			if type(kdz_item[key]) is str or type(kdz_item[key]) is bytes:
-				kdz_item[key] = kdz_item[key].rstrip(b'\x00')
-				if b'\x00' in kdz_item[key]:
+			value = kdz_item[key]
+			if type(value) is bytes:
+				if b'\x00' in value:
 					print("[!] Warning: extraneous data found IN "+key, file=sys.stderr)
 					#sys.exit(1)
-			elif type(kdz_item[key]) is int:
-				if kdz_item[key] != 0:
-					print('[!] Error: field "'+key+'" is non-zero ('+b2a_hex(kdz_item[key])+')', file=sys.stderr)
+			elif type(value) is int:
+				if value != 0:
+					print('[!] Error: field "'+key+'" is non-zero ('+hex(value)+')', file=sys.stderr)
 					sys.exit(1)
 			else:
 				print("[!] Error: internal error", file=sys.stderr)
@@ -139,9 +141,6 @@ class KDZFileTools(kdz.KDZFile):
 
 		currentPartition = self.partitions[index]
 
-		# Seek to the beginning of the compressed data in the specified partition
-		self.infile.seek(currentPartition['offset'], os.SEEK_SET)
-
 		# Ensure that the output directory exists
 		if not os.path.exists(self.outdir):
 			os.makedirs(self.outdir)
@@ -149,26 +148,15 @@ class KDZFileTools(kdz.KDZFile):
 		# Open the new file for writing
 		outfile = open(os.path.join(self.outdir,currentPartition['name'].decode("utf8")), 'wb')
 
-		# Use 1024 byte chunks
-		chunkSize = 1024
-
-		# uncomment to prevent runaways
-		#for x in xrange(10):
-
-		while True:
-
-			# Read file in 1024 byte chunks
-			outfile.write(self.infile.read(chunkSize))
-
-			# If the output file + chunkSize would be larger than the input data
-			if outfile.tell() + chunkSize >= currentPartition['length']:
-				# Change the chunk size to be the difference between the length of the input and the current length of the output
-				outfile.write(self.infile.read(currentPartition['length'] - outfile.tell() ))
-				# Prevent runaways!
-				break
+		# Let the kernel copy (or share) the data, it is read only once
+		copied = blockio.copy_range(self.infile.fileno(), currentPartition['offset'], outfile.fileno(), 0,
+				currentPartition['length'], self.progress, dontneed=True)
+		if copied < currentPartition['length']:
+			print("[!] Warning: KDZ file ended {:d} bytes into {:s}".format(copied, currentPartition['name'].decode("utf8")), file=sys.stderr)
 
 		# Close the file
 		outfile.close()
+		self.progress.update(items=1)
 
 	def saveExtra(self):
 		"""
@@ -187,16 +175,7 @@ class KDZFileTools(kdz.KDZFile):
 
 		print("[+] Extracting extra data to " + filename)
 
-		self.infile.seek(self.headerEnd, os.SEEK_SET)
-
-		total = self.dataStart - self.headerEnd
-		while total > 0:
-			count = 4096 if 4096 < total else total
-
-			buf = self.infile.read(count)
-			extra.write(buf)
-
-			total -= count
+		blockio.copy_range(self.infile.fileno(), self.headerEnd, extra.fileno(), 0, self.dataStart - self.headerEnd)
 
 		extra.close()
 
@@ -239,10 +218,14 @@ class KDZFileTools(kdz.KDZFile):
 		group.add_argument('-x', '--extract', help='extract all partitions', action='store_true', dest='extractAll')
 		group.add_argument('-s', '--single', help='single Extract by ID', action='store', dest='extractID', type=int)
 		parser.add_argument('-d', '--dir', '-o', '--out', help='output directory', action='store', dest='outdir')
+		add_progress_argument(parser)
 
 		return parser.parse_args()
 
 	def openFile(self, kdzfile):
+		# Each file gets a partition list of its own
+		self.partitions = []
+
 		# Open the file
 		try:
 			self.infile = open(kdzfile, "rb")
@@ -299,12 +282,18 @@ class KDZFileTools(kdz.KDZFile):
 
 		elif args.extractID != None:
 			if args.extractID >= 0 and args.extractID < len(self.partList):
+				self.progress = tracker(args.progress, os.path.basename(self.kdzfile),
+						total=self.partList[args.extractID][1], items_total=1)
 				self.cmdExtractSingle(args.extractID)
+				self.progress.finish()
 			else:
 				print("[!] Segment {:d} is out of range!".format(args.extractID), file=sys.stderr)
 
 		elif args.extractAll:
+			self.progress = tracker(args.progress, os.path.basename(self.kdzfile),
+					total=sum(part[1] for part in self.partList), items_total=len(self.partList))
 			self.cmdExtractAll()
+			self.progress.finish()
 
 if __name__ == "__main__":
 	kdztools = KDZFileTools()
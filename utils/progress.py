@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: progress.py
+#   DESCRIPTION: Progress and throughput reporting
+#                shared by the extractors
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, json, time, threading
+
+MODES = ('quiet', 'bar', 'json')
+
+class Progress(object):
+    """
+    Progress of one job: bytes in/out, items done, elapsed time and
+    throughput.  total is the expected number of bytes in and items_total
+    the expected number of items, either may be None.  This base class
+    is the disabled tracker, every method is a no-op so callers can
+    report unconditionally.
+    """
+
+    enabled = False
+
+    def __init__(self, name='', total=None, items_total=None):
+        self.name = name
+        self.total = total
+        self.items_total = items_total
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.items = 0
+        self.start = time.time()
+
+    def update(self, bytes_in=0, bytes_out=0, items=0):
+        pass
+
+    def finish(self):
+        pass
+
+    def metrics(self):
+        elapsed = time.time() - self.start
+        return {
+            'name': self.name,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'total': self.total,
+            'items': self.items,
+            'items_total': self.items_total,
+            'elapsed': round(elapsed, 3),
+            'rate': round((self.bytes_out or self.bytes_in) / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish()
+
+class ReportingProgress(Progress):
+    """
+    Tracker that hands its metrics to a sink, at most every interval seconds
+    """
+
+    enabled = True
+
+    def __init__(self, sink, name='', total=None, items_total=None, interval=0.25):
+        super(ReportingProgress, self).__init__(name, total, items_total)
+        self.sink = sink
+        self.interval = interval
+        self.next_report = self.start
+        self.finished = False
+        # Worker threads may report at the same time
+        self.lock = threading.Lock()
+
+    def update(self, bytes_in=0, bytes_out=0, items=0):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.items += items
+            now = time.time()
+            if now >= self.next_report:
+                self.next_report = now + self.interval
+                self.sink.report(self.metrics(), False)
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.sink.report(self.metrics(), True)
+
+def _size(n):
+    return '{:.1f} MiB'.format(n / 1048576.0)
+
+class BarSink(object):
+    """
+    Single updating status line on a terminal
+    """
+
+    def __init__(self, stream=None, width=30):
+        self.stream = stream or sys.stderr
+        self.width = width
+
+    def report(self, m, done):
+        if m['total']:
+            frac = min(1.0, float(m['bytes_in']) / m['total'])
+        elif m['items_total']:
+            frac = min(1.0, float(m['items']) / m['items_total'])
+        else:
+            frac = None
+
+        line = m['name']
+        if frac is not None:
+            fill = int(frac * self.width)
+            line += ' [{}{}] {:3d}%'.format('#' * fill, ' ' * (self.width - fill), int(frac * 100))
+        if m['items_total']:
+            line += ' {}/{}'.format(m['items'], m['items_total'])
+        elif m['items']:
+            line += ' {} items'.format(m['items'])
+        line += ' {} {}/s'.format(_size(m['bytes_out'] or m['bytes_in']), _size(m['rate']))
+
+        self.stream.write('\r' + line + ('\n' if done else ''))
+        self.stream.flush()
+
+class JSONSink(object):
+    """
+    One JSON object per report, the last one has "done": true
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def report(self, m, done):
+        m = dict(m)
+        m['done'] = done
+        self.stream.write(json.dumps(m, sort_keys=True) + '\n')
+        self.stream.flush()
+
+def tracker(mode, name='', total=None, items_total=None, stream=None):
+    """
+    Return a Progress for mode ('quiet', 'bar' or 'json'; None is quiet)
+    """
+    if mode == 'bar':
+        return ReportingProgress(BarSink(stream), name, total, items_total)
+    if mode == 'json':
+        return ReportingProgress(JSONSink(stream), name, total, items_total, interval=1.0)
+    return Progress(name, total, items_total)
+
+def add_argument(parser, default='quiet'):
+    """
+    Add the common --progress option to an argparse parser
+    """
+    parser.add_argument('--progress', choices=MODES, default=default,
+            help='progress reporting on stderr: quiet, bar or json lines (default: {})'.format(default))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: rangelib.py
+#   DESCRIPTION: Compact block range sets for
+#                transfer lists
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from array import array
+
+class RangeSet(object):
+    """
+    Half-open block ranges [begin, end) stored flat in one array('Q') as
+    begin0, end0, begin1, end1, ...  Ranges keep the order they were given
+    in (new.dat and stash data follow that order); the set operations
+    return sorted, merged results.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data=None):
+        if isinstance(data, array):
+            self.data = data
+        else:
+            self.data = array('Q', data or ())
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse the transfer list form '<count>,<begin>,<end>,...'
+
+        >>> RangeSet.parse('4,10,20,0,5')
+        RangeSet("4,10,20,0,5")
+        >>> list(RangeSet.parse('4,10,20,0,5'))
+        [(10, 20), (0, 5)]
+        >>> RangeSet.parse('3,10,20')
+        Traceback (most recent call last):
+        ...
+        ValueError: bad range set "3,10,20"
+        >>> RangeSet.parse('2,20,10')
+        Traceback (most recent call last):
+        ...
+        ValueError: bad range 20-10 in "2,20,10"
+        """
+        data = array('Q', map(int, text.split(',')))
+        if not data or len(data) != data[0] + 1 or data[0] % 2:
+            raise ValueError('bad range set "{}"'.format(text))
+        del data[0]
+        for i in range(0, len(data), 2):
+            if data[i] >= data[i + 1]:
+                raise ValueError('bad range {}-{} in "{}"'.format(data[i], data[i + 1], text))
+        return cls(data)
+
+    def __iter__(self):
+        it = iter(self.data)
+        return zip(it, it)
+
+    def __len__(self):
+        return len(self.data) // 2
+
+    def __bool__(self):
+        return len(self.data) > 0
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.data[2*index], self.data[2*index + 1]
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RangeSet("{}")'.format(self.to_string_raw())
+
+    def to_string_raw(self):
+        return ','.join(str(x) for x in [len(self.data)] + self.data.tolist())
+
+    def size(self):
+        """
+        Total number of blocks covered (ranges are assumed not to overlap)
+
+        >>> RangeSet.parse('4,10,20,0,5').size()
+        15
+        """
+        return sum(self.data[1::2]) - sum(self.data[0::2])
+
+    @property
+    def first(self):
+        """
+        Lowest block covered, 0 for an empty set
+
+        >>> RangeSet.parse('4,10,20,0,5').first, RangeSet().first
+        (0, 0)
+        """
+        return min(self.data[0::2]) if self.data else 0
+
+    @property
+    def last(self):
+        """
+        One past the highest block covered, 0 for an empty set
+
+        >>> RangeSet.parse('4,10,20,0,5').last, RangeSet().last
+        (20, 0)
+        """
+        return max(self.data[1::2]) if self.data else 0
+
+    def normalized(self):
+        """
+        Sorted copy with overlapping and adjacent ranges merged
+
+        >>> RangeSet.parse('8,30,40,0,5,5,10,8,12').normalized()
+        RangeSet("4,0,12,30,40")
+        """
+        out = array('Q')
+        for begin, end in sorted(self):
+            if out and begin <= out[-1]:
+                if end > out[-1]:
+                    out[-1] = end
+            else:
+                out.append(begin)
+                out.append(end)
+        return RangeSet(out)
+
+    def union(self, other):
+        """
+        >>> RangeSet.parse('4,0,5,20,30').union(RangeSet.parse('4,25,40,3,8'))
+        RangeSet("4,0,8,20,40")
+        """
+        return RangeSet(self.data + other.data).normalized()
+
+    def intersect(self, other):
+        """
+        >>> RangeSet.parse('4,0,10,20,30').intersect(RangeSet.parse('4,5,25,28,40'))
+        RangeSet("6,5,10,20,25,28,30")
+        >>> RangeSet.parse('2,0,10').intersect(RangeSet.parse('2,10,20'))
+        RangeSet("0")
+        """
+        a = self.normalized().data
+        b = other.normalized().data
+        out = array('Q')
+        i = j = 0
+        while i < len(a) and j < len(b):
+            begin = max(a[i], b[j])
+            end = min(a[i + 1], b[j + 1])
+            if begin < end:
+                out.append(begin)
+                out.append(end)
+            if a[i + 1] < b[j + 1]:
+                i += 2
+            else:
+                j += 2
+        return RangeSet(out)
+
+    def subtract(self, other):
+        """
+        >>> RangeSet.parse('4,0,10,20,30').subtract(RangeSet.parse('6,2,4,8,22,25,26'))
+        RangeSet("8,0,2,4,8,22,25,26,30")
+        >>> RangeSet.parse('2,0,10').subtract(RangeSet.parse('2,0,10'))
+        RangeSet("0")
+        """
+        a = self.normalized().data
+        b = other.normalized().data
+        out = array('Q')
+        j = 0
+        for i in range(0, len(a), 2):
+            begin, end = a[i], a[i + 1]
+            while j < len(b) and b[j + 1] <= begin:
+                j += 2
+            k = j
+            while k < len(b) and b[k] < end:
+                if b[k] > begin:
+                    out.append(begin)
+                    out.append(b[k])
+                begin = max(begin, b[k + 1])
+                k += 2
+            if begin < end:
+                out.append(begin)
+                out.append(end)
+        return RangeSet(out)
+
+    def overlaps(self, other):
+        """
+        >>> RangeSet.parse('2,0,10').overlaps(RangeSet.parse('2,9,12'))
+        True
+        >>> RangeSet.parse('2,0,10').overlaps(RangeSet.parse('2,10,12'))
+        False
+        """
+        return bool(self.intersect(other))
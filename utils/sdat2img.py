@@ -9,76 +9,496 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-import sys, os, errno
+import sys, os, io, errno, time, bisect, subprocess
+from array import array
 
-def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
-    __version__ = '1.2'
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
-    if sys.hexversion < 0x02070000:
-        print >> sys.stderr, "Python 2.7 or newer is required."
-        try:
-            input = raw_input
-        except NameError: pass
-        input('Press ENTER to exit...')
+import sparseimg
+from blockio import RangeCopier, preallocate, punch_hole, pwrite_all
+from progress import Progress, tracker, add_argument as add_progress_argument
+from rangelib import RangeSet
+
+BLOCK_SIZE = 4096
+
+# Amount of data inspected at once when looking for all-zero blocks
+SCAN_CHUNK = 4 << 20
+
+def rangeset(src):
+    try:
+        return RangeSet.parse(src)
+    except (ValueError, OverflowError):
+        print('Error on parsing following data to rangeset:\n{}'.format(src), file=sys.stderr)
         sys.exit(1)
-    else:
-        print('sdat2img binary - version: {}\n'.format(__version__))
 
-    def rangeset(src):
-        src_set = src.split(',')
-        num_set =  [int(item) for item in src_set]
-        if len(num_set) != num_set[0]+1:
-            print('Error on parsing following data to rangeset:\n{}'.format(src), file=sys.stderr)
-            sys.exit(1)
+def parse_transfer_list_file(path):
+    trans_list = open(path, 'r')
 
-        return tuple ([ (num_set[i], num_set[i+1]) for i in range(1, len(num_set), 2) ])
+    # First line in transfer list is the version number
+    version = int(trans_list.readline())
 
-    def parse_transfer_list_file(path):
-        trans_list = open(TRANSFER_LIST_FILE, 'r')
+    # Second line in transfer list is the total number of blocks we expect to write
+    new_blocks = int(trans_list.readline())
 
-        # First line in transfer list is the version number
-        version = int(trans_list.readline())
+    if version >= 2:
+        # Third line is how many stash entries are needed simultaneously
+        trans_list.readline()
+        # Fourth line is the maximum number of blocks that will be stashed simultaneously
+        trans_list.readline()
 
-        # Second line in transfer list is the total number of blocks we expect to write
-        new_blocks = int(trans_list.readline())
+    # Subsequent lines are all individual transfer commands
+    commands = []
+    for line in trans_list:
+        line = line.split(' ')
+        cmd = line[0]
+        if cmd in ['erase', 'new', 'zero']:
+            commands.append([cmd, rangeset(line[1])])
+        else:
+            # Skip lines starting with numbers, they are not commands anyway
+            if not cmd[0].isdigit():
+                print('Command "{}" is not valid.'.format(cmd), file=sys.stderr)
+                if cmd in ['move', 'bsdiff', 'imgdiff', 'stash', 'free']:
+                    print('This is an incremental OTA, apply it to the source image with blockimgupdate.py', file=sys.stderr)
+                trans_list.close()
+                sys.exit(1)
 
-        if version >= 2:
-            # Third line is how many stash entries are needed simultaneously
-            trans_list.readline()
-            # Fourth line is the maximum number of blocks that will be stashed simultaneously
-            trans_list.readline()
+    trans_list.close()
+    return version, new_blocks, commands
 
-        # Subsequent lines are all individual transfer commands
-        commands = []
-        for line in trans_list:
-            line = line.split(' ')
-            cmd = line[0]
-            if cmd in ['erase', 'new', 'zero']:
-                commands.append([cmd, rangeset(line[1])])
+def coalesce(commands):
+    """
+    Flatten the commands into [cmd, begin, end] extents, merging neighbours
+    of the same kind which are also adjacent in the image.  'new' extents
+    come out in new.dat order.
+    """
+    extents = []
+    for command in commands:
+        cmd = command[0]
+        for begin, end in command[1]:
+            if extents and extents[-1][0] == cmd and extents[-1][2] == begin:
+                extents[-1][2] = end
             else:
-                # Skip lines starting with numbers, they are not commands anyway
-                if not cmd[0].isdigit():
-                    print('Command "{}" is not valid.'.format(cmd), file=sys.stderr)
-                    trans_list.close()
-                    sys.exit(1)
+                extents.append([cmd, begin, end])
+    return extents
 
-        trans_list.close()
-        return version, new_blocks, commands
+class NewDataFile(object):
+    """
+    An uncompressed new.dat, possibly split into numbered parts
+    (system.new.dat.0, system.new.dat.1, ...), read with positional reads
+    """
 
-    BLOCK_SIZE = 4096
-    
-    version, new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
+    seekable = True
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.fds = []
+        self.starts = []
+        self.size = 0
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            self.fds.append(fd)
+            self.starts.append(self.size)
+            self.size += os.fstat(fd).st_size
+
+    def pieces(self, pos, length):
+        """
+        Yield (fd, offset, count) triples covering length bytes at pos
+        """
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while length > 0 and 0 <= i < len(self.fds):
+            part_end = self.starts[i + 1] if i + 1 < len(self.starts) else self.size
+            count = min(length, part_end - pos)
+            if count > 0:
+                yield self.fds[i], pos - self.starts[i], count
+                pos += count
+                length -= count
+            i += 1
+
+    def read_at(self, pos, length):
+        return b''.join(os.pread(fd, count, offset) for fd, offset, count in self.pieces(pos, length))
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+class NewDataStream(object):
+    """
+    A compressed new.dat decompressed on the fly.  Transfer lists consume
+    new.dat strictly in command order, so reads only ever move forward.
+    """
+
+    seekable = False
+
+    def __init__(self, path, stream, proc=None):
+        self.path = path
+        self.stream = stream
+        self.proc = proc
+        self.pos = 0
+
+    def read_at(self, pos, length):
+        if pos != self.pos:
+            raise IOError('{}: compressed new data can only be read sequentially (wanted {}, at {})'.format(self.path, pos, self.pos))
+        parts = []
+        while length > 0:
+            data = self.stream.read(length)
+            if not data:
+                break
+            parts.append(data)
+            length -= len(data)
+        data = b''.join(parts)
+        self.pos += len(data)
+        return data
 
-    if version == 1:
-        print('Android Lollipop 5.0 detected!\n')
-    elif version == 2:
-        print('Android Lollipop 5.1 detected!\n')
-    elif version == 3:
-        print('Android Marshmallow 6.x detected!\n')
-    elif version == 4:
-        print('Android Nougat 7.x / Oreo 8.x detected!\n')
+    def close(self):
+        self.stream.close()
+        if self.proc and self.proc.wait() not in (0, -13):
+            print('Warning: {} exited with status {}'.format(self.proc.args[0], self.proc.returncode), file=sys.stderr)
+
+class BrotliReader(object):
+    """
+    Minimal file-like reader over the brotli module's streaming decompressor
+    """
+
+    def __init__(self, path):
+        self.raw = open(path, 'rb')
+        self.decompressor = brotli.Decompressor()
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self, n):
+        while len(self.buffer) < n and not self.eof:
+            data = self.raw.read(1 << 20)
+            if not data:
+                self.eof = True
+                break
+            process = getattr(self.decompressor, 'process', None) or self.decompressor.decompress
+            self.buffer += process(data)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def close(self):
+        self.raw.close()
+
+# Compressed new.dat flavours: (python decompressor, command line fallback)
+COMPRESSED_SUFFIXES = {
+    '.br': (lambda path: BrotliReader(path) if brotli else None, ['brotli', '-dc']),
+    '.xz': (lambda path: lzma.open(path, 'rb') if lzma else None, ['xz', '-dc']),
+    '.lz4': (lambda path: lz4.frame.open(path, 'rb') if lz4 else None, ['lz4', '-dc']),
+}
+
+def open_new_data(path):
+    """
+    Open a new.dat given as plain, compressed (.br, .xz, .lz4) or split
+    (.new.dat.0, .new.dat.1, ...) file
+    """
+    base, ext = os.path.splitext(path)
+    if ext in COMPRESSED_SUFFIXES:
+        opener, command = COMPRESSED_SUFFIXES[ext]
+        stream = opener(path)
+        if stream is not None:
+            return NewDataStream(path, stream)
+        try:
+            proc = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+        except OSError:
+            print('Error: no {} decompressor available for {}'.format(ext, path), file=sys.stderr)
+            sys.exit(1)
+        return NewDataStream(path, proc.stdout, proc)
+
+    # Split new.dat: either the first part or the missing joined name is given
+    if ext[1:].isdigit() and base.endswith('.new.dat'):
+        path = base
+    if not os.path.exists(path) and os.path.exists(path + '.0'):
+        parts = []
+        while os.path.exists('{}.{}'.format(path, len(parts))):
+            parts.append('{}.{}'.format(path, len(parts)))
+        return NewDataFile(parts)
+
+    return NewDataFile([path])
+
+def read_blocks(source, pos, length):
+    """
+    Yield (offset, data) pieces of at most SCAN_CHUNK bytes from source
+    """
+    done = 0
+    while done < length:
+        data = source.read_at(pos + done, min(length - done, SCAN_CHUNK))
+        if not data:
+            break
+        yield done, data
+        done += len(data)
+
+def copy_extent(copier, source, src_pos, dst_fd, dst_pos, length):
+    """
+    Copy length bytes of new data at src_pos to dst_pos, return bytes copied
+    """
+    done = 0
+    if source.seekable:
+        for fd, offset, count in source.pieces(src_pos, length):
+            n = copier.copy(fd, offset, dst_fd, dst_pos + done, count)
+            done += n
+            if n < count:
+                break
     else:
-        print('Unknown Android version!\n')
+        for offset, data in read_blocks(source, src_pos, length):
+            pwrite_all(dst_fd, data, dst_pos + offset)
+            done += len(data)
+    return done
+
+def write_sparse(extents, source, dst_fd, progress=Progress()):
+    """
+    Write 'new' extents leaving holes for all-zero blocks and zero/erase
+    extents, return the number of new.dat bytes consumed
+    """
+    src_pos = 0
+    for cmd, begin, end in extents:
+        if cmd != 'new':
+            punch_hole(dst_fd, begin*BLOCK_SIZE, (end - begin)*BLOCK_SIZE)
+            progress.update(items=1)
+            continue
+
+        length = (end - begin)*BLOCK_SIZE
+        got = 0
+        for offset, data in read_blocks(source, src_pos, length):
+            view = memoryview(data)
+            dst_pos = begin*BLOCK_SIZE + offset
+            for first, count, is_zero in sparseimg.zero_runs(data, BLOCK_SIZE):
+                start = dst_pos + first*BLOCK_SIZE
+                if is_zero:
+                    punch_hole(dst_fd, start, count*BLOCK_SIZE)
+                else:
+                    preallocate(dst_fd, start, count*BLOCK_SIZE)
+                    pwrite_all(dst_fd, view[first*BLOCK_SIZE:(first + count)*BLOCK_SIZE], start)
+            # A truncated new.dat may end in a partial block
+            tail = len(data) % BLOCK_SIZE
+            if tail:
+                pwrite_all(dst_fd, view[-tail:], dst_pos + len(data) - tail)
+            got += len(data)
+            progress.update(bytes_in=len(data), bytes_out=len(data))
+
+        src_pos += got
+        progress.update(items=1)
+        if got < length:
+            print('Warning: new data file ended after {} bytes'.format(src_pos), file=sys.stderr)
+            break
+    return src_pos
+
+def write_sparse_image(extents, source, output, total_blocks, progress=Progress()):
+    """
+    Write the image as an Android sparse image: 'new' data as RAW chunks
+    (all-zero blocks as FILL), zero extents as FILL, erase extents and
+    unmapped blocks as DONT_CARE; return the number of new.dat bytes used
+    """
+    # Sparse images are written in block order, new.dat is in command order
+    segments = []
+    src_pos = 0
+    for cmd, begin, end in extents:
+        segments.append((begin, end, cmd, src_pos))
+        if cmd == 'new':
+            src_pos += (end - begin)*BLOCK_SIZE
+    segments = resolve_overlaps(segments)
+    in_order = segments == sorted(segments)
+    segments.sort()
+
+    # A compressed stream can't be read out of order, so lay the data out
+    # in a holey scratch image first and encode from that
+    if not source.seekable and not in_order:
+        scratch_path = output.name + '.tmp'
+        with open(scratch_path, 'wb') as scratch:
+            used = write_sparse(extents, source, scratch.fileno(), progress)
+            # Trailing all-zero blocks are holes, the file must still
+            # reach the end of the image
+            os.ftruncate(scratch.fileno(), total_blocks*BLOCK_SIZE)
+        try:
+            scratch_source = NewDataFile([scratch_path])
+            segments = [(begin, end, cmd, begin*BLOCK_SIZE) for begin, end, cmd, pos in segments]
+            encode_segments(segments, scratch_source, output, total_blocks)
+            scratch_source.close()
+        finally:
+            os.remove(scratch_path)
+        return used
+
+    return encode_segments(segments, source, output, total_blocks, progress)
+
+def resolve_overlaps(segments):
+    """
+    Drop the parts of command ordered (begin, end, cmd, src_pos) segments
+    which a later command writes again, as the commands apply in order
+    and the last one wins
+    """
+    # Blocks written by the commands seen so far (walking backwards), as
+    # sorted disjoint [starts[i], ends[i]) ranges
+    starts = []
+    ends = []
+    resolved = []
+    for begin, end, cmd, pos in reversed(segments):
+        pieces = []
+        i = j = bisect.bisect_right(ends, begin)
+        lo = begin
+        while j < len(starts) and starts[j] < end:
+            if starts[j] > lo:
+                pieces.append((lo, starts[j], cmd, pos + (lo - begin)*BLOCK_SIZE))
+            lo = max(lo, ends[j])
+            j += 1
+        if lo < end:
+            pieces.append((lo, end, cmd, pos + (lo - begin)*BLOCK_SIZE))
+        resolved.append(pieces)
+
+        if j > i:
+            begin = min(begin, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [begin]
+        ends[i:j] = [end]
+    return [segment for pieces in reversed(resolved) for segment in pieces]
+
+def encode_segments(segments, source, output, total_blocks, progress=Progress()):
+    """
+    Encode block ordered (begin, end, cmd, src_pos) segments as a sparse
+    image, return the number of source bytes used
+    """
+    writer = sparseimg.SparseWriter(output, BLOCK_SIZE, total_blocks)
+    used = 0
+    for begin, end, cmd, pos in segments:
+        if cmd == 'zero':
+            writer.fill(end - begin, block=begin)
+        elif cmd == 'new':
+            length = (end - begin)*BLOCK_SIZE
+            got = 0
+            for offset, data in read_blocks(source, pos, length):
+                if len(data) % BLOCK_SIZE:
+                    data += bytes(BLOCK_SIZE - len(data) % BLOCK_SIZE)
+                writer.data(data, block=begin + offset//BLOCK_SIZE)
+                got += len(data)
+                progress.update(bytes_in=len(data), bytes_out=len(data))
+            used += min(got, length)
+            if got < length:
+                print('Warning: new data file ended at offset {}'.format(pos + got), file=sys.stderr)
+        progress.update(items=1)
+    writer.close()
+    return used
+
+class TransferListImage(io.RawIOBase):
+    """
+    Read-only, seekable view of the image a transfer list + new.dat would
+    produce, without writing it out.  Image offsets are mapped to new.dat
+    offsets through a sorted index of the 'new' extents; everything else
+    reads back as zeros.  Filesystem readers can use it like a file.
+    """
+
+    def __init__(self, transfer_list, new_data):
+        super(TransferListImage, self).__init__()
+        version, new_blocks, commands = parse_transfer_list_file(transfer_list)
+        self.size = max(command[1].last for command in commands)*BLOCK_SIZE if commands else 0
+
+        self.source = new_data if hasattr(new_data, 'read_at') else open_new_data(new_data)
+        if not self.source.seekable:
+            self.source.close()
+            raise ValueError('{}: compressed new data can not be read at random, decompress it first'.format(new_data))
+
+        # Sorted (image block, new.dat offset) index over the 'new' extents
+        extents = []
+        src_pos = 0
+        for cmd, begin, end in coalesce(commands):
+            if cmd == 'new':
+                extents.append((begin, end, src_pos))
+                src_pos += (end - begin)*BLOCK_SIZE
+        extents.sort()
+        self.starts = array('Q', (e[0] for e in extents))
+        self.ends = array('Q', (e[1] for e in extents))
+        self.offsets = array('Q', (e[2] for e in extents))
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def pread(self, offset, length):
+        """
+        Return up to length bytes of the image starting at offset
+        """
+        length = max(0, min(length, self.size - offset))
+        out = bytearray(length)
+        pos = offset
+        end = offset + length
+        i = max(bisect.bisect_right(self.starts, pos // BLOCK_SIZE) - 1, 0)
+        while pos < end and i < len(self.starts):
+            ext_start = self.starts[i]*BLOCK_SIZE
+            ext_end = self.ends[i]*BLOCK_SIZE
+            if ext_start >= end:
+                break
+            if ext_end > pos:
+                lo = max(pos, ext_start)
+                hi = min(end, ext_end)
+                data = self.source.read_at(self.offsets[i] + lo - ext_start, hi - lo)
+                out[lo - offset:lo - offset + len(data)] = data
+                pos = hi
+            i += 1
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.pread(self.pos, len(b))
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super(TransferListImage, self).close()
+
+def open_image(transfer_list, new_data, buffering=io.DEFAULT_BUFFER_SIZE):
+    """
+    Open the image described by a transfer list + new.dat for reading
+    """
+    image = TransferListImage(transfer_list, new_data)
+    return io.BufferedReader(image, buffering) if buffering else image
+
+ANDROID_VERSIONS = {
+    1: 'Android Lollipop 5.0',
+    2: 'Android Lollipop 5.1',
+    3: 'Android Marshmallow 6.x',
+    4: 'Android Nougat 7.x / Oreo 8.x',
+}
+
+def convert(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, sparse=False, sparse_image=False, verbose=True, progress=None):
+    """
+    Convert one transfer list + new.dat pair, return a dict of statistics;
+    progress is a progress.Progress told about every extent written
+    """
+    version, new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
+
+    if verbose:
+        if version in ANDROID_VERSIONS:
+            print('{} detected!\n'.format(ANDROID_VERSIONS[version]))
+        else:
+            print('Unknown Android version!\n')
 
     # Don't clobber existing files to avoid accidental data loss
     try:
@@ -91,55 +511,187 @@ def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
         else:
             raise
 
-    new_data_file = open(NEW_DATA_FILE, 'rb')
-    all_block_sets = [i for command in commands for i in command[1]]
-    max_file_size = max(pair[1] for pair in all_block_sets)*BLOCK_SIZE
+    new_data_file = open_new_data(NEW_DATA_FILE)
+    max_file_size = max(command[1].last for command in commands)*BLOCK_SIZE
 
-    for command in commands:
-        if command[0] == 'new':
-            for block in command[1]:
-                begin = block[0]
-                end = block[1]
-                block_count = end - begin
-                print('Copying {} blocks into position {}...'.format(block_count, begin))
-
-                # Position output file
-                output_img.seek(begin*BLOCK_SIZE)
-                
-                # Copy one block at a time
-                while(block_count > 0):
-                    output_img.write(new_data_file.read(BLOCK_SIZE))
-                    block_count -= 1
-        else:
-            print('Skipping command {}...'.format(command[0]))
+    extents = coalesce(commands)
+    if progress is None:
+        progress = Progress()
+    progress.total = new_blocks*BLOCK_SIZE
+    progress.items_total = len(extents)
+    if verbose:
+        print('Copying {} blocks in {} extents...'.format(sum(end - begin for cmd, begin, end in extents if cmd == 'new'), len(extents)))
+
+    dst_fd = output_img.fileno()
+    start = time.time()
+
+    if sparse_image:
+        src_pos = write_sparse_image(extents, new_data_file, output_img, max_file_size//BLOCK_SIZE, progress)
+    elif sparse:
+        src_pos = write_sparse(extents, new_data_file, dst_fd, progress)
+    else:
+        copier = RangeCopier()
+        src_pos = 0
+        for cmd, begin, end in extents:
+            if cmd != 'new':
+                progress.update(items=1)
+                continue
+            length = (end - begin)*BLOCK_SIZE
+            copied = copy_extent(copier, new_data_file, src_pos, dst_fd, begin*BLOCK_SIZE, length)
+            src_pos += copied
+            progress.update(bytes_in=copied, bytes_out=copied, items=1)
+            if copied < length:
+                print('Warning: new data file ended after {} bytes'.format(src_pos), file=sys.stderr)
+                break
 
     # Make file larger if necessary
-    if(output_img.tell() < max_file_size):
+    if not sparse_image and os.fstat(dst_fd).st_size < max_file_size:
         output_img.truncate(max_file_size)
 
     output_img.close()
     new_data_file.close()
-    print('Done! Output image: {}'.format(os.path.realpath(output_img.name)))
+    progress.finish()
 
-if __name__ == '__main__':
-    try:
-        TRANSFER_LIST_FILE = str(sys.argv[1])
-        NEW_DATA_FILE = str(sys.argv[2])
-    except IndexError:
-        print('\nUsage: sdat2img.py <transfer_list> <system_new_file> [system_img]\n')
-        print('    <transfer_list>: transfer list file')
-        print('    <system_new_file>: system new dat file')
-        print('    [system_img]: output system image\n\n')
-        print('Visit xda thread for more information.\n')
+    return {
+        'version': version,
+        'output': os.path.realpath(OUTPUT_IMAGE_FILE),
+        'blocks': max_file_size//BLOCK_SIZE,
+        'bytes': src_pos,
+        'seconds': time.time() - start,
+    }
+
+def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, sparse=False, sparse_image=False, progress='quiet'):
+    __version__ = '1.2'
+
+    if sys.hexversion < 0x02070000:
+        print >> sys.stderr, "Python 2.7 or newer is required."
         try:
             input = raw_input
         except NameError: pass
         input('Press ENTER to exit...')
-        sys.exit()
+        sys.exit(1)
+    else:
+        print('sdat2img binary - version: {}\n'.format(__version__))
+
+    stats = convert(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, sparse, sparse_image,
+            progress=tracker(progress, os.path.basename(OUTPUT_IMAGE_FILE)))
+
+    print('Copied {:.1f} MiB in {:.2f}s ({:.1f} MiB/s)'.format(stats['bytes']/1048576.0, stats['seconds'], stats['bytes']/1048576.0/max(stats['seconds'], 1e-6)))
+    print('Done! Output image: {}'.format(stats['output']))
 
+# Names a new.dat may have next to <partition>.transfer.list
+NEW_DATA_SUFFIXES = ['.new.dat', '.new.dat.br', '.new.dat.xz', '.new.dat.lz4', '.new.dat.0']
+
+def find_partitions(paths):
+    """
+    Collect (name, transfer_list, new_data) jobs from directories, transfer
+    lists (new data found next to them) and TRANSFER_LIST=NEW_DATA pairs
+    """
+    jobs = []
+    for path in paths:
+        if '=' in path and not os.path.exists(path):
+            transfer_list, new_data = path.split('=', 1)
+            lists = [(transfer_list, new_data)]
+        elif os.path.isdir(path):
+            lists = [(os.path.join(path, f), None) for f in sorted(os.listdir(path)) if f.endswith('.transfer.list')]
+        else:
+            lists = [(path, None)]
+
+        for transfer_list, new_data in lists:
+            base = transfer_list[:-len('.transfer.list')] if transfer_list.endswith('.transfer.list') else os.path.splitext(transfer_list)[0]
+            if new_data is None:
+                for suffix in NEW_DATA_SUFFIXES:
+                    if os.path.exists(base + suffix):
+                        new_data = base + suffix
+                        break
+                else:
+                    print('Warning: no new data found for {}, skipping'.format(transfer_list), file=sys.stderr)
+                    continue
+            jobs.append((os.path.basename(base), transfer_list, new_data))
+    return jobs
+
+def _convert_job(job):
+    name, transfer_list, new_data, output, sparse, sparse_image = job
     try:
-        OUTPUT_IMAGE_FILE = str(sys.argv[3])
-    except IndexError:
-        OUTPUT_IMAGE_FILE = 'system.img'
+        stats = convert(transfer_list, new_data, output, sparse, sparse_image, verbose=False)
+        stats['error'] = None
+    except SystemExit as e:
+        stats = {'error': 'exited with status {}'.format(e.code)}
+    except Exception as e:
+        stats = {'error': '{}: {}'.format(type(e).__name__, e)}
+    stats['name'] = name
+    return stats
+
+def batch(paths, outdir='.', jobs=None, sparse=False, sparse_image=False, progress='quiet'):
+    """
+    Convert every partition found in paths concurrently in a process pool,
+    return the per-partition statistics in completion order; progress is
+    reported per finished partition
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    partitions = find_partitions(paths)
+    if not partitions:
+        print('Error: no transfer lists found', file=sys.stderr)
+        return []
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    suffix = '.simg' if sparse_image else '.img'
+    work = [(name, transfer_list, new_data, os.path.join(outdir, name + suffix), sparse, sparse_image)
+            for name, transfer_list, new_data in partitions]
+
+    jobs = jobs or os.cpu_count() or 1
+    print('Converting {} partitions with {} workers...\n'.format(len(work), min(jobs, len(work))))
+
+    results = []
+    start = time.time()
+    report = tracker(progress, 'sdat2img', items_total=len(work))
+    with ProcessPoolExecutor(max_workers=min(jobs, len(work))) as pool:
+        for future in as_completed([pool.submit(_convert_job, job) for job in work]):
+            stats = future.result()
+            results.append(stats)
+            report.update(bytes_in=stats.get('bytes', 0), bytes_out=stats.get('bytes', 0), items=1)
+            if stats['error']:
+                print('{}: FAILED ({})'.format(stats['name'], stats['error']))
+            else:
+                print('{}: {:.1f} MiB in {:.2f}s ({:.1f} MiB/s) -> {}'.format(stats['name'],
+                        stats['bytes']/1048576.0, stats['seconds'],
+                        stats['bytes']/1048576.0/max(stats['seconds'], 1e-6), stats['output']))
+
+    report.finish()
+
+    total = sum(r.get('bytes', 0) for r in results)
+    elapsed = time.time() - start
+    print('\nDone! {} of {} partitions converted, {:.1f} MiB in {:.2f}s ({:.1f} MiB/s)'.format(
+            sum(1 for r in results if not r['error']), len(results),
+            total/1048576.0, elapsed, total/1048576.0/max(elapsed, 1e-6)))
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a block based OTA (transfer list + new.dat) into a filesystem image',
+            epilog='Visit xda thread for more information.')
+    parser.add_argument('transfer_list', nargs='?', help='transfer list file')
+    parser.add_argument('new_data', nargs='?', help='system new dat file (.br, .xz, .lz4 and split .new.dat.N sets are read directly)')
+    parser.add_argument('output', nargs='?', default='system.img', help='output system image (default: system.img)')
+    parser.add_argument('-s', '--sparse', action='store_true', help='leave holes for zero/erase ranges and all-zero blocks')
+    parser.add_argument('-S', '--sparse-image', action='store_true', help='write an Android sparse image instead of a raw image')
+    batch_group = parser.add_argument_group('batch mode')
+    batch_group.add_argument('-b', '--batch', nargs='+', metavar='PATH',
+            help='convert every partition of directories, transfer lists or TRANSFER_LIST=NEW_DATA pairs concurrently')
+    batch_group.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: CPU count)')
+    batch_group.add_argument('-o', '--outdir', default='.', help='output directory (default: current directory)')
+    add_progress_argument(parser)
+    args = parser.parse_args()
+
+    if args.batch:
+        results = batch(args.batch, args.outdir, args.jobs, sparse=args.sparse, sparse_image=args.sparse_image, progress=args.progress)
+        sys.exit(0 if results and not any(r['error'] for r in results) else 1)
+
+    if not args.new_data:
+        parser.error('the transfer_list and new_data arguments are required')
 
-    main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE)
+    main(args.transfer_list, args.new_data, args.output, sparse=args.sparse, sparse_image=args.sparse_image, progress=args.progress)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: sparseimg.py
+#   DESCRIPTION: Android sparse image helpers
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os, sys, errno, shutil, struct, zlib
+
+from blockio import pwrite_all
+from progress import Progress, tracker, add_argument as add_progress_argument
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_HEADER = struct.Struct('<I4H4I')
+CHUNK_HEADER = struct.Struct('<2H2I')
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# total_sz of a chunk is a 32 bit byte count, header included
+MAX_CHUNK_BYTES = 0xFFFFFFFF - CHUNK_HEADER.size
+
+ZERO_FILL = b'\x00\x00\x00\x00'
+
+# Largest amount of data read into RAM at once
+COPY_CHUNK = 1 << 20
+
+def is_sparse(path):
+    """
+    True when the file at path starts with the sparse image magic
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    return len(head) == 4 and struct.unpack('<I', head)[0] == SPARSE_HEADER_MAGIC
+
+def zero_runs(buf, blk_sz=4096):
+    """
+    Split buf (bytes or bytearray, a multiple of blk_sz long) into runs of
+    all-zero and non-zero blocks, yielding (first_block, block_count, is_zero)
+    """
+    count = len(buf) // blk_sz
+    if not count:
+        return
+    zero = bytes(blk_sz)
+
+    # Most buffers are either entirely data or entirely zero
+    if buf[0:blk_sz] != zero and buf[-blk_sz:] != zero and buf.find(zero) < 0:
+        yield 0, count, False
+        return
+    if buf.count(0) == len(buf):
+        yield 0, count, True
+        return
+
+    run_start = 0
+    run_zero = buf[0:blk_sz] == zero
+    for i in range(1, count):
+        is_zero = buf[i*blk_sz:(i+1)*blk_sz] == zero
+        if is_zero != run_zero:
+            yield run_start, i - run_start, run_zero
+            run_start = i
+            run_zero = is_zero
+    yield run_start, count - run_start, run_zero
+
+class SparseWriter(object):
+    """
+    Streaming encoder for Android sparse images.  Blocks must be written in
+    ascending order; gaps are emitted as DONT_CARE chunks and consecutive
+    chunks of the same kind are merged.  The output must be seekable, the
+    file header and the header of the current chunk are patched in place.
+    """
+
+    def __init__(self, file, blk_sz=4096, total_blks=0):
+        self.file = file
+        self.blk_sz = blk_sz
+        self.total_blks = total_blks
+        self.max_chunk_blks = MAX_CHUNK_BYTES // blk_sz
+        self.block = 0
+        self.chunks = 0
+        # (type, offset of header, blocks, fill value) of the open chunk
+        self.current = None
+
+        self.start = file.tell()
+        file.write(bytes(SPARSE_HEADER.size))
+
+    def _begin(self, chunk_type, nblocks, value=None):
+        cur = self.current
+        if cur and cur[0] == chunk_type and cur[3] == value and cur[2] + nblocks <= self.max_chunk_blks:
+            self.current = (chunk_type, cur[1], cur[2] + nblocks, value)
+            return
+        self._finish()
+        self.current = (chunk_type, self.file.tell(), nblocks, value)
+        self.file.write(bytes(CHUNK_HEADER.size))
+        if value is not None:
+            self.file.write(value)
+        self.chunks += 1
+
+    def _finish(self):
+        if not self.current:
+            return
+        chunk_type, offset, nblocks, value = self.current
+        if chunk_type == CHUNK_TYPE_RAW:
+            total_sz = CHUNK_HEADER.size + nblocks*self.blk_sz
+        elif chunk_type == CHUNK_TYPE_FILL:
+            total_sz = CHUNK_HEADER.size + len(value)
+        else:
+            total_sz = CHUNK_HEADER.size
+        end = self.file.tell()
+        self.file.seek(offset)
+        self.file.write(CHUNK_HEADER.pack(chunk_type, 0, nblocks, total_sz))
+        self.file.seek(end)
+        self.current = None
+
+    def _advance(self, block):
+        if block < self.block:
+            raise ValueError('sparse image blocks must be written in ascending order ({} < {})'.format(block, self.block))
+        if block > self.block:
+            self.skip(block - self.block)
+
+    def raw(self, data, block=None):
+        """
+        Append data as RAW blocks (optionally at block, skipping the gap)
+        """
+        if block is not None:
+            self._advance(block)
+        view = memoryview(data)
+        nblocks = len(view) // self.blk_sz
+        done = 0
+        while done < nblocks:
+            count = min(nblocks - done, self.max_chunk_blks)
+            self._begin(CHUNK_TYPE_RAW, count)
+            self.file.write(view[done*self.blk_sz:(done + count)*self.blk_sz])
+            done += count
+        self.block += nblocks
+
+    def fill(self, nblocks, value=ZERO_FILL, block=None):
+        """
+        Append nblocks filled with the 4 byte pattern value
+        """
+        if block is not None:
+            self._advance(block)
+        while nblocks > 0:
+            count = min(nblocks, self.max_chunk_blks)
+            self._begin(CHUNK_TYPE_FILL, count, value)
+            self.block += count
+            nblocks -= count
+
+    def skip(self, nblocks):
+        """
+        Append nblocks whose contents do not matter
+        """
+        while nblocks > 0:
+            count = min(nblocks, self.max_chunk_blks)
+            self._begin(CHUNK_TYPE_DONT_CARE, count)
+            self.block += count
+            nblocks -= count
+
+    def data(self, buf, block=None):
+        """
+        Append buf, storing all-zero blocks as FILL chunks
+        """
+        if block is not None:
+            self._advance(block)
+        view = memoryview(buf)
+        for first, count, is_zero in zero_runs(buf, self.blk_sz):
+            if is_zero:
+                self.fill(count)
+            else:
+                self.raw(view[first*self.blk_sz:(first + count)*self.blk_sz])
+
+    def close(self):
+        """
+        Pad up to total_blks and write the final file header
+        """
+        if self.block < self.total_blks:
+            self.skip(self.total_blks - self.block)
+        self._finish()
+        self.total_blks = self.block
+        end = self.file.tell()
+        self.file.seek(self.start)
+        self.file.write(SPARSE_HEADER.pack(SPARSE_HEADER_MAGIC, 1, 0,
+                SPARSE_HEADER.size, CHUNK_HEADER.size, self.blk_sz,
+                self.total_blks, self.chunks, 0))
+        self.file.seek(end)
+
+def _read_exact(f, length):
+    buf = f.read(length)
+    if len(buf) != length:
+        raise ValueError('sparse image truncated ({} of {} bytes)'.format(len(buf), length))
+    return buf
+
+def _fill_range(fd, pattern, offset, length, crc=None):
+    """
+    Write the COPY_CHUNK long pattern over length bytes at offset (or with
+    fd None just checksum them), return the updated crc
+    """
+    done = 0
+    while done < length:
+        count = min(len(pattern), length - done)
+        if fd is not None:
+            pwrite_all(fd, pattern[:count], offset + done)
+        if crc is not None:
+            crc = zlib.crc32(pattern[:count], crc)
+        done += count
+    return crc
+
+def decode(f, out_fd, check_crc=False, progress=None):
+    """
+    Write the sparse image read sequentially from the file object f to the
+    descriptor out_fd and return the image size in bytes.  DONT_CARE
+    chunks are not written, so several sparse files of one image can be
+    decoded onto the same output.  Zero blocks past the current end of the
+    output are left as holes; the caller extends the file to the returned
+    size.  CRC32 chunks are checked when check_crc is set.
+    """
+    if progress is None:
+        progress = Progress()
+
+    header = _read_exact(f, SPARSE_HEADER.size)
+    (magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz,
+            total_blks, total_chunks, checksum) = SPARSE_HEADER.unpack(header)
+    if magic != SPARSE_HEADER_MAGIC:
+        raise ValueError('not a sparse image')
+    if major != 1 or file_hdr_sz < SPARSE_HEADER.size or chunk_hdr_sz < CHUNK_HEADER.size:
+        raise ValueError('unsupported sparse image version {}.{}'.format(major, minor))
+    _read_exact(f, file_hdr_sz - SPARSE_HEADER.size)
+
+    size = os.fstat(out_fd).st_size
+    crc = 0 if check_crc else None
+    zeros = bytes(COPY_CHUNK)
+    block = 0
+
+    for i in range(total_chunks):
+        chunk_type, reserved, chunk_blks, total_sz = CHUNK_HEADER.unpack_from(_read_exact(f, chunk_hdr_sz))
+        data_sz = total_sz - chunk_hdr_sz
+        offset = block*blk_sz
+        length = chunk_blks*blk_sz
+
+        if chunk_type == CHUNK_TYPE_RAW:
+            if data_sz != length:
+                raise ValueError('bad RAW chunk size {} for {} blocks at block {}'.format(data_sz, chunk_blks, block))
+            done = 0
+            while done < length:
+                buf = _read_exact(f, min(COPY_CHUNK, length - done))
+                pwrite_all(out_fd, buf, offset + done)
+                if crc is not None:
+                    crc = zlib.crc32(buf, crc)
+                done += len(buf)
+                progress.update(bytes_in=len(buf), bytes_out=len(buf))
+            size = max(size, offset + length)
+
+        elif chunk_type == CHUNK_TYPE_FILL:
+            if data_sz != 4:
+                raise ValueError('bad FILL chunk size {} at block {}'.format(data_sz, block))
+            value = _read_exact(f, 4)
+            if value == ZERO_FILL:
+                # Only zeros below the current end of the output need writing
+                _fill_range(out_fd, zeros, offset, min(length, max(0, size - offset)))
+                crc = _fill_range(None, zeros, offset, length, crc)
+            else:
+                crc = _fill_range(out_fd, value*(COPY_CHUNK//4), offset, length, crc)
+                size = max(size, offset + length)
+            progress.update(bytes_in=4, bytes_out=length)
+
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
+            if data_sz != 0:
+                raise ValueError('bad DONT_CARE chunk size {} at block {}'.format(data_sz, block))
+            crc = _fill_range(None, zeros, offset, length, crc)
+
+        elif chunk_type == CHUNK_TYPE_CRC32:
+            if data_sz != 4:
+                raise ValueError('bad CRC32 chunk size {} at block {}'.format(data_sz, block))
+            expected = struct.unpack('<I', _read_exact(f, 4))[0]
+            if crc is not None and expected != crc & 0xFFFFFFFF:
+                raise ValueError('CRC32 mismatch at block {} ({:08x} vs {:08x})'.format(block, crc & 0xFFFFFFFF, expected))
+
+        else:
+            raise ValueError('unknown chunk type 0x{:04X} at block {}'.format(chunk_type, block))
+
+        block += chunk_blks
+
+    if block != total_blks:
+        raise ValueError('sparse image has {} blocks, header says {}'.format(block, total_blks))
+    return total_blks*blk_sz
+
+def unsparse(inputs, output, check_crc=False, progress=None):
+    """
+    Decode one or more sparse files (e.g. a sparsechunk set) into the raw
+    image output, return the image size
+    """
+    if progress is None:
+        progress = Progress()
+
+    size = 0
+    with open(output, 'wb') as out:
+        for path in inputs:
+            with open(path, 'rb') as f:
+                size = max(size, decode(f, out.fileno(), check_crc, progress))
+            progress.update(items=1)
+        if os.fstat(out.fileno()).st_size < size:
+            out.truncate(size)
+    return size
+
+def data_extents(fd, size):
+    """
+    Yield (start, end) byte ranges of fd holding data, skipping holes where
+    the filesystem reports them
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except (AttributeError, OSError) as e:
+            if getattr(e, 'errno', None) == errno.ENXIO:
+                return
+            # No hole reporting, treat the rest as data
+            yield pos, size
+            return
+        yield start, min(end, size)
+        pos = end
+
+def encode(input, output, blk_sz=4096, progress=None):
+    """
+    Encode the raw image input as the sparse image output: holes become
+    DONT_CARE chunks, all-zero blocks FILL chunks, everything else RAW
+    """
+    if progress is None:
+        progress = Progress()
+
+    with open(input, 'rb') as src, open(output, 'wb') as out:
+        fd = src.fileno()
+        size = os.fstat(fd).st_size
+        writer = SparseWriter(out, blk_sz, (size + blk_sz - 1)//blk_sz)
+        chunk = COPY_CHUNK - COPY_CHUNK % blk_sz
+        pos = 0
+        for start, end in data_extents(fd, size):
+            pos = max(pos, start - start % blk_sz)
+            while pos < end:
+                buf = os.pread(fd, min(chunk, end - pos + -(end - pos) % blk_sz), pos)
+                if not buf:
+                    break
+                if len(buf) % blk_sz:
+                    buf += bytes(blk_sz - len(buf) % blk_sz)
+                writer.data(buf, block=pos//blk_sz)
+                pos += len(buf)
+                progress.update(bytes_in=len(buf), bytes_out=len(buf))
+        writer.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert Android sparse images to raw images and back')
+    parser.add_argument('images', nargs='+', metavar='INPUT... OUTPUT',
+            help='sparse image(s), several are merged (e.g. a sparsechunk set), and the raw (or with -e, sparse) output image')
+    parser.add_argument('-c', '--check', action='store_true', help='only tell (by exit status) whether all inputs are sparse')
+    parser.add_argument('-e', '--encode', action='store_true', help='encode one raw image as a sparse image')
+    parser.add_argument('-m', '--move-raw', action='store_true', help='move a single input that is not sparse to OUTPUT instead of failing')
+    parser.add_argument('-b', '--block-size', type=int, default=4096, help='block size for -e (default: 4096)')
+    parser.add_argument('--crc', action='store_true', help='verify CRC32 chunks while decoding')
+    add_progress_argument(parser)
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if all(is_sparse(path) for path in args.images) else 1)
+
+    if len(args.images) < 2:
+        parser.error('an OUTPUT image is required')
+    args.inputs, args.output = args.images[:-1], args.images[-1]
+
+    try:
+        report = tracker(args.progress, os.path.basename(args.output), total=sum(os.path.getsize(path) for path in args.inputs))
+        if args.encode:
+            if len(args.inputs) != 1:
+                parser.error('-e takes exactly one input')
+            encode(args.inputs[0], args.output, args.block_size, report)
+        elif len(args.inputs) == 1 and not is_sparse(args.inputs[0]):
+            if not args.move_raw:
+                print('Error: {} is not a sparse image'.format(args.inputs[0]), file=sys.stderr)
+                sys.exit(1)
+            shutil.move(args.inputs[0], args.output)
+        else:
+            unsparse(args.inputs, args.output, args.crc, report)
+        report.finish()
+    except (IOError, OSError, ValueError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-# splituapp for Python2/3 by SuperR. @XDA
+# splituapp for Python 3 by SuperR. @XDA
 #
 # For extracting img files from UPDATE.APP
 
@@ -12,120 +12,425 @@ from __future__ import print_function
 import os
 import re
 import sys
+import json
 import string
 import struct
-from subprocess import check_output
+from binascii import b2a_hex, crc_hqx
+
+import blockio
+import sparseimg
+from progress import Progress, tracker, add_argument as add_progress_argument
+
+MAGIC = b'\x55\xAA\x5A\xA5'
+
+# magic, header size, (16), payload size, (32), name, (22); the CRC table
+# fills the rest of the header
+HEADER = struct.Struct('<4sL16xL32x16s22x')
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.json'
+
+# The header CRC table holds one little-endian CRC-16/X-25 per 4 KiB block
+BLOCK_SIZE = 4096
+CHUNK = 256 * BLOCK_SIZE
+VERIFY_PIECE = 64 << 20
+REV8 = [int('{:08b}'.format(i)[::-1], 2) for i in range(256)]
+BITREV = bytes(bytearray(REV8))
+
+def crc16(data):
+	"""
+	CRC-16/X-25 of data.  X-25 is the bit-reflected form of the CRC that
+	binascii.crc_hqx computes, so reflect the input bytes and the result.
+	"""
+	crc = crc_hqx(data.translate(BITREV), 0xFFFF)
+	return (REV8[crc & 0xFF] << 8 | REV8[crc >> 8]) ^ 0xFFFF
+
+def crc_table(entry):
+	"""
+	Expected per-block CRCs of entry, or None when the header doesn't have
+	a complete table
+	"""
+	table = bytes(bytearray.fromhex(entry['crc']))
+	blocks = (entry['size'] + BLOCK_SIZE - 1) // BLOCK_SIZE
+	if not blocks or len(table) != 2*blocks:
+		return None
+	return struct.unpack('<{:d}H'.format(blocks), table)
+
+def check_blocks(data, table, first):
+	"""
+	Check data, starting at block first, against table; return the number
+	of the first bad block or None
+	"""
+	for i in range(0, len(data), BLOCK_SIZE):
+		if crc16(data[i:i + BLOCK_SIZE]) != table[first + i//BLOCK_SIZE]:
+			return first + i//BLOCK_SIZE
+	return None
+
+def entry_name(raw):
+	try:
+		filename = str(raw.decode())
+		return ''.join(f for f in filename if f in string.printable).lower()
+	except:
+		return ''
+
+def find_magic(f, pos, end):
+	"""
+	Return the next 4-byte aligned offset >= pos holding the entry magic,
+	or None
+	"""
+	pos += -pos % 4
+	while pos < end:
+		f.seek(pos)
+		buf = f.read(1 << 20)
+		if not buf:
+			break
+		i = buf.find(MAGIC)
+		while i >= 0 and i % 4:
+			i = buf.find(MAGIC, i + 1)
+		if i >= 0:
+			return pos + i
+		# keep the last 3 bytes in case the magic straddles the read
+		pos += max(4, (len(buf) - 3) & ~3)
+	return None
+
+def scan(source):
+	"""
+	Walk the entry headers of source, seeking past the payloads, and return
+	a list of entries (name, header_offset, payload_offset, size, crc)
+	"""
+	entries = []
+	with open(source, 'rb') as f:
+		end = os.fstat(f.fileno()).st_size
+		pos = 0
+		while pos + HEADER.size <= end:
+			f.seek(pos)
+			buf = f.read(HEADER.size)
+			if buf[:4] != MAGIC:
+				pos = find_magic(f, pos + 4, end)
+				if pos is None:
+					break
+				continue
 
-def extract(source, flist):
-	def cmd(command):
+			magic, headersize, filesize, filename = HEADER.unpack(buf)
+			crcdata = f.read(headersize - HEADER.size)
+
+			entries.append({
+				'name': entry_name(filename),
+				'header_offset': pos,
+				'payload_offset': pos + headersize,
+				'size': filesize,
+				'crc': b2a_hex(crcdata).decode().upper(),
+			})
+
+			pos += headersize + filesize
+			pos += -pos % 4
+	return entries
+
+def index(source, cache=True):
+	"""
+	Return the entry list of source, from the cache file next to it when
+	that still matches the size and mtime of source
+	"""
+	st = os.stat(source)
+	cache_path = source + INDEX_SUFFIX
+	if cache:
 		try:
-			test1 = check_output(command)
-			test1 = test1.strip().decode()
-		except:
-			test1 = ''
+			with open(cache_path) as c:
+				cached = json.load(c)
+			if (cached.get('version') == INDEX_VERSION and cached.get('size') == st.st_size
+					and cached.get('mtime') == st.st_mtime):
+				return cached['entries']
+		except (IOError, OSError, ValueError):
+			pass
 
-		return test1
+	entries = scan(source)
+
+	if cache:
+		try:
+			with open(cache_path, 'w') as c:
+				json.dump({'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime, 'entries': entries}, c)
+		except (IOError, OSError):
+			pass
+	return entries
+
+def output_names(entries, outdir):
+	"""
+	Pick the output file of every entry: a repeated name gets '_2', and a
+	name already taken (on disk or by an earlier entry) gets '_1', '_2', ...
+	"""
+	seen = []
+	taken = set()
+	names = []
+	for entry in entries:
+		filename = entry['name']
+		if filename in seen:
+			filename = filename+'_2'
+		seen.append(filename)
+
+		path = outdir+os.sep+filename+'.img'
+		if os.path.exists(path) or path in taken:
+			i = 1
+			while os.path.exists(outdir+os.sep+filename+'_'+str(i)+'.img') or outdir+os.sep+filename+'_'+str(i)+'.img' in taken:
+				i += 1
+			path = outdir+os.sep+filename+'_'+str(i)+'.img'
+		taken.add(path)
+		names.append((filename, path))
+	return names
+
+def select(entries, flist, source):
+	"""
+	Entries named in flist (all of them when flist is empty), reporting
+	the names that don't exist
+	"""
+	if not flist:
+		return entries
+	for name in flist:
+		if not any(e['name'] == name for e in entries):
+			print(name+' not found in '+os.path.basename(source))
+	return [e for e in entries if e['name'] in flist]
+
+def _verify_piece(job):
+	# table only covers this piece, which starts at block first of the entry
+	source, offset, length, table, first = job
+	with open(source, 'rb') as f:
+		f.seek(offset)
+		done = 0
+		while done < length:
+			buf = f.read(min(CHUNK, length - done))
+			if not buf:
+				return first + done//BLOCK_SIZE, done
+			bad = check_blocks(buf, table, done//BLOCK_SIZE)
+			if bad is not None:
+				return first + bad, done
+			done += len(buf)
+	return None, done
+
+def verify_pieces(path, offset, size, table):
+	"""
+	Split the size bytes at offset of path, covered by the crc table, into
+	_verify_piece jobs
+	"""
+	work = []
+	for start in range(0, size, VERIFY_PIECE):
+		first = start//BLOCK_SIZE
+		work.append((path, offset + start, min(VERIFY_PIECE, size - start),
+				table[first:first + VERIFY_PIECE//BLOCK_SIZE], first))
+	return work
+
+def verify(source, flist, jobs=None, progress=None, cache=True):
+	"""
+	Check the CRC tables of the selected entries without writing anything;
+	pieces of every entry are checked in parallel in a process pool
+	"""
+	from concurrent.futures import ProcessPoolExecutor
+
+	if progress is None:
+		progress = Progress()
+
+	selected = select(index(source, cache), flist, source)
+	if flist and not selected:
+		return 1
+
+	work = []
+	checked = []
+	for i, entry in enumerate(selected):
+		table = crc_table(entry)
+		if table is None:
+			print('No crc table for '+entry['name']+'.img, skipping')
+			continue
+		checked.append(i)
+		work.extend((i, job) for job in verify_pieces(source, entry['payload_offset'], entry['size'], table))
+
+	progress.total = sum(job[2] for i, job in work)
+	progress.items_total = len(work)
+
+	failed = set()
+	with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+		for (i, job), (bad, done) in zip(work, pool.map(_verify_piece, [job for i, job in work])):
+			progress.update(bytes_in=done, items=1)
+			if bad is not None and i not in failed:
+				failed.add(i)
+				print('ERROR: crc value for '+selected[i]['name']+'.img does not match at block '+str(bad))
+
+	progress.finish()
+	for i in checked:
+		if i not in failed:
+			print(selected[i]['name']+'.img OK')
+	return 1 if failed else 0
+
+def copy_entry(source, entry, path, progress=None):
+	"""
+	Copy the payload of entry to path through descriptors of its own, so
+	several entries can be copied at once.  The kernel copies (or shares)
+	the data when it can; crc checking is left to verify_pieces jobs run
+	on the output afterwards.
+	"""
+	if progress is None:
+		progress = Progress()
+
+	src = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+	try:
+		dst = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+		try:
+			done = blockio.copy_range(src, entry['payload_offset'], dst, 0, entry['size'], progress)
+			if done < entry['size']:
+				raise IOError('unexpected end of '+source)
+		finally:
+			os.close(dst)
+	finally:
+		os.close(src)
+
+	progress.update(items=1)
+
+class EntryReader(object):
+	"""
+	Sequential file-like reader over the payload of one entry, checking the
+	crc of every block it passes
+	"""
+
+	def __init__(self, fd, entry, table=None):
+		self.fd = fd
+		self.entry = entry
+		self.table = table
+		self.pos = 0
+		self.pending = b''
+		self.bad = None
+
+	def read(self, count):
+		count = min(count, self.entry['size'] - self.pos)
+		if count <= 0:
+			return b''
+		buf = blockio.pread(self.fd, count, self.entry['payload_offset'] + self.pos)
+		self.pos += len(buf)
+
+		if self.table is not None and self.bad is None and buf:
+			data = self.pending + buf
+			# a partial block is only complete at the end of the payload
+			full = len(data) if self.pos == self.entry['size'] else len(data) - len(data) % BLOCK_SIZE
+			self.bad = check_blocks(data[:full], self.table, (self.pos - len(data)) // BLOCK_SIZE)
+			self.pending = data[full:]
+		return buf
+
+	def finish(self):
+		"""
+		Read (and check) what the consumer left, return the first block
+		failing its crc or None
+		"""
+		while self.read(CHUNK):
+			pass
+		return self.bad
+
+def is_sparse_entry(source, entry):
+	with open(source, 'rb') as f:
+		f.seek(entry['payload_offset'])
+		return f.read(4) == struct.pack('<I', sparseimg.SPARSE_HEADER_MAGIC)
+
+def unsparse_entries(source, entries, path, check=True, progress=None):
+	"""
+	Decode the sparse payloads of entries, in order, into the raw image at
+	path; return the first block failing its crc or None
+	"""
+	if progress is None:
+		progress = Progress()
+	bad = None
+
+	src = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+	try:
+		with open(path, 'wb') as out:
+			size = 0
+			for entry in entries:
+				reader = EntryReader(src, entry, crc_table(entry) if check else None)
+				size = max(size, sparseimg.decode(reader, out.fileno(), progress=progress))
+				entry_bad = reader.finish()
+				if bad is None:
+					bad = entry_bad
+				progress.update(items=1)
+			if os.fstat(out.fileno()).st_size < size:
+				out.truncate(size)
+	finally:
+		os.close(src)
+	return bad
+
+def extract(source, flist, progress=None, cache=True, check=True, jobs=1, unsparse=False):
+	"""
+	Extract the entries named in flist (all when empty) to the output dir,
+	jobs entries at a time.  With unsparse, sparse entries are written as
+	raw images, and sparse entries sharing a name (super, super_2, ...) are
+	merged into one image.  The crc of copied entries is checked on the
+	output in a process pool, as each copy completes.
+	"""
+	from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-	bytenum = 4
 	outdir = 'output'
-	img_files = []
+
+	if progress is None:
+		progress = Progress()
 
 	try:
 		os.makedirs(outdir)
 	except:
 		pass
 
-	py2 = None
-	if int(''.join(str(i) for i in sys.version_info[0:2])) < 30:
-		py2 = 1
+	selected = select(index(source, cache), flist, source)
+	if flist and not selected:
+		return 1
 
-	with open(source, 'rb') as f:
-		while True:
-			i = f.read(bytenum)
+	progress.total = sum(e['size'] for e in selected)
+	progress.items_total = len(selected)
 
-			if not i:
-				break
-			elif i != b'\x55\xAA\x5A\xA5':
+	# Output names are settled before anything is written
+	work = []
+	merged = {}
+	for entry, (filename, path) in zip(selected, output_names(selected, outdir)):
+		if unsparse and is_sparse_entry(source, entry):
+			if entry['name'] in merged:
+				merged[entry['name']].append(entry)
 				continue
-
-			headersize = f.read(bytenum)
-			headersize = list(struct.unpack('<L', headersize))[0]
-			f.seek(16, 1)
-			filesize = f.read(bytenum)
-			filesize = list(struct.unpack('<L', filesize))[0]
-			f.seek(32, 1)
-			filename = f.read(16)
-
-			try:
-				filename = str(filename.decode())
-				filename = ''.join(f for f in filename if f in string.printable).lower()
-			except:
-				filename = ''
-
-			f.seek(22, 1)
-			crcdata = f.read(headersize - 98)
-
-			if not flist or filename in flist:
-				if filename in img_files:
-					filename = filename+'_2'
-
-				print('Extracting '+filename+'.img ...')
-
-				chunk = 10240
-
-				try:
-					if os.path.exists(outdir+os.sep+filename + ".img"):
-						i = 1
-						while os.path.exists(outdir+os.sep+filename+'_'+str(i)+'.img'):
-							i += 1
-
-						with open(outdir+os.sep+filename+'_'+str(i)+'.img', 'wb') as o:
-							while filesize > 0:
-					 		if chunk > filesize:
-					 			chunk = filesize
-
-					 		o.write(f.read(chunk))
-					 		filesize -= chunk
-
-					else:
-						with open(outdir+os.sep+filename+'.img', 'ab') as o:
-							while filesize > 0:
-					 		if chunk > filesize:
-					 			chunk = filesize
-
-					 		o.write(f.read(chunk))
-					 		filesize -= chunk
-				except:
-					print('ERROR: Failed to create '+filename+'.img\n')
-					return 1
-
-				img_files.append(filename)
-
-				if os.name != 'nt':
-					if os.path.isfile('crc'):
-						print('Calculating crc value for '+filename+'.img ...\n')
-
-						crcval = []
-						if py2:
-							for i in crcdata:
-								crcval.append('%02X' % ord(i))
-						else:
-							for i in crcdata:
-								crcval.append('%02X' % i)
-
-						crcval = ''.join(crcval)
-						crcact = cmd('./crc output/'+filename+'.img')
-
-						if crcval != crcact:
-							print('ERROR: crc value for '+filename+'.img does not match\n')
-							return 1
+			merged[entry['name']] = [entry]
+			work.append((merged[entry['name']], filename, path))
+		else:
+			work.append((entry, filename, path))
+
+	status = 0
+	checks = []
+	with ThreadPoolExecutor(max_workers=max(1, jobs or 1)) as pool, ProcessPoolExecutor(max_workers=max(1, jobs or 1)) as checker:
+		futures = []
+		for entry, filename, path in work:
+			if isinstance(entry, list):
+				print('Extracting '+filename+'.img (unsparsing {:d} entries) ...'.format(len(entry)))
+				futures.append(pool.submit(unsparse_entries, source, entry, path, check, progress))
 			else:
-				f.seek(filesize, 1)
+				print('Extracting '+filename+'.img ...')
+				futures.append(pool.submit(copy_entry, source, entry, path, progress))
 
-			xbytes = bytenum - f.tell() % bytenum
-			if xbytes < bytenum:
-				f.seek(xbytes, 1)
+		for (entry, filename, path), future in zip(work, futures):
+			try:
+				bad = future.result()
+			except (IOError, OSError, ValueError):
+				print('ERROR: Failed to create '+filename+'.img\n')
+				status = 1
+				continue
 
+			if bad is not None:
+				print('ERROR: crc value for '+filename+'.img does not match at block '+str(bad)+'\n')
+				status = 1
+
+			# The copy holds the payload as is, check it while the rest copy
+			table = crc_table(entry) if check and not isinstance(entry, list) else None
+			if table is not None:
+				checks.append((filename, [checker.submit(_verify_piece, job) for job in verify_pieces(path, 0, entry['size'], table)]))
+
+		for filename, pieces in checks:
+			for piece in pieces:
+				bad, done = piece.result()
+				if bad is not None:
+					print('ERROR: crc value for '+filename+'.img does not match at block '+str(bad)+'\n')
+					status = 1
+					break
+
+	progress.finish()
+	if status:
+		return status
 	print('\nExtraction complete')
 	return 0
 
@@ -138,6 +443,21 @@ if __name__ == '__main__':
 	optional = parser.add_argument_group('Optional')
 	optional.add_argument("-h", "--help", action="help", help="show this help message and exit")
 	optional.add_argument("-l", "--list", nargs="*", metavar=('img1', 'img2'), help="List of img files to extract")
+	optional.add_argument("--json", action="store_true", help="Print the entry index as JSON and exit")
+	optional.add_argument("--no-cache", action="store_true", help="Rescan instead of using (and writing) the "+INDEX_SUFFIX+" index next to the file")
+	optional.add_argument("--no-verify", action="store_true", help="Don't check the header crc values while extracting")
+	optional.add_argument("--verify-only", action="store_true", help="Only check the crc values of the (listed) img files, write nothing")
+	optional.add_argument("-u", "--unsparse", action="store_true", help="Write sparse img files as raw images, merging same-named entries")
+	optional.add_argument("-j", "--jobs", type=int, help="Number of img files extracted at once, or of verify processes (default: CPU count)")
+	add_progress_argument(optional)
 	args = parser.parse_args()
 
-	extract(args.filename, args.list)
+	if args.json:
+		json.dump(index(args.filename, not args.no_cache), sys.stdout, indent=1)
+		print()
+		sys.exit(0)
+
+	if args.verify_only:
+		sys.exit(verify(args.filename, args.list, args.jobs, tracker(args.progress, os.path.basename(args.filename)), not args.no_cache))
+
+	sys.exit(extract(args.filename, args.list, tracker(args.progress, os.path.basename(args.filename)), not args.no_cache, not args.no_verify, args.jobs or os.cpu_count() or 1, args.unsparse))
@@ -84,6 +84,15 @@ else
     exit 1
 fi
 
+# Known-answer checks kept in the helper modules' docstrings
+echo "8. Checking extractor helpers..."
+if python3 -m doctest utils/rangelib.py utils/blockimgupdate.py; then
+    echo "✅ Extractor helper checks pass"
+else
+    echo "❌ Extractor helper checks failed"
+    exit 1
+fi
+
 echo "============================================"
 echo "🎉 All validation checks passed!"
 echo ""